@@ -6,6 +6,7 @@ import asyncio
 import uvicorn
 
 from db import Database
+from db_pool import close_pool
 from web_api import app
 
 load_dotenv()
@@ -111,11 +112,21 @@ async def start_api():
     await server.serve()
 
 
+async def shutdown():
+    # 共有プールは Bot と Web API で1つ。Bot を止めてから最後に閉じる
+    if not bot.is_closed():
+        await bot.close()
+    await close_pool()
+
+
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.create_task(start_api())
     loop.create_task(start_bot())
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(shutdown())
 
 
 
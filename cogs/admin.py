@@ -42,11 +42,17 @@ class AdminCog(commands.Cog):
 
         # 操作モード分岐
         if mode == "設定":
-            await self.bot.db.set_balance(uid, guild_id, amount)
+            await self.bot.db.set_balance(
+                uid, guild_id, amount, reason="admin_set", ref=interaction.user.id
+            )
         elif mode == "増加":
-            await self.bot.db.add_balance(uid, guild_id, amount)
+            await self.bot.db.add_balance(
+                uid, guild_id, amount, reason="admin_add", ref=interaction.user.id
+            )
         elif mode == "減少":
-            await self.bot.db.remove_balance(uid, guild_id, amount)
+            await self.bot.db.remove_balance(
+                uid, guild_id, amount, reason="admin_remove", ref=interaction.user.id
+            )
         else:
             return await interaction.response.send_message(
                 "モードは 設定 / 増加 / 減少 から選んでください。",
@@ -115,11 +121,7 @@ class AdminCog(commands.Cog):
         guild_id = str(guild.id)
 
         # サブ垢ロール取得（ホテル設定）
-        hotel_config = await self.bot.db.conn.fetchrow(
-            "SELECT sub_role FROM hotel_settings WHERE guild_id=$1",
-            guild_id
-        )
-        sub_role_id = hotel_config["sub_role"] if hotel_config else None
+        sub_role_id = await self.bot.db.get_hotel_sub_role(guild_id)
         sub_role = guild.get_role(int(sub_role_id)) if sub_role_id else None
 
         # 対象メンバー抽出
@@ -143,25 +145,35 @@ class AdminCog(commands.Cog):
         lack_members = []
 
         if action.value == "pay":
-            # 送金は全員OK
-            for member in members:
-                await self.bot.db.add_balance(str(member.id), guild_id, amount)
-                success_members.append(member)
+            # 送金は全員OK（1クエリで一括加算）
+            await self.bot.db.apply_balance_deltas(
+                guild_id,
+                [(str(m.id), amount) for m in members],
+                floor=None,
+                reason="role_pay",
+                ref=role.id
+            )
+            success_members = members
 
             verb = "送金"
             sign = "+"
 
         else:  # deduct
-            for member in members:
-                user = await self.bot.db.get_user(str(member.id), guild_id)
-                balance = user["balance"]
+            # 残高が足りる人だけ1クエリで一括減算
+            result = await self.bot.db.apply_balance_deltas(
+                guild_id,
+                [(str(m.id), -amount) for m in members],
+                floor=0,
+                reason="role_deduct",
+                ref=role.id
+            )
+            rejected_ids = {user_id for user_id, _, _ in result["rejected"]}
 
-                if balance < amount:
+            for member in members:
+                if str(member.id) in rejected_ids:
                     lack_members.append(member)
-                    continue
-
-                await self.bot.db.add_balance(str(member.id), guild_id, -amount)
-                success_members.append(member)
+                else:
+                    success_members.append(member)
 
             verb = "引き落とし"
             sign = "-"
@@ -275,6 +287,114 @@ class AdminCog(commands.Cog):
                 ephemeral=True
             )
 
+    # --------------------------
+    # /db統計（SQLテンプレート別の上位）
+    # --------------------------
+    @app_commands.command(
+        name="db統計",
+        description="重いSQLの上位とDBプールの状況を表示します（管理者限定）"
+    )
+    @app_commands.describe(
+        order="並び順",
+        count="表示件数（最大25）"
+    )
+    @app_commands.choices(order=[
+        app_commands.Choice(name="合計時間", value="total_ms"),
+        app_commands.Choice(name="最大時間", value="max_ms"),
+        app_commands.Choice(name="平均時間", value="avg_ms"),
+        app_commands.Choice(name="回数", value="count"),
+        app_commands.Choice(name="行数", value="rows"),
+    ])
+    async def db_stats(
+        self,
+        interaction: discord.Interaction,
+        order: app_commands.Choice[str] | None = None,
+        count: int = 10
+    ):
+        settings = await self.bot.db.get_settings()
+        admin_roles = settings["admin_roles"] or []
+
+        is_admin_role = any(str(r.id) in admin_roles for r in interaction.user.roles)
+        if not (interaction.user.guild_permissions.administrator or is_admin_role):
+            return await interaction.response.send_message(
+                "❌ 管理者ロールが必要です。",
+                ephemeral=True
+            )
+
+        order_by = order.value if order else "total_ms"
+        rows = self.bot.db.top_queries(max(1, min(count, 25)), order_by)
+
+        # 1ページ目：プール / ロック待ち
+        pool = self.bot.db.pool_stats()
+        locks = self.bot.db.lock_wait_stats()
+
+        summary = discord.Embed(title="🗄 DB統計", color=0x3498db)
+        if pool:
+            summary.add_field(
+                name="プール",
+                value=(
+                    f"使用中 {pool['in_use']} / {pool['max_size']}"
+                    f"（ピーク {pool['peak_in_use']}）\n"
+                    f"取得待ち 平均 {pool['acquire']['avg_wait'] * 1000:.1f}ms"
+                    f" / 最大 {pool['acquire']['max_wait'] * 1000:.1f}ms\n"
+                    f"SQL {pool['queries']['count']}回"
+                    f" 平均 {pool['queries']['avg_time'] * 1000:.1f}ms"
+                    f" / 最大 {pool['queries']['max_time'] * 1000:.1f}ms"
+                ),
+                inline=False
+            )
+        if locks:
+            lines = [
+                f"{name}: {s['count']}回 最大待ち {s['max_wait'] * 1000:.1f}ms"
+                for name, s in sorted(
+                    locks.items(), key=lambda x: x[1]["max_wait"], reverse=True
+                )[:5]
+            ]
+            summary.add_field(name="ロック待ち", value="\n".join(lines), inline=False)
+        summary.set_footer(text=f"並び順: {order_by} | テンプレート {len(rows)}件")
+
+        pages = [summary]
+
+        for i, r in enumerate(rows, start=1):
+            embed = discord.Embed(
+                title=f"#{i} {r['count']}回 / 合計 {r['total_ms']:.0f}ms",
+                description=f"```sql\n{r['query'][:1500]}\n```",
+                color=0x3498db
+            )
+            embed.add_field(
+                name="時間",
+                value=f"平均 {r['avg_ms']}ms / 最大 {r['max_ms']}ms",
+                inline=True
+            )
+            embed.add_field(
+                name="行数 / エラー",
+                value=f"{r['rows']} / {r['errors']}",
+                inline=True
+            )
+            embed.add_field(
+                name="分布",
+                value=" ".join(f"{k}:{v}" for k, v in r["histogram"].items() if v) or "-",
+                inline=False
+            )
+            embed.add_field(
+                name="呼び出し元",
+                value="\n".join(f"{c} ({n})" for c, n in r["callers"]) or "-",
+                inline=False
+            )
+            pages.append(embed)
+
+        if len(pages) == 1:
+            return await interaction.response.send_message(
+                embed=pages[0],
+                ephemeral=True
+            )
+
+        await interaction.response.send_message(
+            embed=pages[0],
+            view=Paginator(pages),
+            ephemeral=True
+        )
+
 
 # --------------------------
 # setup（必須）
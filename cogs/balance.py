@@ -1,6 +1,6 @@
 import inspect
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 
 from logger import log_pay
@@ -8,6 +8,9 @@ from PIL import Image
 import os
 import io
 
+# 台帳を圧縮せずに残す日数（監査で遡れる範囲）
+LEDGER_KEEP_DAYS = 30
+
 BADGE_DIR = os.path.join(os.path.dirname(__file__), "assets", "badge")
 
 BADGE_FILES = {
@@ -84,6 +87,34 @@ class BalanceCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+    async def cog_load(self):
+        if not self.ledger_maintenance.is_running():
+            self.ledger_maintenance.start()
+
+    async def cog_unload(self):
+        self.ledger_maintenance.cancel()
+
+    # ================================
+    # 残高台帳メンテナンス
+    # - users.balance と台帳の照合（ズレは reconcile 行で補正）
+    # - 古い台帳をチェックポイントへ圧縮
+    # ================================
+    @tasks.loop(hours=6)
+    async def ledger_maintenance(self):
+        try:
+            mismatches = await self.bot.db.reconcile_balances()
+            compacted = await self.bot.db.compact_balance_ledger(
+                keep_days=LEDGER_KEEP_DAYS
+            )
+            print(
+                f"[LEDGER] reconcile={len(mismatches)} compacted={compacted}"
+            )
+        except Exception as e:
+            print("[LEDGER] maintenance error:", repr(e))
+
+    @ledger_maintenance.before_loop
+    async def before_ledger_maintenance(self):
+        await self.bot.wait_until_ready()
 
 
 
@@ -258,32 +289,13 @@ class BalanceCog(commands.Cog):
 
         await interaction.response.defer(ephemeral=True)
 
-        import asyncio
-
-        tasks = [
-            self.bot.db.add_user_badge(
-                str(m.id),
-                str(guild.id),
-                badge_value
-            )
-            for m in members
-        ]
-
-        # 同時実行数（ここ調整ポイント）
-        CHUNK_SIZE = 20
-
-        count = 0
-
-        for i in range(0, len(tasks), CHUNK_SIZE):
-            chunk = tasks[i:i + CHUNK_SIZE]
-            results = await asyncio.gather(*chunk, return_exceptions=True)
-
-            # 成功カウント（エラー除外）
-            for r in results:
-                if not isinstance(r, Exception):
-                    count += 1
-                else:
-                    print("badge add error:", r)
+        # ロール全員分を1クエリで付与
+        await self.bot.db.add_user_badges(
+            str(guild.id),
+            [str(m.id) for m in members],
+            badge_value
+        )
+        count = len(members)
 
         await interaction.followup.send(
             f"🏅 {role.name} の {count}人に **{badge_value}** を付与しました。",
@@ -357,14 +369,13 @@ class BalanceCog(commands.Cog):
 
         await interaction.response.defer(ephemeral=True)
 
-        count = 0
-        for m in members:
-            await self.bot.db.remove_user_badge(
-                str(m.id),
-                str(guild.id),
-                badge_value
-            )
-            count += 1
+        # ロール全員分を1クエリで削除
+        await self.bot.db.remove_user_badges(
+            str(guild.id),
+            [str(m.id) for m in members],
+            badge_value
+        )
+        count = len(members)
 
         await interaction.followup.send(
             f"🗑️ {role.name} の {count}人から **{badge_value}** を削除しました。",
@@ -422,8 +433,14 @@ class BalanceCog(commands.Cog):
                 )
 
             # 送金実行
-            await db.remove_balance(str(sender.id), str(guild.id), amount)
-            await db.add_balance(str(member.id), str(guild.id), amount)
+            await db.remove_balance(
+                str(sender.id), str(guild.id), amount,
+                reason="transfer_out", ref=member.id
+            )
+            await db.add_balance(
+                str(member.id), str(guild.id), amount,
+                reason="transfer_in", ref=sender.id
+            )
         except Exception as e:
             print("pay error:", repr(e))
             if interaction.response.is_done():
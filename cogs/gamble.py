@@ -385,7 +385,7 @@ class BetView(discord.ui.View):
                         ephemeral=True
                     )
 
-                await interaction.client.db.remove_balance(uid, guild_id, amt)
+                await interaction.client.db.remove_balance(uid, guild_id, amt, reason="gamble_bet")
 
                 await interaction.client.db._execute(
                     """
@@ -554,7 +554,9 @@ class JudgeView(discord.ui.View):
 
         # DB反映
         for uid, info in pay_dict.items():
-            await db.add_balance(uid, guild_id, info["payout"] + info["refund"])
+            await db.add_balance(
+                uid, guild_id, info["payout"] + info["refund"], reason="gamble_payout"
+            )
 
         # -----------------------------
         # 📌 Embed
@@ -96,7 +96,7 @@ class HotelCog(commands.Cog):
         await self._wait_db_ready()
 
         try:
-            rows = await self.bot.db._fetch("SELECT * FROM hotel_settings")
+            rows = await self.bot.db.get_all_hotel_settings()
         except Exception as e:
             print("[Hotel] load hotel_settings failed:", repr(e))
             return
@@ -182,24 +182,7 @@ class HotelCog(commands.Cog):
         cats = [category1, category2, category3, category4, category5]
         category_ids = [str(c.id) for c in cats if c is not None]
 
-        await self.bot.db._execute(
-            """
-            INSERT INTO hotel_settings (
-                guild_id, manager_role, log_channel, sub_role,
-                ticket_price_1, ticket_price_10, ticket_price_30,
-                category_ids
-            )
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
-            ON CONFLICT (guild_id)
-            DO UPDATE SET
-                manager_role=$2,
-                log_channel=$3,
-                sub_role=$4,
-                ticket_price_1=$5,
-                ticket_price_10=$6,
-                ticket_price_30=$7,
-                category_ids=$8;
-            """,
+        await self.bot.db.save_hotel_settings(
             guild_id,
             str(manager_role.id),
             str(log_channel.id),
@@ -241,10 +224,7 @@ class HotelCog(commands.Cog):
 
         guild_id = str(interaction.guild.id)
 
-        hotel_config = await self.bot.db._fetchrow(
-            "SELECT * FROM hotel_settings WHERE guild_id=$1",
-            guild_id
-        )
+        hotel_config = await self.bot.db.get_hotel_settings(guild_id)
         if not hotel_config:
             return await interaction.response.send_message(
                 "❌ ホテル初期設定がまだ行われていません。",
@@ -306,10 +286,7 @@ class HotelCog(commands.Cog):
 
         owner_id = room["owner_id"]
 
-        hotel_config = await interaction.client.db._fetchrow(
-            "SELECT * FROM hotel_settings WHERE guild_id=$1",
-            guild_id
-        )
+        hotel_config = await interaction.client.db.get_hotel_settings(guild_id)
         if not hotel_config:
             return await interaction.response.send_message(
                 "❌ ホテル初期設定がまだ行われていません。",
@@ -430,10 +407,7 @@ class HotelCog(commands.Cog):
         is_admin_role = any(str(r.id) in admin_roles for r in interaction.user.roles)
 
         guild_id = str(guild.id)
-        hotel_config = await self.bot.db._fetchrow(
-            "SELECT * FROM hotel_settings WHERE guild_id=$1",
-            guild_id
-        )
+        hotel_config = await self.bot.db.get_hotel_settings(guild_id)
 
         manager_role_id = hotel_config["manager_role"] if hotel_config else None
         has_manager_role = False
@@ -18,10 +18,7 @@ async def _get_room_and_config(interaction: discord.Interaction):
     if not room:
         return None, None, "❌ このVCはホテルルームとして登録されていません。"
 
-    config = await interaction.client.db.conn.fetchrow(
-        "SELECT * FROM hotel_settings WHERE guild_id=$1",
-        guild_id
-    )
+    config = await interaction.client.db.get_hotel_settings(guild_id)
     if not config:
         return None, None, "❌ ホテル初期設定がありません。（/ホテル初期設定）"
 
@@ -364,10 +361,7 @@ async def _extend_days(interaction: discord.Interaction, need: int, days: int):
 async def send_extend_log(interaction, vc, days, new_expire):
     guild_id = str(interaction.guild.id)
 
-    config = await interaction.client.db.conn.fetchrow(
-        "SELECT * FROM hotel_settings WHERE guild_id=$1",
-        guild_id
-    )
+    config = await interaction.client.db.get_hotel_settings(guild_id)
     if not config:
         return
 
@@ -27,7 +27,9 @@ class TicketConfirmButton(discord.ui.Button):
             )
 
         # 残高減算
-        await interaction.client.db.remove_balance(user_id, guild_id, self.price)
+        await interaction.client.db.remove_balance(
+            user_id, guild_id, self.price, reason="hotel_ticket"
+        )
 
         # チケット付与
         new_tickets = await interaction.client.db.add_tickets(
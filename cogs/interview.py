@@ -165,7 +165,8 @@ class InterviewCog(commands.Cog):
                 await self.bot.db.set_balance(
                     str(member.id),
                     guild_id,
-                    reward_amount
+                    reward_amount,
+                    reason="interview"
                 )
 
                 # 🥚 初回だけランダム卵付与
@@ -414,13 +414,13 @@ class JankenCardCog(commands.Cog):
         return int(row["balance"])
 
     async def _add_balance(self, user_id: int, amount: int, guild_id: int):
-        await self.bot.db.add_balance(str(user_id), str(guild_id), amount)
+        await self.bot.db.add_balance(str(user_id), str(guild_id), amount, reason="janken")
 
     async def _sub_balance(self, user_id: int, amount: int, guild_id: int) -> bool:
         row = await self.bot.db.get_user(str(user_id), str(guild_id))
         if row["balance"] < amount:
             return False
-        await self.bot.db.remove_balance(str(user_id), str(guild_id), amount)
+        await self.bot.db.remove_balance(str(user_id), str(guild_id), amount, reason="janken")
         return True
 
     # -----------------------------
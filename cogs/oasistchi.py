@@ -13,6 +13,9 @@ import asyncio
 from PIL import Image, ImageSequence
 from datetime import datetime, timezone, timedelta, time as dtime
 from db import PASSIVE_SKILLS
+from race_scheduler import DeadlineScheduler
+from response_cache import race_cache
+from race_pools import pool_aggregator
 JST = timezone(timedelta(hours=9))
 import traceback
 
@@ -568,6 +571,15 @@ class OasistchiCog(commands.Cog):
         self.db = bot.db
         self._race_lock = asyncio.Lock()
 
+        # レース進行（抽選・確定・結果送信）は締切スケジューラーで駆動
+        self.race_scheduler = DeadlineScheduler("RACE SCHEDULER")
+        for phase in ("lottery", "finalize", "result"):
+            self.race_scheduler.on(
+                phase,
+                lambda key, phase=phase: self._on_race_deadline(phase, key)
+            )
+        self.race_scheduler.on("daily", self._on_race_daily)
+
     async def cog_load(self):
         print("🔥 cog_load 呼ばれた")
 
@@ -578,30 +590,32 @@ class OasistchiCog(commands.Cog):
         if not self.oasistchi_tick.is_running():
             self.oasistchi_tick.start()
 
-        if not self.race_lottery_watcher.is_running():
-            self.race_lottery_watcher.start()
-
-
         if not self.trifecta_purchase_dm_watcher.is_running():
             self.trifecta_purchase_dm_watcher.start()
 
     async def cog_unload(self):
         self.poop_check.cancel()
-        self.race_tick.cancel()
         self.oasistchi_tick.cancel()
-        self.race_lottery_watcher.cancel()
+        self.race_scheduler.stop()
 
     @commands.Cog.listener()
     async def on_ready(self):
         if not hasattr(self.bot, "_race_started"):
             self.bot._race_started = True
 
-            print("🏇 Race loop starting...")
+            print("🏇 Race scheduler starting...")
 
             await asyncio.sleep(2)
 
-            if not self.race_tick.is_running():
-                self.race_tick.start()
+            if not self.race_scheduler.is_running():
+                await self.start_race_scheduler()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        # 途中参加のサーバーも当日分から
+        if self.race_scheduler.is_running():
+            async with self._race_lock:
+                await self.trigger_race_daily_process()
 
 
 
@@ -676,91 +690,35 @@ class OasistchiCog(commands.Cog):
 
 
     async def trigger_race_daily_process(self):
+        """レースカレンダーを（足りなければ）作り足し、今日の分をスケジューラーに読み込む"""
         db = self.bot.db
-        now = datetime.now(JST)
-        today = now.date()
-
-        # 🔑 Bot が参加している全 guild を処理
-        for guild in self.bot.guilds:
-            guild_id = str(guild.id)
-
-            # =========================
-            # ① 今日のレース生成
-            # =========================
-            try:
-                async with db._lock:
-                    if not await db.has_today_race_schedules(today, guild_id):
-                        await db.generate_today_races(guild_id, today)
-                        print(f"[RACE] {today} のレースを生成しました guild={guild_id}")
-            except Exception as e:
-                print(f"[RACE ERROR] generate failed guild={guild_id}: {e}")
-                continue
-
-            # =========================
-            # ② レース一覧取得
-            # =========================
-            async with db._lock:
-                races = await db.get_today_race_schedules(today, guild_id)
-
-            # =========================
-            # ③ 抽選判定ループ
-            # =========================
-            for race in races:
-                if race.get("lottery_done"):
-                    continue
-
-                race_time_raw = race["race_time"]
-                if isinstance(race_time_raw, str):
-                    h, m = map(int, race_time_raw.split(":"))
-                    race_time = dtime(hour=h, minute=m)
-                else:
-                    race_time = race_time_raw
-
-                entry_close = (
-                    datetime.combine(today, race_time, JST)
-                    - timedelta(minutes=race["entry_open_minutes"])
-                )
-
-                if now < entry_close:
-                    continue
-
-                # =========================
-                # ④ pending 数チェック
-                # =========================
-                async with db._lock:
-                    pending_count = await db._fetchval(
-                        """
-                        SELECT COUNT(*)
-                        FROM race_entries
-                        WHERE guild_id = $1
-                          AND race_date = $2
-                          AND schedule_id = $3
-                          AND status = 'pending'
-                        """,
-                        guild_id,
-                        race["race_date"],
-                        race["id"],
-                    )
-
-                if pending_count < 2:
-                    continue
-
-                # ⑤ 抽選実行
-                #try:
-                #    await db.run_race_lottery(
-                #        guild_id,
-                #        race["race_date"],
-                #        race["id"]
-                #   )
-
-                #    print(f"[RACE] 抽選完了 race_id={race['id']} guild={guild_id}")
-
-                #except Exception as e:
-                #    print(f"[RACE ERROR] lottery failed race_id={race['id']} guild={guild_id}: {e}")
+        today = today_jst_date()
 
+        # =========================
+        # ① レースカレンダー（全 guild・数日先まで一括）
+        # 足りていれば読むだけで終わる
+        # =========================
+        guild_ids = [str(guild.id) for guild in self.bot.guilds]
 
+        try:
+            async with db.lock("race_schedules"):
+                created = await db.ensure_race_calendar(guild_ids, today)
+            if created:
+                print(f"[RACE] {today} から {created} レースを生成しました guilds={len(guild_ids)}")
+        except Exception as e:
+            print(f"[RACE ERROR] calendar generate failed: {e!r}")
 
+        # =========================
+        # ② 前日までの単勝プールをメモリから外す
+        # =========================
+        evicted = pool_aggregator.evict_before(today)
+        if evicted:
+            print(f"[RACE] {evicted} レース分のプールをメモリから外しました")
 
+        # =========================
+        # ③ 締切スケジュール読み込み
+        # =========================
+        await self.load_race_schedule(today)
 
     # =========================
     # レース処理（正規版・完成）
@@ -960,376 +918,446 @@ class OasistchiCog(commands.Cog):
 
 
     # =========================
-    # レース抽選タスク（完全防御版）
+    # レース進行（締切スケジューラー）
+    # 締切ごとに1回だけ DB を見る（ポーリングしない）
+    #   lottery  : 締切（発走 - entry_open_minutes）→ 抽選
+    #   finalize : 発走 → レース確定・賞金
+    #   result   : 発走 + 10分 → 結果パネル・払い戻し
+    #   daily    : 翌日 0:00 → レース生成・読み込み
     # =========================
-    @tasks.loop(seconds=30)
-    async def race_lottery_watcher(self):
+    RACE_RESULT_DELAY = timedelta(minutes=10)
 
-        try:
-            now = datetime.now(JST)
-            today = now.date()
+    @staticmethod
+    def race_datetime(race) -> datetime:
+        race_time_raw = race.get("race_time")
 
-            for guild in self.bot.guilds:
-                guild_id = str(guild.id)
+        if isinstance(race_time_raw, str):
+            h, m = map(int, race_time_raw.split(":")[:2])
+            race_time = dtime(hour=h, minute=m)
+        else:
+            race_time = race_time_raw
+
+        return datetime.combine(race["race_date"], race_time, tzinfo=JST)
+
+    def race_deadlines(self, race) -> dict:
+        race_dt = self.race_datetime(race)
+        return {
+            "lottery": race_dt - timedelta(minutes=race.get("entry_open_minutes", 10)),
+            "finalize": race_dt,
+            "result": race_dt + self.RACE_RESULT_DELAY,
+        }
+
+    @staticmethod
+    def next_race_phase(race) -> str | None:
+        if not race.get("lottery_done"):
+            return "lottery"
+        if not race.get("reward_paid", False):
+            return "finalize"
+        if not race.get("result_sent", False):
+            return "result"
+        return None
+
+    def schedule_race(self, race):
+        """レースの次のフェーズを締切時刻で登録（過去なら即実行）"""
+        phase = self.next_race_phase(race)
+        key = (str(race["guild_id"]), race["id"])
+
+        # 別フェーズの古い登録は取り消す
+        for kind in ("lottery", "finalize", "result"):
+            if kind != phase:
+                self.race_scheduler.cancel(kind, key)
+
+        if phase is None:
+            return
 
-                try:
-                    races = await self.bot.db.get_today_race_schedules(today, guild_id)
-                except Exception as e:
-                    print(f"[RACE ERROR] get_today_race_schedules guild={guild_id} err={e!r}")
-                    continue
+        when = self.race_deadlines(race)[phase]
+        self.race_scheduler.schedule(when.timestamp(), phase, key)
 
-                for race in races:
+    async def load_race_schedule(self, race_date=None):
+        """指定日（既定は今日）のレースを DB から読み込んで heap を作り直す"""
+        race_date = race_date or today_jst_date()
+        guild_ids = {str(g.id) for g in self.bot.guilds}
 
-                    try:
-                        # -------------------------
-                        # race_time 安全変換
-                        # -------------------------
-                        race_time_raw = race.get("race_time")
+        races = await self.bot.db.get_race_schedules_by_date(race_date)
 
-                        if isinstance(race_time_raw, str):
-                            h, m = map(int, race_time_raw.split(":"))
-                            race_time = dtime(hour=h, minute=m)
-                        else:
-                            race_time = race_time_raw
+        self.race_scheduler.cancel_where(
+            lambda kind, key: kind in ("lottery", "finalize", "result")
+        )
 
-                        race_dt = datetime.combine(today, race_time, tzinfo=JST)
+        count = 0
+        for race in races:
+            race = dict(race)
+            if race["guild_id"] not in guild_ids:
+                continue
+            self.schedule_race(race)
+            count += 1
 
-                        close_dt = race_dt - timedelta(
-                            minutes=race.get("entry_open_minutes", 10)
-                        )
+        print(f"[RACE SCHEDULER] loaded {count} races date={race_date}")
 
-                        # =========================
-                        # ① 抽選
-                        # =========================
-                        if not race.get("lottery_done") and now >= close_dt:
+    def schedule_next_daily(self):
+        tomorrow = today_jst_date() + timedelta(days=1)
+        # 0:00 ちょうどだと日付判定がぶれるので少し後
+        when = datetime.combine(tomorrow, dtime(0, 0, 5), tzinfo=JST)
+        self.race_scheduler.schedule(when.timestamp(), "daily", "daily")
 
-                            print(f"[RACE LOTTERY] race_id={race.get('id')}")
-
-                            result = await self.bot.db.run_race_lottery(
-                                guild_id=guild_id,
-                                race_date=today,
-                                schedule_id=race["id"]
-                            )
+    async def start_race_scheduler(self):
+        async with self._race_lock:
+            await self.trigger_race_daily_process()
 
-                            if not result:
-                                print(f"[RACE ERROR] lottery returned None race_id={race.get('id')}")
-                                continue
+        self.schedule_next_daily()
+        self.race_scheduler.start()
 
-                            selected_entries = result.get("selected", [])
+    async def _on_race_daily(self, key):
+        async with self._race_lock:
+            await self.trigger_race_daily_process()
 
-                            if len(selected_entries) >= 2:
-                                await self.send_race_entry_panel(
-                                    race,
-                                    selected_entries
-                                )
-                            else:
-                                print(f"[RACE WARNING] less than 2 selected race_id={race.get('id')}")
+        # 失敗時はスケジューラーのリトライに任せ、成功したら翌日分を登録
+        self.schedule_next_daily()
 
-                            continue  # 抽選処理終了
+    async def _on_race_deadline(self, phase: str, key):
+        guild_id, schedule_id = key
 
+        race = await self.bot.db.get_race_schedule(schedule_id)
+        if not race:
+            return
 
-                        # =========================
-                        # ② レース確定（開始時刻）
-                        # =========================
-                        if race.get("lottery_done") and not race.get("reward_paid", False):
+        race = dict(race)
+        current = self.next_race_phase(race)
 
-                            if now >= race_dt:
+        if current != phase:
+            # デバッグコマンドなどで状態が変わっていた → 今の状態で登録し直す
+            self.schedule_race(race)
+            return
 
-                                print(f"[RACE START] race_id={race.get('id')}")
+        async with self._race_lock:
+            if phase == "lottery":
+                await self.run_race_lottery_phase(guild_id, race)
+            elif phase == "finalize":
+                await self.run_race_finalize_phase(guild_id, race)
+            else:
+                await self.run_race_result_phase(guild_id, race)
 
-                                await self.bot.db.finalize_race(
-                                    guild_id=guild_id,
-                                    race_date=today,
-                                    schedule_id=race["id"],
-                                    distance=race.get("distance")
-                                )
+        # 進んだら次の締切を登録（同じフェーズのままなら何もしない）
+        fresh = await self.bot.db.get_race_schedule(schedule_id)
+        if fresh and self.next_race_phase(dict(fresh)) != phase:
+            self.schedule_race(dict(fresh))
 
-                        # =========================
-                        # ③ 結果パネル（10分後）
-                        # =========================
-                        if race.get("reward_paid", False) and not race.get("result_sent", False):
+    # =========================
+    # ① 抽選
+    # =========================
+    async def run_race_lottery_phase(self, guild_id: str, race: dict):
+        print(f"[RACE LOTTERY] race_id={race.get('id')}")
 
-                            result_dt = race_dt + timedelta(minutes=10)
+        result = await self.bot.db.run_race_lottery(
+            guild_id=guild_id,
+            race_date=race["race_date"],
+            schedule_id=race["id"]
+        )
+
+        if not result:
+            print(f"[RACE ERROR] lottery returned None race_id={race.get('id')}")
+            return
+
+        selected_entries = result.get("selected", [])
 
-                            if now >= result_dt:
+        if len(selected_entries) >= 2:
+            await self.send_race_entry_panel(
+                race,
+                selected_entries
+            )
+        else:
+            print(f"[RACE WARNING] less than 2 selected race_id={race.get('id')}")
 
-                                print(f"[RACE RESULT SEND] race_id={race.get('id')}")
+    # =========================
+    # ② レース確定（開始時刻）
+    # =========================
+    async def run_race_finalize_phase(self, guild_id: str, race: dict):
+        print(f"[RACE START] race_id={race.get('id')}")
 
-                                results = await self.bot.db._fetch("""
-                                    SELECT re.user_id,
-                                           re.pet_id,
-                                           re.rank,
-                                           re.score,
-                                           p.name,
-                                           p.base_speed,
-                                           p.train_speed,
-                                           p.base_stamina,
-                                           p.train_stamina,
-                                           p.base_power,
-                                           p.train_power,
-                                           p.passive_skill
-                                    FROM race_entries re
-                                    JOIN oasistchi_pets p
-                                      ON p.id = re.pet_id
-                                    WHERE re.schedule_id = $1
-                                      AND re.status = 'selected'
-                                    ORDER BY re.rank ASC
-                                """, race["id"])
+        await self.bot.db.finalize_race(
+            guild_id=guild_id,
+            race_date=race["race_date"],
+            schedule_id=race["id"],
+            distance=race.get("distance")
+        )
 
-                                if not results:
-                                    print(f"[RACE WARNING] no results race_id={race.get('id')}")
-                                    continue
-                                print("RESULTS DEBUG:", results)
+    # =========================
+    # ③ 結果パネル（10分後）
+    # =========================
+    async def run_race_result_phase(self, guild_id: str, race: dict):
+        print(f"[RACE RESULT SEND] race_id={race.get('id')}")
+
+        results = await self.bot.db._fetch("""
+            SELECT re.user_id,
+                   re.pet_id,
+                   re.rank,
+                   re.score,
+                   p.name,
+                   p.base_speed,
+                   p.train_speed,
+                   p.base_stamina,
+                   p.train_stamina,
+                   p.base_power,
+                   p.train_power,
+                   p.passive_skill
+            FROM race_entries re
+            JOIN oasistchi_pets p
+              ON p.id = re.pet_id
+            WHERE re.schedule_id = $1
+              AND re.status = 'selected'
+            ORDER BY re.rank ASC
+        """, race["id"])
+
+        if not results:
+            print(f"[RACE WARNING] no results race_id={race.get('id')}")
+            return
+        print("RESULTS DEBUG:", results)
 
-                                # =========================
-                                # 💰 完全プール式 払い戻し
-                                # =========================
+        # =========================
+        # 💰 完全プール式 払い戻し
+        # =========================
 
 
-                                winner_pet_id = results[0]["pet_id"]
+        winner_pet_id = results[0]["pet_id"]
 
-                                # 総投票額
-                                total_pool_row = await self.bot.db._fetchrow("""
-                                    SELECT SUM(amount) AS total
-                                    FROM race_bets
-                                    WHERE schedule_id = $1
-                                """, race["id"])
+        # 総投票額
+        total_pool_row = await self.bot.db._fetchrow("""
+            SELECT SUM(amount) AS total
+            FROM race_bets
+            WHERE schedule_id = $1
+        """, race["id"])
 
-                                total_pool = (total_pool_row["total"] if total_pool_row else 0) or 0
+        total_pool = (total_pool_row["total"] if total_pool_row else 0) or 0
 
 
-                                # 勝ち馬への総投票額
+        # 勝ち馬への総投票額
 
-                                winner_pool_row = await self.bot.db._fetchrow("""
-                                    SELECT SUM(amount) AS total
-                                    FROM race_bets
-                                    WHERE schedule_id = $1
-                                      AND pet_id = $2
-                                """, race["id"], str(winner_pet_id))
+        winner_pool_row = await self.bot.db._fetchrow("""
+            SELECT SUM(amount) AS total
+            FROM race_bets
+            WHERE schedule_id = $1
+              AND pet_id = $2
+        """, race["id"], str(winner_pet_id))
 
 
-                                winner_pool = (winner_pool_row["total"] if winner_pool_row else 0) or 0
+        winner_pool = (winner_pool_row["total"] if winner_pool_row else 0) or 0
 
-                                print(f"[POOL] total={total_pool} winner_pool={winner_pool}")
+        print(f"[POOL] total={total_pool} winner_pool={winner_pool}")
 
-                                # 払戻原資
-                                payout_pool = total_pool
+        # 払戻原資
+        payout_pool = total_pool
 
-                                if winner_pool > 0:
+        if winner_pool > 0:
 
 
-                                    winning_bets = await self.bot.db._fetch("""
-                                        SELECT user_id, amount
-                                        FROM race_bets
-                                        WHERE schedule_id = $1
-                                          AND pet_id = $2
-                                    """, race["id"], str(winner_pet_id))
+            winning_bets = await self.bot.db._fetch("""
+                SELECT user_id, amount
+                FROM race_bets
+                WHERE schedule_id = $1
+                  AND pet_id = $2
+            """, race["id"], str(winner_pet_id))
 
-                                    for bet in winning_bets:
+            for bet in winning_bets:
 
-                                        payout = int(payout_pool * (bet["amount"] / winner_pool))
+                payout = int(payout_pool * (bet["amount"] / winner_pool))
 
-                                        print(
-                                            f"[PAYOUT] race={race['id']} "
-                                            f"user={bet['user_id']} "
-                                            f"bet={bet['amount']} "
-                                            f"payout={payout}"
-                                        )
+                print(
+                    f"[PAYOUT] race={race['id']} "
+                    f"user={bet['user_id']} "
+                    f"bet={bet['amount']} "
+                    f"payout={payout}"
+                )
 
 
-                                        await self.bot.db.add_balance(
-                                            int(bet["user_id"]),
-                                            int(race["guild_id"]),
-                                            payout
-                                        )
+                await self.bot.db.add_balance(
+                    int(bet["user_id"]),
+                    int(race["guild_id"]),
+                    payout,
+                    reason="race_payout",
+                    ref=race["id"]
+                )
+
+
+                try:
+                    user_obj = await self.bot.fetch_user(int(bet["user_id"]))
+
+
+                    await user_obj.send(
+                        f"🎉 **的中！**\n"
+                        f"🏁 第{race['race_no']}レース\n\n"
+                        f"🎫 購入額：{bet['amount']:,} rrc\n"
+                        f"💰 払戻：{payout:,} rrc"
+                    )
+
+                except Exception as e:
+                    print(f"[PAYOUT DM ERROR] {e!r}")
+
+        else:
+            print(f"[NO WINNERS] race_id={race['id']} winner_pool=0")
+
+
+        # =========================
+        # 🎯 3連単 払い戻し
+        # =========================
+
+        if len(results) >= 3:
 
+            first_id  = results[0]["pet_id"]
+            second_id = results[1]["pet_id"]
+            third_id  = results[2]["pet_id"]
 
-                                        try:
-                                            user_obj = await self.bot.fetch_user(int(bet["user_id"]))
 
 
-                                            await user_obj.send(
-                                                f"🎉 **的中！**\n"
-                                                f"🏁 第{race['race_no']}レース\n\n"
-                                                f"🎫 購入額：{bet['amount']:,} rrc\n"
-                                                f"💰 払戻：{payout:,} rrc"
-                                            )
+            pool_row = await self.bot.db._fetchrow("""
+                SELECT total_pool
+                FROM race_trifecta_pools
+                WHERE schedule_id = $1
+            """, race["id"])
 
-                                        except Exception as e:
-                                            print(f"[PAYOUT DM ERROR] {e!r}")
+            total_tri_pool = pool_row["total_pool"] if pool_row else 0
 
-                                else:
-                                    print(f"[NO WINNERS] race_id={race['id']} winner_pool=0")
 
+            combo_pool = await self.bot.db._fetchval("""
+                SELECT COALESCE(SUM(amount),0)
+                FROM race_trifecta_bets
+                WHERE schedule_id = $1
+                  AND first_pet_id = $2
+                  AND second_pet_id = $3
+                  AND third_pet_id = $4
+            """, race["id"], first_id, second_id, third_id)
 
-                                # =========================
-                                # 🎯 3連単 払い戻し
-                                # =========================
+            print(f"[TRI POOL] total={total_tri_pool} combo={combo_pool}")
 
-                                if len(results) >= 3:
+            if total_tri_pool > 0 and combo_pool > 0:
 
-                                    first_id  = results[0]["pet_id"]
-                                    second_id = results[1]["pet_id"]
-                                    third_id  = results[2]["pet_id"]
+                payout_pool = total_tri_pool
 
+                winning_bets = await self.bot.db._fetch("""
+                    SELECT user_id, amount
+                    FROM race_trifecta_bets
+                    WHERE schedule_id = $1
+                      AND first_pet_id = $2
+                      AND second_pet_id = $3
+                      AND third_pet_id = $4
+                """, race["id"], first_id, second_id, third_id)
 
+                for bet in winning_bets:
 
-                                    pool_row = await self.bot.db._fetchrow("""
-                                        SELECT total_pool
-                                        FROM race_trifecta_pools
-                                        WHERE schedule_id = $1
-                                    """, race["id"])
+                    payout = int(payout_pool * (bet["amount"] / combo_pool))
 
-                                    total_tri_pool = pool_row["total_pool"] if pool_row else 0
+                    print(
+                        f"[TRIFECTA PAYOUT] race={race['id']} "
+                        f"user={bet['user_id']} "
+                        f"bet={bet['amount']} "
+                       f"payout={payout}"
+                    )
 
+                    await self.bot.db.add_balance(
+                        str(bet["user_id"]),
+                        str(race["guild_id"]),
+                        payout,
+                        reason="trifecta_payout",
+                        ref=race["id"]
+                    )
 
-                                    combo_pool = await self.bot.db._fetchval("""
-                                        SELECT COALESCE(SUM(amount),0)
-                                        FROM race_trifecta_bets
-                                        WHERE schedule_id = $1
-                                          AND first_pet_id = $2
-                                          AND second_pet_id = $3
-                                          AND third_pet_id = $4
-                                    """, race["id"], first_id, second_id, third_id)
+                    try:
+                        user_obj = await self.bot.fetch_user(int(bet["user_id"]))
+                        await user_obj.send(
+                            f"🎯 **3連単的中！**\n"
+                            f"🏁 第{race['race_no']}レース\n\n"
+                            f"💰 払戻：{payout:,} rrc"
+                        )
+                    except Exception as e:
+                        print(f"[TRIFECTA DM ERROR] {e!r}")
 
-                                    print(f"[TRI POOL] total={total_tri_pool} combo={combo_pool}")
+                await self.bot.db._execute("""
+                        UPDATE race_trifecta_pools
+                        SET total_pool = 0
+                        WHERE schedule_id = $1
+                    """, race["id"])
 
-                                    if total_tri_pool > 0 and combo_pool > 0:
+            else:
+                print(f"[TRIFECTA NO WINNER] race_id={race['id']}")
 
-                                        payout_pool = total_tri_pool
+                if total_tri_pool > 0:
 
-                                        winning_bets = await self.bot.db._fetch("""
-                                            SELECT user_id, amount
-                                            FROM race_trifecta_bets
-                                            WHERE schedule_id = $1
-                                              AND first_pet_id = $2
-                                              AND second_pet_id = $3
-                                              AND third_pet_id = $4
-                                        """, race["id"], first_id, second_id, third_id)
+                    # 🔥 次レースへcarry加算
+                    await self.bot.db._execute("""
+                        UPDATE race_trifecta_carry
+                        SET carry_over = carry_over + $1
+                        WHERE guild_id = $2
+                    """, total_tri_pool, guild_id)
 
-                                        for bet in winning_bets:
+                    #    今レースのプールをクリア（重要）
+                    await self.bot.db._execute("""
+                        UPDATE race_trifecta_pools
+                        SET total_pool = 0
+                        WHERE schedule_id = $1
+                    """, race["id"])
 
-                                            payout = int(payout_pool * (bet["amount"] / combo_pool))
+                    print(f"[TRIFECTA CARRY ADD] +{total_tri_pool}")
 
-                                            print(
-                                                f"[TRIFECTA PAYOUT] race={race['id']} "
-                                                f"user={bet['user_id']} "
-                                                f"bet={bet['amount']} "
-                                               f"payout={payout}"
-                                            )
-
-                                            await self.bot.db.add_balance(
-                                                str(bet["user_id"]),
-                                                str(race["guild_id"]),
-                                                payout
-                                            )
 
-                                            try:
-                                                user_obj = await self.bot.fetch_user(int(bet["user_id"]))
-                                                await user_obj.send(
-                                                    f"🎯 **3連単的中！**\n"
-                                                    f"🏁 第{race['race_no']}レース\n\n"
-                                                    f"💰 払戻：{payout:,} rrc"
-                                                )
-                                            except Exception as e:
-                                                print(f"[TRIFECTA DM ERROR] {e!r}")
+        # =========================
+        # 結果整形（最終オッズ＋パッシブ付き）
+        # =========================
 
-                                        await self.bot.db._execute("""
-                                                UPDATE race_trifecta_pools
-                                                SET total_pool = 0
-                                                WHERE schedule_id = $1
-                                            """, race["id"])
+        formatted = []
 
-                                    else:
-                                        print(f"[TRIFECTA NO WINNER] race_id={race['id']}")
+        for r in results:
 
-                                        if total_tri_pool > 0:
+            # -------------------------
+            # ステータス合算
+            # -------------------------
+            stats = {
+                "speed": (r["base_speed"] or 0) + (r["train_speed"] or 0),
+                "stamina": (r["base_stamina"] or 0) + (r["train_stamina"] or 0),
+                "power": (r["base_power"] or 0) + (r["train_power"] or 0),
+                "guts": r.get("guts", False),
+            }
 
-                                            # 🔥 次レースへcarry加算
-                                            await self.bot.db._execute("""
-                                                UPDATE race_trifecta_carry
-                                                SET carry_over = carry_over + $1
-                                                WHERE guild_id = $2
-                                            """, total_tri_pool, guild_id)
+            # -------------------------
+            # その馬への総投票額取得
+            # -------------------------
+            pet_pool_row = await self.bot.db._fetchrow("""
+                SELECT SUM(amount) AS total
+                FROM race_bets
+                WHERE schedule_id = $1
+                  AND pet_id = $2
+            """, race["id"], str(r["pet_id"]))
 
-                                            #    今レースのプールをクリア（重要）
-                                            await self.bot.db._execute("""
-                                                UPDATE race_trifecta_pools
-                                                SET total_pool = 0
-                                                WHERE schedule_id = $1
-                                            """, race["id"])
+            pet_pool = (pet_pool_row["total"] if pet_pool_row else 0) or 0
 
-                                            print(f"[TRIFECTA CARRY ADD] +{total_tri_pool}")
+            # -------------------------
+            # 最終オッズ計算
+            # -------------------------
+            if pet_pool > 0:
+                final_odds = round(total_pool / pet_pool, 2)
+            else:
+                final_odds = 0
 
+            formatted.append({
+                "user_id": r["user_id"],
+                "name": r["name"],
+                "score": r["score"],
+                "stats": stats,
+                "final_odds": final_odds,
+                "pet_id": r["pet_id"],
+                "passive_skill": r.get("passive_skill")
+            })
 
-                                # =========================
-                                # 結果整形（最終オッズ＋パッシブ付き）
-                                # =========================
+        await self.send_race_result_embed(race, formatted)
 
-                                formatted = []
+        await self.bot.db._execute("""
+            UPDATE race_schedules
+            SET race_finished = TRUE,
+                result_sent = TRUE
+            WHERE id = $1
+        """, race["id"])
 
-                                for r in results:
+        # Web の表示キャッシュを捨てる（締切表示が変わる）
+        race_cache.bump(race["guild_id"], race["id"])
 
-                                    # -------------------------
-                                    # ステータス合算
-                                    # -------------------------
-                                    stats = {
-                                        "speed": (r["base_speed"] or 0) + (r["train_speed"] or 0),
-                                        "stamina": (r["base_stamina"] or 0) + (r["train_stamina"] or 0),
-                                        "power": (r["base_power"] or 0) + (r["train_power"] or 0),
-                                        "guts": r.get("guts", False),
-                                    }
-
-                                    # -------------------------
-                                    # その馬への総投票額取得
-                                    # -------------------------
-                                    pet_pool_row = await self.bot.db._fetchrow("""
-                                        SELECT SUM(amount) AS total
-                                        FROM race_bets
-                                        WHERE schedule_id = $1
-                                          AND pet_id = $2
-                                    """, race["id"], str(r["pet_id"]))
-
-                                    pet_pool = (pet_pool_row["total"] if pet_pool_row else 0) or 0
-
-                                    # -------------------------
-                                    # 最終オッズ計算
-                                    # -------------------------
-                                    if pet_pool > 0:
-                                        final_odds = round(total_pool / pet_pool, 2)
-                                    else:
-                                        final_odds = 0
-
-                                    formatted.append({
-                                        "user_id": r["user_id"],
-                                        "name": r["name"],
-                                        "score": r["score"],
-                                        "stats": stats,
-                                        "final_odds": final_odds,
-                                        "pet_id": r["pet_id"],
-                                        "passive_skill": r.get("passive_skill")
-                                    })
-
-                                await self.send_race_result_embed(race, formatted)
-
-                                await self.bot.db._execute("""
-                                    UPDATE race_schedules
-                                    SET race_finished = TRUE,
-                                        result_sent = TRUE
-                                    WHERE id = $1
-                                """, race["id"])
-
-
-
-                    except Exception as race_err:
-                        print(f"[RACE LOOP ERROR] race_id={race.get('id')} err={race_err!r}")
-
-                        traceback.print_exc()
-
-                        continue
-
-        except Exception as fatal:
-            print(f"[RACE WATCHER FATAL] {fatal!r}")
 
 
     # =========================
@@ -1832,36 +1860,13 @@ class OasistchiCog(commands.Cog):
         if not self.bot.is_ready():
             return
 
-        db = self.bot.db
-        async with db._lock:
-            pets = await db.get_all_oasistchi_pets()
+        # 全件取得は読むだけなのでロック不要（更新は pet 単位でロックされる）
+        pets = await self.bot.db.get_all_oasistchi_pets()
 
         for pet in pets:
             await self.process_time_tick(pet)
 
 
-    # -----------------------------
-    # レース作成
-    # -----------------------------
-
-    @tasks.loop(minutes=1)
-    async def race_tick(self):
-        print("🔥 race_tick 動いた")
-        print("[RACE TICK] tick")
-
-        async with self._race_lock:
-            try:
-                await self.trigger_race_daily_process()
-            except Exception as e:
-                print(f"[RACE TICK ERROR] {e!r}")
-
-
-    @race_tick.before_loop
-    async def before_race_tick(self):
-        print("[RACE TICK] waiting for ready...")
-        await self.bot.wait_until_ready()
-        print("[RACE TICK] started")
-
 # =========================
 # ボタンView
 # =========================
@@ -3742,7 +3747,7 @@ class ExploreButton(discord.ui.Button):
             text = random.choice(EXPLORE_FLAVOR[reward]).format(name=pet["name"])
 
             if reward > 0:
-                await db.add_balance(uid, gid, reward)
+                await db.add_balance(uid, gid, reward, reason="explore")
             print("D")
 
             await db.set_explore_time(uid, now)
@@ -4255,7 +4260,7 @@ class PaidPetConfirmView(discord.ui.View):
         # -------------------------
         # 課金（ここで1回だけ）
         # -------------------------
-        await db.remove_balance(uid, gid, self.price)
+        await db.remove_balance(uid, gid, self.price, reason="item_purchase")
 
         # -------------------------
         # 処理分岐
@@ -4381,7 +4386,7 @@ class RaceEntryConfirmView(discord.ui.View):
 
         # 参加費処理（ENTRY_FEEが0なら実質ノーダメ）
         if entry_fee > 0:
-            await db.remove_balance(uid, guild_id, entry_fee)
+            await db.remove_balance(uid, guild_id, entry_fee, reason="race_entry")
 
         # ④ 同一おあしすっちの「同日・他レース」エントリーを無効化（pendingだけ潰す）
         # ＝同じペットで別レースに入れようとしたら、後勝ち/前勝ちの仕様をここで作れる
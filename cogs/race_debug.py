@@ -2,6 +2,7 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 from datetime import datetime, timezone, timedelta, date
+from response_cache import race_cache
 
 JST = timezone(timedelta(hours=9))
 
@@ -192,6 +193,86 @@ class RaceDebug(commands.Cog):
 
         await interaction.followup.send(embed=embed, ephemeral=True)
 
+    @app_commands.command(
+        name="race_passive_debug",
+        description="【デバッグ】本日の出走確定馬のパッシブ倍率"
+    )
+    async def race_passive_debug(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+
+        if interaction.user.id != 716667546241335328:
+                return await interaction.followup.send(
+                    "❌ このコマンドは使用できません。",
+                    ephemeral=True
+                )
+
+        race_date = today_jst_date()
+        guild_id = str(interaction.guild.id)
+
+        races = await self.db.get_today_race_schedules(race_date, guild_id)
+
+        if not races:
+            return await interaction.followup.send(
+                "❌ 本日のレースが存在しません。",
+                ephemeral=True
+            )
+
+        embed = discord.Embed(
+            title="🧪 パッシブ倍率（出走確定馬）",
+            description=f"📅 {race_date}",
+            color=discord.Color.blue()
+        )
+
+        for race in races:
+            rows = await self.db.preview_race_passives(guild_id, race_date, race["id"])
+
+            if not rows:
+                continue
+
+            lines = []
+            for r in rows:
+                if not r["has_passive"]:
+                    effect = "なし"
+                else:
+                    effect = (
+                        f"`{r['passive_skill']}` "
+                        f"S×{r['speed']:.2f} St×{r['stamina']:.2f} P×{r['power']:.2f}"
+                    )
+                    if r["chance"]:
+                        effect += f"（{r['chance']:.0%}で発動）"
+
+                lines.append(f"・pet_id `{r['pet_id']}` / <@{r['user_id']}>：{effect}")
+
+            embed.add_field(
+                name=f"第{race['race_no']}レース｜{race.get('distance')}｜{race.get('surface')}",
+                value="\n".join(lines)[:1024],
+                inline=False
+            )
+
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(
+        name="race_stats_rebuild",
+        description="【デバッグ】このサーバーの通算成績（ランキング）を履歴から作り直す"
+    )
+    async def race_stats_rebuild(self, interaction: discord.Interaction):
+        await interaction.response.defer(ephemeral=True)
+
+        if interaction.user.id != 716667546241335328:
+                return await interaction.followup.send(
+                    "❌ このコマンドは使用できません。",
+                    ephemeral=True
+                )
+
+        guild_id = str(interaction.guild.id)
+        rows = await self.db.rebuild_pet_race_stats(guild_id)
+
+        await interaction.followup.send(
+            f"📊 **通算成績を作り直しました**\n"
+            f"・{rows} 行（ペット × 距離）",
+            ephemeral=True
+        )
+
     @app_commands.command(
         name="race_entries_reset",
         description="【デバッグ】本日のレースエントリーを全リセット"
@@ -225,6 +306,14 @@ class RaceDebug(commands.Cog):
               AND guild_id = $2
         """, race_date, guild_id)
 
+        # Web の表示キャッシュも捨てる
+        race_cache.bump(guild_id)
+
+        # 締切スケジュールも作り直す（抽選からやり直し）
+        race_cog = self.bot.get_cog("OasistchiCog")
+        if race_cog:
+            await race_cog.load_race_schedule(race_date)
+
         await interaction.followup.send(
             f"🧹 **本日のレースエントリーをリセットしました**\n"
             f"📅 {race_date}\n"
@@ -129,14 +129,9 @@ class SalaryCog(commands.Cog):
             guild_id = str(guild.id)
 
             # ホテル設定からサブ垢ロールID取得
-            hotel_config = await self.bot.db.conn.fetchrow(
-                "SELECT sub_role FROM hotel_settings WHERE guild_id=$1",
-                guild_id
-            )
-            sub_role_id = hotel_config["sub_role"] if hotel_config else None
+            sub_role_id = await self.bot.db.get_hotel_sub_role(guild_id)
 
-            total_users = 0
-            total_amount = 0
+            deltas = []
 
             for member in guild.members:
                 if member.bot:
@@ -152,9 +147,14 @@ class SalaryCog(commands.Cog):
                         add_amount += salary_map[str(role.id)]
 
                 if add_amount > 0:
-                    await self.bot.db.add_balance(str(member.id), guild_id, add_amount)
-                    total_users += 1
-                    total_amount += add_amount
+                    deltas.append((str(member.id), add_amount))
+
+            # 全員分を1クエリで加算
+            await self.bot.db.apply_balance_deltas(
+                guild_id, deltas, floor=None, reason="salary"
+            )
+            total_users = len(deltas)
+            total_amount = sum(d for _, d in deltas)
 
             # ログ送信
             await log_salary(
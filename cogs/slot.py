@@ -200,7 +200,9 @@ class SlotCog(commands.Cog):
                 ephemeral=True
             )
 
-        await self.bot.db.remove_balance(str(user.id), str(interaction.guild.id), s["fee"])
+        await self.bot.db.remove_balance(
+            str(user.id), str(interaction.guild.id), s["fee"], reason="slot_fee"
+        )
         s["players"][user.id] = {"pool": 0}
 
         try:
@@ -309,7 +311,8 @@ class SlotCog(commands.Cog):
         await self.bot.db.remove_balance(
             str(loser_id),
             str(guild.id),
-            total
+            total,
+            reason="slot_loss"
         )
 
         # ================================
@@ -319,7 +322,8 @@ class SlotCog(commands.Cog):
             await self.bot.db.add_balance(
                 str(uid),
                 str(guild.id),
-                share
+                share,
+                reason="slot_payout"
             )
 
         loser = guild.get_member(loser_id)
@@ -395,7 +399,8 @@ class SlotCog(commands.Cog):
             await self.bot.db.add_balance(
                 str(uid),
                 str(interaction.guild.id),
-                refund
+                refund,
+                reason="slot_refund"
             )
 
         await interaction.channel.send(
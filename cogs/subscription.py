@@ -34,27 +34,12 @@ class SubscriptionCog(commands.Cog):
 
         guild_id = str(interaction.guild.id)
 
-        await self.bot.db.conn.execute("""
-            INSERT INTO subscription_settings (
-                guild_id,
-                standard_role, standard_price,
-                regular_role, regular_price,
-                premium_role, premium_price,
-                log_channel
-            )
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
-            ON CONFLICT (guild_id)
-            DO UPDATE SET
-                standard_role=$2, standard_price=$3,
-                regular_role=$4, regular_price=$5,
-                premium_role=$6, premium_price=$7,
-                log_channel=$8
-        """,
-        guild_id,
-        str(standard_role.id), standard_price,
-        str(regular_role.id), regular_price,
-        str(premium_role.id), premium_price,
-        str(log_channel.id)
+        await self.bot.db.save_subscription_settings(
+            guild_id,
+            str(standard_role.id), standard_price,
+            str(regular_role.id), regular_price,
+            str(premium_role.id), premium_price,
+            str(log_channel.id)
         )
 
         await interaction.response.send_message("🛠 サブスク設定を更新しました！", ephemeral=True)
@@ -72,10 +57,7 @@ class SubscriptionCog(commands.Cog):
 
         guild_id = str(interaction.guild.id)
 
-        config = await self.bot.db.conn.fetchrow(
-            "SELECT * FROM subscription_settings WHERE guild_id=$1",
-            guild_id
-        )
+        config = await self.bot.db.get_subscription_settings(guild_id)
 
         if not config:
             return await interaction.response.send_message("❌ サブスク設定がありません。", ephemeral=True)
@@ -100,9 +82,7 @@ class SubscriptionCog(commands.Cog):
         guild = interaction.guild
         guild_id = str(guild.id)
 
-        config = await self.bot.db.conn.fetchrow(
-            "SELECT * FROM subscription_settings WHERE guild_id=$1", guild_id
-        )
+        config = await self.bot.db.get_subscription_settings(guild_id)
 
         if not config:
             return await interaction.response.send_message("❌ サブスク設定がありません。")
@@ -123,12 +103,20 @@ class SubscriptionCog(commands.Cog):
             if not role:
                 continue
 
+            # プラン単位で残高が足りる人だけ1クエリで一括引き落とし
+            result = await self.bot.db.apply_balance_deltas(
+                guild_id,
+                [(str(m.id), -price) for m in role.members],
+                floor=0,
+                reason="subscription",
+                ref=key
+            )
+            rejected_ids = {user_id for user_id, _, _ in result["rejected"]}
+
             for member in role.members:
-                user = await self.bot.db.get_user(str(member.id), guild_id)
 
                 # 更新可能
-                if user["balance"] >= price:
-                    await self.bot.db.remove_balance(str(member.id), guild_id, price)
+                if str(member.id) not in rejected_ids:
                     success.append(member)
                 else:
                     # 残高不足 → 退会
@@ -180,9 +168,7 @@ class PlanButton(discord.ui.Button):
         guild = interaction.guild
         guild_id = str(guild.id)
 
-        config = await interaction.client.db.conn.fetchrow(
-            "SELECT * FROM subscription_settings WHERE guild_id=$1", guild_id
-        )
+        config = await interaction.client.db.get_subscription_settings(guild_id)
 
         # プラン情報
         if self.plan_key == "standard":
@@ -232,10 +218,7 @@ class ConfirmSubscribeView(discord.ui.View):
         guild_id = str(guild.id)
         role = guild.get_role(int(self.role_id))
 
-        config = await interaction.client.db.conn.fetchrow(
-            "SELECT * FROM subscription_settings WHERE guild_id=$1",
-            guild_id
-        )
+        config = await interaction.client.db.get_subscription_settings(guild_id)
 
         # 多重加入防止
         for rid in [
@@ -258,7 +241,9 @@ class ConfirmSubscribeView(discord.ui.View):
 
         # 加入処理
         await interaction.user.add_roles(role)
-        await interaction.client.db.remove_balance(str(interaction.user.id), guild_id, self.price)
+        await interaction.client.db.remove_balance(
+            str(interaction.user.id), guild_id, self.price, reason="subscription"
+        )
 
         await interaction.response.send_message(
             f"🎉 **{self.plan_name} に加入しました！**",
@@ -283,10 +268,7 @@ class UnsubscribeButton(discord.ui.Button):
         guild = interaction.guild
         guild_id = str(guild.id)
 
-        config = await interaction.client.db.conn.fetchrow(
-            "SELECT * FROM subscription_settings WHERE guild_id=$1",
-            guild_id
-        )
+        config = await interaction.client.db.get_subscription_settings(guild_id)
 
         roles = [
             config["standard_role"],
@@ -7,6 +7,14 @@ import random
 from datetime import datetime, timezone, timedelta, date
 import uuid
 import json
+import contextlib
+
+from db_pool import get_pool, query_stats
+import race_engine
+from race_pools import pool_aggregator
+from response_cache import race_cache
+from migrations import run_migrations
+from migrations.v0007_pet_race_stats import DELETE_STATS, REBUILD_STATS
 
 JST = timezone(timedelta(hours=9))
 
@@ -20,6 +28,13 @@ DISTANCES = ["短距離", "マイル", "中距離", "長距離"]
 SURFACES = ["芝", "ダート"]
 CONDITIONS = ["良", "稍重", "重", "不良"]
 ENTRY_OPEN_MINUTES = 60  # レース開始60分前に締切
+RACE_DURATION_MINUTES = 60  # 発走からレース終了（closed）まで
+
+# レースカレンダー：何日先まで作っておくか / 残りがこれを切ったら作り足す
+RACE_CALENDAR_DAYS = int(os.getenv("RACE_CALENDAR_DAYS", "7"))
+RACE_CALENDAR_MIN_DAYS = 2
+# 番組（距離・馬場・状態）抽選のシード。同じなら同じ番組になる
+RACE_CALENDAR_SEED = os.getenv("RACE_CALENDAR_SEED", "oasistchi-race")
 
 PASSIVE_SKILLS = {
 
@@ -215,11 +230,143 @@ PASSIVE_SKILLS = {
 }
 
 
+# ======================================================
+#   キー単位ロック（行 / ギルド単位で排他）
+# ======================================================
+class KeyedLock:
+    """
+    ("oasistchi_pets", pet_id) や ("users", guild_id, user_id) のような
+    キーごとに asyncio.Lock を割り当てる。
+    ・同じキー同士は従来どおり直列
+    ・別キーは並行して進む
+    ・使われなくなったロックは自動で破棄
+    ・先頭要素（テーブル名）ごとに待ち時間を集計
+    """
+
+    SLOW_WAIT_SEC = 1.0
+
+    def __init__(self):
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        self._users: dict[tuple, int] = {}
+        # name -> {"count", "total_wait", "max_wait"}
+        self._stats: dict[str, dict] = {}
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, *key):
+        key = tuple(str(k) for k in key)
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+
+        started = time.perf_counter()
+        try:
+            async with lock:
+                self._record_wait(key, time.perf_counter() - started)
+                yield
+        finally:
+            self._users[key] -= 1
+            if self._users[key] == 0:
+                del self._users[key]
+                del self._locks[key]
+
+    def _record_wait(self, key: tuple, waited: float):
+        name = key[0] if key else ""
+        s = self._stats.setdefault(
+            name,
+            {"count": 0, "total_wait": 0.0, "max_wait": 0.0}
+        )
+        s["count"] += 1
+        s["total_wait"] += waited
+        s["max_wait"] = max(s["max_wait"], waited)
+
+        if waited >= self.SLOW_WAIT_SEC:
+            print(f"[LOCK WAIT] key={key} waited={waited:.3f}s")
+
+    def stats(self) -> dict:
+        """テーブル名ごとの {count, total_wait, avg_wait, max_wait, held}"""
+        held: dict[str, int] = {}
+        for key in self._locks:
+            held[key[0]] = held.get(key[0], 0) + 1
+
+        return {
+            name: {
+                "count": s["count"],
+                "total_wait": round(s["total_wait"], 6),
+                "avg_wait": round(s["total_wait"] / s["count"], 6) if s["count"] else 0.0,
+                "max_wait": round(s["max_wait"], 6),
+                "held": held.get(name, 0),
+            }
+            for name, s in self._stats.items()
+        }
+
+
+# ======================================================
+#   設定キャッシュ（settings / hotel_settings など低頻度更新テーブル用）
+# ======================================================
+# 他プロセス（Web API など）から更新された場合の保険。0 で無期限
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", "300"))
+
+
+# 3連単オッズ表（全組み合わせ）のキャッシュ秒数。購入時は即破棄
+TRIFECTA_MATRIX_TTL = float(os.getenv("TRIFECTA_MATRIX_TTL", "5"))
+
+# レース確率推定（抽選確定後に1回）のシミュレーション回数
+RACE_PROB_SIMS = int(os.getenv("RACE_PROB_SIMS", "20000"))
+# メモリに残すレース確率の件数（古いものから捨てる）
+RACE_PROB_CACHE_SIZE = 256
+
+
+class ConfigCache:
+    """
+    ("settings",) や ("hotel_settings", guild_id) をキーに読み込み結果を保持する。
+    ・get(key, loader): 無い / 期限切れなら loader() で読み直す
+    ・invalidate(*prefix): 前方一致で破棄（("hotel_settings",) なら全ギルド分）
+    ・読み込み中に invalidate されたら、その結果は保存しない
+    """
+
+    def __init__(self, ttl: float | None = None):
+        self.ttl = ttl or None
+        self._data: dict[tuple, tuple] = {}
+        self._generation = 0
+
+    async def get(self, key: tuple, loader):
+        key = tuple(str(k) for k in key)
+        now = time.monotonic()
+
+        hit = self._data.get(key)
+        if hit is not None and (self.ttl is None or now - hit[1] < self.ttl):
+            return hit[0]
+
+        generation = self._generation
+        value = await loader()
+
+        if generation == self._generation:
+            self._data[key] = (value, now)
+        return value
+
+    def invalidate(self, *prefix):
+        prefix = tuple(str(k) for k in prefix)
+        n = len(prefix)
+        for key in [k for k in self._data if k[:n] == prefix]:
+            del self._data[key]
+        self._generation += 1
+
+
+# Bot と Web API の Database インスタンスで共有（購入側の破棄がどちらにも効くように）
+trifecta_matrix_cache = ConfigCache(TRIFECTA_MATRIX_TTL)
+
+
 class Database:
     def __init__(self):
         self.pool = None
-        self.dsn = os.getenv("DATABASE_URL")
-        self._lock = asyncio.Lock()
+        self._locks = KeyedLock()
+        self._config = ConfigCache(CONFIG_CACHE_TTL)
+        # レース確率 {schedule_id: dict}（確定後は変わらないので TTL なし）
+        self._race_probs = {}
+        # バックグラウンド実行中のタスク（GC で消えないよう参照を持つ）
+        self._bg_tasks = set()
         # バッジJSON
         self.badge_file = os.path.join(
             os.path.dirname(__file__),
@@ -245,1614 +392,645 @@ class Database:
 
     @staticmethod
     def apply_passive_effect(stats: dict, pet: dict, context: dict) -> dict:
-        passive_key = pet.get("passive_skill")
-        passive = PASSIVE_SKILLS.get(passive_key)
+        # 効果の中身は race_engine のスキルコンパイラ（simulate_race と共通）
+        compiled = race_engine.compile_passive(
+            pet.get("passive_skill"),
+            context.get("distance"),
+            context.get("surface")
+        )
 
-        if not passive:
+        if compiled is None:
             return stats
 
-        ptype = passive["type"]
-
-        if ptype == "stat":
-            target = passive["target"]
-            stats[target] *= passive["multiplier"]
-
-        elif ptype == "all":
-            m = passive["multiplier"]
-
-            stats["speed"] *= m
-            stats["stamina"] *= m
-            stats["power"] *= m
+        mult, chance = race_engine.resolve_passive(compiled, context)
 
-        elif ptype == "trade":
-            for k, v in passive["effects"].items():
-                stats[k] *= v
+        if chance and random.random() >= chance:
+            mult = race_engine.NO_EFFECT
 
-        elif ptype == "gate_number":
-            if context.get("gate") == passive["gate"]:
-                m = passive["multiplier"]
-                stats["speed"] *= m
-                stats["stamina"] *= m
-                stats["power"] *= m
+        for key, m in zip(race_engine.STATS, mult):
+            stats[key] = int(stats[key] * m)
 
+        return stats
 
-        elif ptype == "surface":
-            if context.get("surface") == passive["surface"]:
-                m = passive["multiplier"]
-                stats["speed"] *= m
-                stats["stamina"] *= m
-                stats["power"] *= m
-
-
-        elif ptype == "distance":
-            if context.get("distance") == passive["distance"]:
-                m = passive["multiplier"]
-                stats["speed"] *= m
-                stats["stamina"] *= m
-                stats["power"] *= m
-
-
-
-        elif ptype == "same_adult":
-            if context.get("same_adult_exists"):
-                m = passive["multiplier"]
-                stats["speed"] *= m
-                stats["stamina"] *= m
-                stats["power"] *= m
+    def simulate_race(self, entries, race):
+        # 計算本体は race_engine（配列版）。乱数の引き順は従来と同じなので
+        # random.seed を固定すれば以前と同じ着順・スコアになる。
+        return race_engine.simulate_race(entries, race)
 
+    # ------------------------------------------------------
+    #   DB接続
+    # ------------------------------------------------------
+    async def connect(self):
+        if self.pool is None:
+            # Web API と同じプールを使う（サイズは db_pool で環境変数から決定）
+            self.pool = await get_pool()
 
+    async def _ensure_pool(self):
+        if self.pool is None:
+            await self.connect()
 
-        elif ptype == "chance_boost":
-            if random.random() < passive["chance"]:
-                m = passive["multiplier"]
-                stats["speed"] *= m
-                stats["stamina"] *= m
-                stats["power"] *= m
+    # ------------------------------------------------------
+    #   キー単位ロック（Cog 側から使う用）
+    #   例: async with db.lock("race_schedules", guild_id):
+    # ------------------------------------------------------
+    def lock(self, *key):
+        return self._locks(*key)
 
-        elif ptype == "odds_rank":
-            rank = context.get("odds_rank", 1)
-            m = 1 + rank * 0.02
+    def lock_wait_stats(self) -> dict:
+        return self._locks.stats()
 
-            stats["speed"] *= m
-            stats["stamina"] *= m
-            stats["power"] *= m
+    def pool_stats(self) -> dict:
+        """取得待ち時間・使用中数・SQL実行時間（db_pool.InstrumentedPool.stats）"""
+        return self.pool.stats() if self.pool else {}
 
-        stats["speed"] = int(stats["speed"])
-        stats["stamina"] = int(stats["stamina"])
-        stats["power"] = int(stats["power"])
+    def top_queries(self, n: int = 10, order_by: str = "total_ms") -> list[dict]:
+        """SQLテンプレート別の集計上位（db_pool.QueryStats.top）"""
+        return query_stats.top(n, order_by)
 
-        return stats    
+    def recent_slow_queries(self) -> list[dict]:
+        return list(query_stats.slow_log)
 
-    def simulate_race(self, entries, race):
-        DISTANCE_BALANCE = {
-            "短距離": {"speed": 1.4, "power": 0.8, "stamina": 0.5},
-            "マイル": {"speed": 1.2, "power": 1.2, "stamina": 0.8},
-            "中距離": {"speed": 0.9, "power": 1.3, "stamina": 1.3},
-            "長距離": {"speed": 0.6, "power": 1.0, "stamina": 1.6},
-        }
 
-        distance = race["distance"]
-        surface = race["surface"]
+    # ------------------------------------------------------
+    #   初期化（テーブル自動作成）
+    # ------------------------------------------------------
+    async def init_db(self):
+        await self.connect()
 
-        balance = DISTANCE_BALANCE.get(distance)
-        if not balance:
-            raise ValueError(f"不明な距離: {distance}")
+        # テーブル作成・カラム補完は migrations/ で管理
+        # 適用済みならバージョン確認1回で終わる
+        version = await run_migrations(self.pool)
+        print(f"🔧 スキーマバージョン: v{version:04d}")
 
-        results = []
 
-        for e in entries:
+    # ------------------------------------------------------
+    #   ユーザー残高（ギルド別管理）
+    # ------------------------------------------------------
+    async def get_user(self, user_id, guild_id):
+        await self._ensure_pool()
+        user_id = str(user_id)
+        guild_id = str(guild_id)
+        await self._execute("""
+            INSERT INTO users (user_id, guild_id, balance)
+            VALUES ($1, $2, 0)
+            ON CONFLICT (user_id, guild_id) DO NOTHING
+        """, user_id, guild_id)
+        return await self._fetchrow(
+            "SELECT * FROM users WHERE user_id=$1 AND guild_id=$2",
+            user_id, guild_id
+        )
 
-            # =========================
-            # 🔎 同族判定
-            # =========================
-            same_adult_exists = any(
-                other["adult_key"] == e["adult_key"] and other["pet_id"] != e["pet_id"]
-                for other in entries
+    # ------------------------------------------------------
+    #   残高台帳
+    #   users.balance の増減は必ず balance_ledger に1行残す
+    #   （users と台帳は同じステートメントで更新）
+    # ------------------------------------------------------
+    async def apply_balance_delta(self, user_id, guild_id, delta, reason, ref=None, *, conn=None):
+        """残高に delta を加算して台帳に記録する。return: 新残高"""
+        return await self._fetchval("""
+            WITH u AS (
+                INSERT INTO users (user_id, guild_id, balance)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id, guild_id)
+                DO UPDATE SET balance = users.balance + EXCLUDED.balance
+                RETURNING user_id, guild_id, balance
             )
+            INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+            SELECT guild_id, user_id, $3, balance, $4, $5
+            FROM u
+            RETURNING balance_after
+        """, str(user_id), str(guild_id), int(delta), reason,
+            None if ref is None else str(ref), conn=conn)
+
+    async def set_balance(self, user_id, guild_id, amount, reason="admin_set", ref=None):
+        await self._ensure_pool()
+        user_id = str(user_id)
+        guild_id = str(guild_id)
+        async with self._locks("users", guild_id, user_id):
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    current = await conn.fetchval("""
+                        SELECT balance FROM users
+                        WHERE user_id=$1 AND guild_id=$2
+                        FOR UPDATE
+                    """, user_id, guild_id) or 0
 
-            # =========================
-            # 🔥 パッシブ適用
-            # =========================
-            stats = {
-                "speed": e["speed"],
-                "stamina": e["stamina"],
-                "power": e["power"]
-            }
-
-            context = {
-                "gate": e.get("gate"),
-                "surface": surface,
-                "distance": distance,
-                "same_adult_exists": same_adult_exists,
+                    return await self.apply_balance_delta(
+                        user_id, guild_id, amount - current, reason, ref,
+                        conn=conn
+                    )
 
 
-            }
+    async def add_balance(self, user_id, guild_id, amount, reason="adjust", ref=None):
+        await self._ensure_pool()
+        return await self.apply_balance_delta(user_id, guild_id, amount, reason, ref)
 
-            stats = self.apply_passive_effect(stats, e, context)
-            # =========================
-            # 🔥 根性発動判定
-            # =========================
-            happiness = e.get("happiness", 0)
+    async def remove_balance(self, user_id, guild_id, amount, reason="adjust", ref=None):
+        await self._ensure_pool()
+        user_id = str(user_id)
+        guild_id = str(guild_id)
 
-            base_guts_rate = (happiness / 100) * 0.10
+        # 0 未満にはしない（実際に減った額を台帳に記録）
+        return await self._fetchval("""
+            WITH u AS (
+                UPDATE users x
+                SET balance = GREATEST(0, x.balance - $3)
+                FROM (
+                    SELECT user_id, guild_id, balance
+                    FROM users
+                    WHERE user_id=$1 AND guild_id=$2
+                    FOR UPDATE
+                ) old
+                WHERE x.user_id = old.user_id AND x.guild_id = old.guild_id
+                RETURNING x.user_id, x.guild_id, x.balance, old.balance AS old_balance
+            )
+            INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+            SELECT guild_id, user_id, balance - old_balance, balance, $4, $5
+            FROM u
+            RETURNING balance_after
+        """, user_id, guild_id, amount, reason,
+            None if ref is None else str(ref)) or 0
+
+    async def apply_balance_deltas(self, guild_id, deltas, floor=0, reason="adjust", ref=None, *, conn=None):
+        """
+        複数ユーザーの残高を1ステートメントでまとめて増減する（給料・ロール一括処理用）
+        deltas: [(user_id, delta), ...]（同じユーザーが複数回あれば合算）
+        floor : 減算後の残高がこれを下回るユーザーは変更しない（None で無制限）
+        reason: 台帳に記録する理由コード
+        conn  : 呼び出し側のトランザクション内で実行する場合に指定
+        return: {
+            "balances": {user_id: 新残高},
+            "rejected": [(user_id, delta, 現残高), ...]
+        }
+        """
+        await self._ensure_pool()
+        guild_id = str(guild_id)
 
+        merged = {}
+        for user_id, delta in deltas:
+            user_id = str(user_id)
+            merged[user_id] = merged.get(user_id, 0) + int(delta)
 
-            guts_triggered = random.random() < base_guts_rate
+        if not merged:
+            return {"balances": {}, "rejected": []}
 
-            # ① まず基礎スピードを作る
-            base_speed = stats["speed"]
+        # 未登録ユーザーは delta を初期残高として作成
+        # 減算は floor を割らない行だけ更新（行ロック取得後に再評価される）
+        rows = await self._fetch("""
+            WITH d AS (
+                SELECT t.user_id, t.delta
+                FROM unnest($2::text[], $3::bigint[]) AS t(user_id, delta)
+            ),
+            applied AS (
+                INSERT INTO users (user_id, guild_id, balance)
+                SELECT d.user_id, $1, d.delta
+                FROM d
+                WHERE d.delta >= 0
+                   OR $4::bigint IS NULL
+                   OR d.delta >= $4
+                   OR EXISTS (
+                       SELECT 1 FROM users x
+                       WHERE x.user_id = d.user_id AND x.guild_id = $1
+                   )
+                ON CONFLICT (user_id, guild_id)
+                DO UPDATE SET balance = users.balance + EXCLUDED.balance
+                WHERE EXCLUDED.balance >= 0
+                   OR $4::bigint IS NULL
+                   OR users.balance + EXCLUDED.balance >= $4
+                RETURNING user_id, balance
+            ),
+            ledger AS (
+                INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+                SELECT $1, a.user_id, d.delta, a.balance, $5, $6
+                FROM applied a
+                JOIN d ON d.user_id = a.user_id
+            )
+            SELECT
+                d.user_id,
+                d.delta,
+                a.balance AS new_balance,
+                COALESCE(u.balance, 0) AS old_balance
+            FROM d
+            LEFT JOIN applied a ON a.user_id = d.user_id
+            LEFT JOIN users u ON u.user_id = d.user_id AND u.guild_id = $1
+        """, guild_id, list(merged.keys()), list(merged.values()), floor,
+            reason, None if ref is None else str(ref), conn=conn)
+
+        balances = {}
+        rejected = []
+        for r in rows:
+            if r["new_balance"] is None:
+                rejected.append((r["user_id"], r["delta"], r["old_balance"]))
+            else:
+                balances[r["user_id"]] = r["new_balance"]
 
-            # ② 根性補正
-            if guts_triggered:
-                base_speed *= 1.10
+        return {"balances": balances, "rejected": rejected}
 
-            # ③ 距離補正込み能力計算
-            speed = stats["speed"] * balance["speed"] + stats["power"] * balance["power"]
-            stamina = stats["stamina"]
+    async def get_ledger_since(self, ledger_id: int = 0, guild_id=None, limit: int = 10000):
+        """
+        チェックポイント以降の台帳を取得（バックアップ・監査の差分読み出し用）
+        ledger_id: 前回読み終えた台帳ID
+        """
+        await self._ensure_pool()
+        if guild_id is None:
+            return await self._fetch("""
+                SELECT * FROM balance_ledger
+                WHERE id > $1
+                ORDER BY id
+                LIMIT $2
+            """, int(ledger_id), limit)
 
+        return await self._fetch("""
+            SELECT * FROM balance_ledger
+            WHERE id > $1 AND guild_id = $2
+            ORDER BY id
+            LIMIT $3
+        """, int(ledger_id), str(guild_id), limit)
 
-            stamina_loss = 50 * balance["stamina"]
-            stamina_after = stamina - stamina_loss
+    async def compact_balance_ledger(self, keep_days: int = 30) -> int:
+        """
+        keep_days より古い台帳を balance_checkpoints に畳んで削除する
+        return: 畳んだ台帳の件数
+        """
+        await self._ensure_pool()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 畳む範囲は id で固定（実行中に追記された分は次回）
+                upto = await conn.fetchval("""
+                    SELECT MAX(id) FROM balance_ledger
+                    WHERE created_at < NOW() - make_interval(days => $1)
+                """, keep_days)
 
-            if stamina_after <= 0:
-                speed *= 0.6
+                if upto is None:
+                    return 0
 
-            rand_factor = random.uniform(0.95, 1.05)
+                await conn.execute("""
+                    INSERT INTO balance_checkpoints (guild_id, user_id, balance, ledger_id)
+                    SELECT guild_id, user_id, SUM(delta), MAX(id)
+                    FROM balance_ledger
+                    WHERE id <= $1
+                    GROUP BY guild_id, user_id
+                    ON CONFLICT (guild_id, user_id)
+                    DO UPDATE SET
+                        balance = balance_checkpoints.balance + EXCLUDED.balance,
+                        ledger_id = GREATEST(balance_checkpoints.ledger_id, EXCLUDED.ledger_id),
+                        updated_at = NOW()
+                """, upto)
+
+                result = await conn.execute(
+                    "DELETE FROM balance_ledger WHERE id <= $1",
+                    upto
+                )
 
-            final_score = speed * rand_factor
+        return int(result.split()[-1])
 
-            print(
-                f"[RACE] "
-                f"pet={e['pet_id']} "
-                f"skill={e.get('passive_skill')} "
-                f"same={same_adult_exists} "
-                f"| base_speed={e['speed']} "
-                f"after_passive={stats['speed']} "
-                f"| power={stats['power']} "
-                f"| stamina_after={stamina_after:.1f} "
-                f"| rand={rand_factor:.4f} "
-                f"| final={final_score:.2f} "
-                f"| guts={guts_triggered}"
+    async def reconcile_balances(self, fix: bool = True) -> list:
+        """
+        users.balance と「チェックポイント + 台帳合計」を照合する
+        fix=True のときは差分を reason='reconcile' として台帳に記録し、
+        台帳側を users.balance に合わせる（プレイヤーの残高は変えない）
+        return: [(guild_id, user_id, users.balance, 台帳残高), ...]
+        """
+        await self._ensure_pool()
+        rows = await self._fetch("""
+            WITH l AS (
+                SELECT guild_id, user_id, SUM(delta) AS total
+                FROM balance_ledger
+                GROUP BY guild_id, user_id
             )
+            SELECT
+                u.guild_id,
+                u.user_id,
+                u.balance,
+                COALESCE(c.balance, 0) + COALESCE(l.total, 0) AS ledger_balance
+            FROM users u
+            LEFT JOIN balance_checkpoints c
+                   ON c.guild_id = u.guild_id AND c.user_id = u.user_id
+            LEFT JOIN l
+                   ON l.guild_id = u.guild_id AND l.user_id = u.user_id
+            WHERE u.balance <> COALESCE(c.balance, 0) + COALESCE(l.total, 0)
+        """)
 
+        mismatches = [
+            (r["guild_id"], r["user_id"], r["balance"], r["ledger_balance"])
+            for r in rows
+        ]
 
+        if mismatches:
+            print(f"[LEDGER] 残高不一致 {len(mismatches)} 件")
 
-            debug_data = {
-                "base_speed": e["speed"],
-                "after_passive_speed": stats["speed"],
-
-                "base_power": e["power"],
-                "after_passive_power": stats["power"],
-
-                "base_stamina": e["stamina"],
-                "after_passive_stamina": stats["stamina"],
+        if fix and mismatches:
+            await self._execute("""
+                INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason)
+                SELECT g, u, b - l, b, 'reconcile'
+                FROM unnest($1::text[], $2::text[], $3::bigint[], $4::bigint[])
+                     AS t(g, u, b, l)
+            """,
+                [m[0] for m in mismatches],
+                [m[1] for m in mismatches],
+                [m[2] for m in mismatches],
+                [m[3] for m in mismatches],
+            )
 
-                "stamina_after": stamina_after,
+        return mismatches
 
-                "rand": rand_factor,
-                "same_adult": same_adult_exists,
-                "passive": e.get("passive_skill"),
-                "distance": distance,
-                "surface": surface,
-                "guts": guts_triggered,
 
-                "final_score": final_score
-            }
+    async def get_all_balances(self, guild_id):
+        await self._ensure_pool()
+        return await self._fetch(
+            "SELECT * FROM users WHERE guild_id=$1 ORDER BY balance DESC",
+            guild_id
+        )
 
+    # ------------------------------------------------------
+    #   給料ロール関連
+    # ------------------------------------------------------
+    async def set_salary(self, role_id, salary):
+        await self._execute("""
+            INSERT INTO role_salaries (role_id, salary)
+            VALUES ($1, $2)
+            ON CONFLICT (role_id)
+            DO UPDATE SET salary=$2;
+        """, role_id, salary)
 
-            results.append({
-                "pet_id": e["pet_id"],
-                "user_id": e["user_id"],
-                "score": final_score,
-                "debug": debug_data
-            })
+    async def get_salaries(self):
+        return await self._fetch("SELECT * FROM role_salaries")
 
+    # ------------------------------------------------------
+    #   Settings
+    # ------------------------------------------------------
+    async def get_settings(self):
+        await self._ensure_pool()
+        return await self._config.get(
+            ("settings",),
+            lambda: self._fetchrow("SELECT * FROM settings WHERE id = 1")
+        )
 
-        results.sort(key=lambda x: x["score"], reverse=True)
+    async def update_settings(self, **kwargs):
+        columns = []
+        values = []
+        idx = 1
 
-        for i, r in enumerate(results):
-            r["rank"] = i + 1
+        for key, value in kwargs.items():
+            columns.append(f"{key} = ${idx}")
+            values.append(value)
+            idx += 1
 
-        return results
+        sql = f"UPDATE settings SET {', '.join(columns)} WHERE id = 1"
+        await self._execute(sql, *values)
+        self._config.invalidate("settings")
 
     # ------------------------------------------------------
-    #   DB接続
+    #   ホテルチケット管理
     # ------------------------------------------------------
-    async def connect(self):
-        if self.pool is None:
-            self.pool = await asyncpg.create_pool(
-                dsn=self.dsn,
-                min_size=1,
-                max_size=10
+    async def get_tickets(self, user_id, guild_id):
+        row = await self._fetchrow(
+            "SELECT tickets FROM hotel_tickets WHERE user_id=$1 AND guild_id=$2",
+            user_id, guild_id
+        )
+        if not row:
+            # 自動作成
+            await self._execute(
+                "INSERT INTO hotel_tickets (user_id, guild_id, tickets) VALUES ($1, $2, 0)",
+                user_id, guild_id
             )
+            return 0
+        return row["tickets"]
 
-    async def _ensure_pool(self):
-        if self.pool is None:
-            await self.connect()
+    async def add_tickets(self, user_id, guild_id, amount):
+        current = await self.get_tickets(user_id, guild_id)
+        new_amount = current + amount
+        await self._execute(
+            "UPDATE hotel_tickets SET tickets=$1 WHERE user_id=$2 AND guild_id=$3",
+            new_amount, user_id, guild_id
+        )
+        return new_amount
 
+    async def remove_tickets(self, user_id, guild_id, amount):
+        current = await self.get_tickets(user_id, guild_id)
+        new_amount = max(0, current - amount)
+        await self._execute(
+            "UPDATE hotel_tickets SET tickets=$1 WHERE user_id=$2 AND guild_id=$3",
+            new_amount, user_id, guild_id
+        )
+        return new_amount
 
     # ------------------------------------------------------
-    #   初期化（テーブル自動作成）
+    #   ホテルルーム管理
     # ------------------------------------------------------
-    async def init_db(self):
-        await self.connect()
-
-        # Users テーブル（ギルド別通貨管理）
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT NOT NULL,
-                guild_id TEXT NOT NULL,
-                balance INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (user_id, guild_id)
-            );
-        """)
-
-        # 給料ロールテーブル
+    async def save_room(self, channel_id, guild_id, owner_id, expire_at):
         await self._execute("""
-            CREATE TABLE IF NOT EXISTS role_salaries (
-                role_id TEXT PRIMARY KEY,
-                salary INTEGER NOT NULL
-            );
-        """)
+            INSERT INTO hotel_rooms (channel_id, guild_id, owner_id, expire_at)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (channel_id)
+            DO UPDATE SET expire_at=$4;
+        """, channel_id, guild_id, owner_id, expire_at)
 
-        # Settings テーブル（1行固定）
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY,
-                admin_roles TEXT[],         -- 通貨管理ロールID配列
-                currency_unit TEXT,         -- 通貨単位
-                log_pay TEXT,               -- 通貨ログ
-                log_manage TEXT,            -- 管理ログ
-                log_interview TEXT,         -- 面接ログ
-                log_salary TEXT,            -- 給料ログ
-                log_hotel TEXT,             -- ホテルログ
-                log_backup TEXT             -- バックアップ用チャンネル
-            );
-        """)
+    async def delete_room(self, channel_id):
+        await self._execute(
+            "DELETE FROM hotel_rooms WHERE channel_id=$1",
+            channel_id
+        )
 
-        # サブスク設定テーブル
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS subscription_settings (
-                guild_id TEXT PRIMARY KEY,
-                standard_role TEXT,
-                standard_price INTEGER,
-                regular_role TEXT,
-                regular_price INTEGER,
-                premium_role TEXT,
-                premium_price INTEGER,
-                log_channel TEXT
-            );
-        """)
+    async def get_room(self, channel_id):
+        return await self._fetchrow(
+            "SELECT * FROM hotel_rooms WHERE channel_id=$1",
+            channel_id
+        )
+    # ------------------------------------------------------
+    #   バックアップ用スナップショット
+    #   users（残高）と hotel_tickets（チケット）をまとめてJSON化
+    #   どちらもカーソルで SNAPSHOT_CHUNK 行ずつ読む
+    # ------------------------------------------------------
+    SNAPSHOT_CHUNK = 5000
 
-        # 面接設定テーブル
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS interview_settings (
-                guild_id TEXT PRIMARY KEY,
-                interviewer_role TEXT,
-                wait_role TEXT,
-                done_role TEXT,
-                reward_amount INTEGER,
-                log_channel TEXT
-            );
-        """)
-        # -----------------------------------------
-        # 既存 settings テーブルのカラム補完
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'settings';
-        """)
+    async def iter_user_snapshot(self, chunk_size: int | None = None):
+        """
+        ("users" | "tickets", [dict, ...]) を chunk_size 行ずつ返す非同期ジェネレータ。
+        users と tickets は同じ時点のデータ（REPEATABLE READ）。
+        """
+        await self._ensure_pool()
+        chunk_size = chunk_size or self.SNAPSHOT_CHUNK
 
-        existing_cols = {row["column_name"] for row in col_check}
+        queries = [
+            ("users", "SELECT user_id, guild_id, balance FROM users", "balance"),
+            ("tickets", "SELECT user_id, guild_id, tickets FROM hotel_tickets", "tickets"),
+        ]
 
-        ADD_COLUMNS = {
-            "log_pay": "TEXT",
-            "log_manage": "TEXT",
-            "log_interview": "TEXT",
-            "log_salary": "TEXT",
-            "log_hotel": "TEXT",
-            "log_backup": "TEXT",
-            "oasistchi_race_reset_date": "DATE",
-        }
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                for kind, query, value_col in queries:
+                    cur = await conn.cursor(query)
+                    while True:
+                        rows = await cur.fetch(chunk_size)
+                        if not rows:
+                            break
+                        yield kind, [
+                            {
+                                "user_id": str(r["user_id"]),
+                                "guild_id": str(r["guild_id"]),
+                                value_col: int(r[value_col]),
+                            }
+                            for r in rows
+                        ]
 
-        for col, col_type in ADD_COLUMNS.items():
-            if col not in existing_cols:
-                print(f"🛠 settings テーブルに {col} カラムを追加します…")
-                await self._execute(
-                    f"ALTER TABLE settings ADD COLUMN {col} {col_type};"
-                )
-
-        # ホテル設定テーブル
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS hotel_settings (
-                guild_id TEXT PRIMARY KEY,
-                manager_role TEXT,
-                log_channel TEXT,
-                sub_role TEXT,
-                ticket_price_1 INTEGER,
-                ticket_price_10 INTEGER,
-                ticket_price_30 INTEGER
-            );
-        """)
-
-        # ホテルチケット所持テーブル
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS hotel_tickets (
-                user_id TEXT,
-                guild_id TEXT,
-                tickets INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, guild_id)
-            );
-        """)
-
-        # ホテルルーム管理テーブル
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS hotel_rooms (
-                channel_id TEXT PRIMARY KEY,
-                guild_id TEXT,
-                owner_id TEXT,
-                expire_at TIMESTAMP
-            );
-        """)
-        # ==================================================
-        # おあしすっち（OASISTCHI）テーブル
-        # ==================================================
-
-        # ユーザーごとの育成枠
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS oasistchi_users (
-                user_id TEXT PRIMARY KEY,
-                slots INTEGER NOT NULL DEFAULT 1
-            );
-        """)
-
-        # おあしすっち本体
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS oasistchi_pets (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-
-                stage TEXT NOT NULL,              -- egg / adult
-                egg_type TEXT,
-                adult_key TEXT,
-                name TEXT,
-
-                growth REAL DEFAULT 0,
-                hunger INTEGER DEFAULT 100,
-                happiness INTEGER DEFAULT 50,
-                poop BOOLEAN DEFAULT FALSE,
-
-               notified_hatch BOOLEAN DEFAULT FALSE,
-
-                last_pet REAL DEFAULT 0,
-                last_interaction REAL DEFAULT 0,
-                last_tick REAL DEFAULT 0,
-                last_hunger_tick REAL DEFAULT 0,
-                last_unhappy_tick REAL DEFAULT 0,
-
-                notify_pet BOOLEAN DEFAULT FALSE,
-                notify_care BOOLEAN DEFAULT FALSE,
-                notify_food BOOLEAN DEFAULT FALSE,
-
-                training_count INTEGER DEFAULT 0
-            );
-        """)
-        # =========================
-        # レース設定（ギルド別）
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_settings (
-            guild_id TEXT PRIMARY KEY,
-            result_channel_id TEXT
-        );
-        """)
-
-        # ==================================================
-        # おあしすっち：図鑑 / 通知（永続化）
-        # ==================================================
-
-        # 図鑑（成体履歴）
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS oasistchi_dex (
-                user_id TEXT NOT NULL,
-                adult_key TEXT NOT NULL,
-                obtained_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, adult_key)
-            );
-        """)
-
-        # 通知設定
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS oasistchi_notify (
-                user_id TEXT PRIMARY KEY,
-                notify_poop BOOLEAN NOT NULL DEFAULT TRUE,
-                notify_food BOOLEAN NOT NULL DEFAULT TRUE,
-                notify_pet_ready BOOLEAN NOT NULL DEFAULT TRUE
-            );
-        """)
-
-        # 既存DBにカラム補完（すでにテーブルがある場合）
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_notify';
-        """)
-        existing_cols = {row["column_name"] for row in col_check}
-
-        NOTIFY_COLUMNS = {
-            "notify_poop": "BOOLEAN NOT NULL DEFAULT TRUE",
-            "notify_food": "BOOLEAN NOT NULL DEFAULT TRUE",
-            "notify_pet_ready": "BOOLEAN NOT NULL DEFAULT TRUE",
-        }
-        for col, col_type in NOTIFY_COLUMNS.items():
-            if col not in existing_cols:
-                await self._execute(f"ALTER TABLE oasistchi_notify ADD COLUMN {col} {col_type};")
-
-        # -----------------------------------------
-        # settings テーブルに race_result_channel_id を追加
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'settings'
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "race_result_channel_id" not in existing_cols:
-            print("🛠 settings テーブルに race_result_channel_id を追加します")
-            await self._execute("""
-                ALTER TABLE settings
-                ADD COLUMN race_result_channel_id TEXT
-            """)
-            print("✅ race_result_channel_id 追加完了")
-
-        # =========================
-        # レース関連テーブル
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_schedules (
-            id SERIAL PRIMARY KEY,
-            race_no INTEGER NOT NULL,
-            race_time TIME NOT NULL,
-            entry_open_minutes INTEGER NOT NULL,
-            max_entries INTEGER NOT NULL DEFAULT 8,
-            entry_fee INTEGER NOT NULL DEFAULT 50000,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_entries (
-            id SERIAL PRIMARY KEY,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            user_id TEXT NOT NULL,
-            pet_id INTEGER NOT NULL,
-            paid BOOLEAN NOT NULL DEFAULT TRUE,
-            created_at TIMESTAMP DEFAULT NOW(),
-            UNIQUE (race_date, schedule_id, pet_id)
-        );
-        """)
-
-        # =========================
-        # 馬券関連テーブル（パリミュチュエル方式）
-        # =========================
-
-        # 個別馬券
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_bets (
-            id SERIAL PRIMARY KEY,
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            user_id TEXT NOT NULL,
-            pet_id INTEGER NOT NULL,
-            amount INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-        # 🔧 race_bets に race_id カラム補完
-        cols = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_bets';
-        """)
-        existing_cols = {c["column_name"] for c in cols}
-
-        if "race_id" not in existing_cols:
-            print("🛠 race_bets に race_id カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE race_bets
-                ADD COLUMN race_id TEXT;
-            """)
-            print("✅ race_id 追加完了")
-
-
-
-
-        # レースごとの総プール
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_pools (
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            total_pool INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY (guild_id, race_date, schedule_id)
-        );
-        """)
-        # =========================
-        # レース結果テーブル
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_results (
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            pet_id INTEGER NOT NULL,
-            rank INTEGER NOT NULL,
-            final_score DOUBLE PRECISION NOT NULL,
-            PRIMARY KEY (guild_id, race_date, schedule_id, pet_id)
-        );
-        """)
-        # debug カラム補完
-        await self._execute("""
-            ALTER TABLE race_results
-            ADD COLUMN IF NOT EXISTS debug JSONB;
-        """)
-        await self._execute("""
-            ALTER TABLE race_entries
-            ADD COLUMN IF NOT EXISTS debug_json JSONB;
-        """)
-        
-        # 🔥 ペット別プール（重要）
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_pet_pools (
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            pet_id INTEGER NOT NULL,
-            total_amount INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY (guild_id, race_date, schedule_id, pet_id)
-        );
-        """)
-
-        # =========================
-        # 3連単：サーバー単位キャリー
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_trifecta_carry (
-            guild_id TEXT PRIMARY KEY,
-            carry_over BIGINT NOT NULL DEFAULT 0
-        );
-        """)
-
-
-        # =========================
-        # 3連単：総プール（キャリー対応）3.1
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_trifecta_pools (
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            total_pool INTEGER NOT NULL DEFAULT 0,
-            carry_in INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY (guild_id, race_date, schedule_id)
-        );
-        """)
-
-        # =========================
-        # 3連単：組み合わせ別プール3.1
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_trifecta_combo_pools (
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            first_pet_id INTEGER NOT NULL,
-            second_pet_id INTEGER NOT NULL,
-            third_pet_id INTEGER NOT NULL,
-            total_amount INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY (
-                guild_id,
-                race_date,
-                schedule_id,
-                first_pet_id,
-                second_pet_id,
-                third_pet_id
-            )
-        );
-        """)
-
-        # 3連単：ユーザー別ベット3.1
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS race_trifecta_bets (
-            id SERIAL PRIMARY KEY,
-            guild_id TEXT NOT NULL,
-            race_date DATE NOT NULL,
-            schedule_id INTEGER NOT NULL,
-            user_id TEXT NOT NULL,
-            first_pet_id INTEGER NOT NULL,
-            second_pet_id INTEGER NOT NULL,
-            third_pet_id INTEGER NOT NULL,
-            amount INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-
-
-        # =========================
-        # 通知テーブル
-        # =========================
-
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS oasistchi_notify(
-            user_id TEXT PRIMARY KEY,
-            notify_poop BOOLEAN DEFAULT TRUE,
-            notify_food BOOLEAN DEFAULT TRUE,
-            notify_pet_ready BOOLEAN DEFAULT TRUE
-        )
-        """)
-
-
-
-
-        # =========================
-        # ユーザーバッジ
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS user_badges (
-            guild_id TEXT NOT NULL,
-            user_id  TEXT NOT NULL,
-            badge    TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW(),
-            PRIMARY KEY (guild_id, user_id, badge)
-        );
-        """)
-
-        # =========================
-        # 自動自己紹介設定3.14
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS intro_auto_settings(
-            guild_id TEXT PRIMARY KEY,
-            category_ids TEXT,
-            watch_channels TEXT
-        )
-        """) 
-        # =========================
-        # 自己紹介URL
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS intro_urls(
-            guild_id TEXT,
-            user_id TEXT,
-            message_url TEXT,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY(guild_id, user_id)
-        )
-        """)
-
-        # =========================
-        # 探索クールタイム3.19
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS oasistchi_explore (
-            user_id TEXT PRIMARY KEY,
-            last_explore BIGINT
-        )
-        """)
-
-
-
-        # =========================
-        # スタンプカード
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS stamp_cards (
-            guild_id BIGINT,
-            user_id BIGINT,
-            stamps INT DEFAULT 0,
-            last_stamp_date DATE,
-            PRIMARY KEY (guild_id, user_id)
-        )
-        """)
-
-        # ⭐ page カラム追加
-        await self._execute("""
-        DO $$
-        BEGIN
-            IF NOT EXISTS (
-                SELECT 1
-                FROM information_schema.columns
-                WHERE table_name='stamp_cards'
-                AND column_name='page'
-            ) THEN
-                ALTER TABLE stamp_cards ADD COLUMN page INT DEFAULT 1;
-            END IF;
-        END$$;
-        """)
-
-        # ⭐ 既存修正
-        await self._execute("""
-        UPDATE stamp_cards
-        SET page = 1
-        WHERE page IS NULL;
-        """)
-
-        # =========================
-        # 匿名チケット3.24
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS anon_tickets (
-            thread_id BIGINT PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            guild_id BIGINT NOT NULL,
-            closed BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-
-        # =========================
-        # 匿名チケット通し番号
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS anon_ticket_counter (
-            guild_id BIGINT PRIMARY KEY,
-            counter BIGINT DEFAULT 0
-        )
-        """)
-
-        # =========================
-        # 匿名チケット通し番号
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS anon_ticket_counter (
-            guild_id BIGINT PRIMARY KEY,
-            counter BIGINT DEFAULT 0
-        )
-        """)
-
-        # =========================
-        # 匿名相談パネル3.26
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS anon_ticket_panels (
-            panel_id BIGINT PRIMARY KEY,
-            guild_id BIGINT,
-            channel_id BIGINT,
-            title TEXT,
-            body TEXT,
-            first_msg TEXT,
-            role_ids BIGINT[],
-            log_channel_id BIGINT
-        )
-        """)
-
-        # =========================
-        # ロール付与パネル
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS role_panels (
-            message_id BIGINT PRIMARY KEY,
-            guild_id BIGINT,
-            panel_data JSONB
-        )
-        """)
-
-        # =========================
-        # VC転送3.30
-        # =========================
-
-
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS temp_vc_settings (
-            guild_id TEXT NOT NULL,
-            source_vc_id TEXT NOT NULL,
-            max_users INTEGER NOT NULL,
-            names_a TEXT[],
-            names_b TEXT[],
-            name_c TEXT,
-            PRIMARY KEY (guild_id, source_vc_id)
-        )
-        """)
-        
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS temp_created_vcs (
-            guild_id TEXT NOT NULL,
-            channel_id TEXT PRIMARY KEY,
-            source_vc_id TEXT NOT NULL
-        )
-        """)
-
-        # =========================
-        # おあしすっち人気投票4.1
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS oasistchi_popularity_votes (
-            guild_id TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            rank_1 TEXT NOT NULL,
-            rank_2 TEXT NOT NULL,
-            rank_3 TEXT NOT NULL,
-            rank_4 TEXT NOT NULL,
-            rank_5 TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW(),
-            PRIMARY KEY (guild_id, user_id)
-        )
-        """)
-
-        # =========================
-        # 川柳4.8
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS senryu_channels (
-            guild_id TEXT NOT NULL,
-            channel_id TEXT NOT NULL,
-            PRIMARY KEY (guild_id, channel_id)
-        )
-        """)
-
-
-        # =========================
-        # 総選挙4.16
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS sosenkyo_votes (
-            guild_id TEXT NOT NULL,
-            voter_id TEXT NOT NULL,
-            category_no INT NOT NULL,
-            target_user_id TEXT NOT NULL,
-            comment TEXT,
-            updated_at TIMESTAMP DEFAULT NOW(),
-            PRIMARY KEY (guild_id, voter_id, category_no)
-        )
-        """)
-
-
-        # =========================
-        # 参加 / 退出ログ4.20
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS user_join_leave_logs (
-            id SERIAL PRIMARY KEY,
-            guild_id TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            action TEXT NOT NULL, -- join / leave / rejoin
-            roles TEXT,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)          
-
-        # =========================
-        # 📅 イベントカレンダー4.27
-        # =========================
-        await self._execute("""
-        CREATE TABLE IF NOT EXISTS event_calendar (
-            id SERIAL PRIMARY KEY,
-            guild_id TEXT NOT NULL,
-            event_name TEXT NOT NULL,
-            start_date DATE NOT NULL,
-            end_date DATE NOT NULL,
-            created_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-
-
-
-
-        # -----------------------------------------
-        # race_entries に status カラムがなければ追加
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_entries';
-        """)
-        existing_cols = {r["column_name"] for r in col_check}
-
-        if "status" not in existing_cols:
-            print("🛠 race_entries に status カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE race_entries
-                ADD COLUMN status TEXT NOT NULL DEFAULT 'pending';
-            """)
-            print("✅ status カラム追加完了")
-
-        # --------------------------------------------------
-        # おあしすっち：レース用カラム補完
-        # --------------------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        # --------------------------------------------------
-        # おあしすっち：特訓回数カラム補完（★今回の修正点）
-        # --------------------------------------------------
-        if "training_count" not in existing_cols:
-            print("🛠 oasistchi_pets に training_count カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE oasistchi_pets
-                ADD COLUMN training_count INTEGER NOT NULL DEFAULT 0;
-            """)
-
-        ADD_COLUMNS = {
-            "raced_today": "BOOLEAN DEFAULT FALSE",
-            "race_candidate": "BOOLEAN DEFAULT FALSE",
-        }
-
-        for col, col_type in ADD_COLUMNS.items():
-            if col not in existing_cols:
-                print(f"🛠 oasistchi_pets に {col} カラムを追加します…")
-                await self._execute(
-                    f"ALTER TABLE oasistchi_pets ADD COLUMN {col} {col_type};"
-                )
-
-        # settings テーブルに guild_id がなければ追加
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'settings';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "guild_id" not in existing_cols:
-            print("🛠 settings テーブルに guild_id カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE settings
-                ADD COLUMN guild_id TEXT;
-            """)
-
-
-
-
-        # --------------------------------------------------
-        # おあしすっち：ステータス（特訓用）カラム補完
-        # --------------------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        ADD_COLUMNS = {
-            "base_speed": "INTEGER DEFAULT 0",
-            "base_stamina": "INTEGER DEFAULT 0",
-            "base_power": "INTEGER DEFAULT 0",
-            "train_speed": "INTEGER DEFAULT 0",
-            "train_stamina": "INTEGER DEFAULT 0",
-            "train_power": "INTEGER DEFAULT 0",
-        }
-
-        for col, col_type in ADD_COLUMNS.items():
-            if col not in existing_cols:
-                await self._execute(
-                    f"ALTER TABLE oasistchi_pets ADD COLUMN {col} {col_type};"
-                )
-        # --------------------------------------------------
-        # おあしすっち：ステータス用カラム補完
-        # --------------------------------------------------
-        ADD_STATUS_COLUMNS = {
-            "speed": "INTEGER DEFAULT 0",
-            "stamina": "INTEGER DEFAULT 0",
-            "power": "INTEGER DEFAULT 0",
-        }
-
-        for col, col_type in ADD_STATUS_COLUMNS.items():
-            if col not in existing_cols:
-                print(f"🛠 oasistchi_pets に {col} カラムを追加します…")
-                await self._execute(
-                    f"ALTER TABLE oasistchi_pets ADD COLUMN {col} {col_type};"
-                )
-
-        # --------------------------------------------------
-        # おあしすっち：時間管理用カラム補完
-        # --------------------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        TIME_COLUMNS = {
-            "last_poop_tick": "REAL DEFAULT 0",
-            "last_growth_tick": "REAL DEFAULT 0",
-            "last_hunger_tick": "REAL DEFAULT 0",
-            "last_unhappy_tick": "REAL DEFAULT 0",
-        }
-
-        for col, col_type in TIME_COLUMNS.items():
-            if col not in existing_cols:
-                print(f"🛠 oasistchi_pets に {col} カラムを追加します…")
-                await self._execute(
-                    f"ALTER TABLE oasistchi_pets ADD COLUMN {col} {col_type};"
-                )
-
-        # --------------------------------------------------
-        # おあしすっち：通知予定時刻カラム（★再起動耐性）
-        # --------------------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-        existing_cols = {row["column_name"] for row in col_check}
-
-        NOTIFY_TIME_COLUMNS = {
-            "next_poop_check_at": "REAL DEFAULT 0",
-            "poop_notified_at": "REAL DEFAULT 0",
-            "pet_ready_at": "REAL DEFAULT 0",
-            "pet_ready_notified_at": "REAL DEFAULT 0",
-        }
-
-        for col, col_type in NOTIFY_TIME_COLUMNS.items():
-            if col not in existing_cols:
-                print(f"🛠 oasistchi_pets に {col} カラムを追加します…")
-                await self._execute(
-                    f"ALTER TABLE oasistchi_pets ADD COLUMN {col} {col_type};"
-                )
-        # -----------------------------------------
-        # oasistchi_pets カラム補完
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "fixed_adult_key" not in existing_cols:
-            print("🛠 oasistchi_pets に fixed_adult_key カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE oasistchi_pets
-                ADD COLUMN fixed_adult_key TEXT;
-            """)
-            print("✅ fixed_adult_key カラム追加完了")
-
-        # --------------------------------------------------
-        # レース関連カラム補完2.2
-        # --------------------------------------------------
-
-        # race_schedules
-        cols = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules';
-        """)
-        race_schedule_cols = {r["column_name"] for r in cols}
-
-        if "race_finished" not in race_schedule_cols:
-            print("   race_schedules に race_finished を追加します…")
-            await self._execute("""
-                ALTER TABLE race_schedules
-                ADD COLUMN race_finished BOOLEAN DEFAULT FALSE;
-            """)
-            print("✅ race_finished 追加完了")
-
-        # race_entries
-        cols = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_entries';
-        """)
-        race_entry_cols = {r["column_name"] for r in cols}
-
-        if "rank" not in race_entry_cols:
-            print("🛠 race_entries に rank を追加します…")
-            await self._execute("""
-                ALTER TABLE race_entries
-                ADD COLUMN rank INTEGER;
-            """)
-            print("✅ rank 追加完了")
-
-        if "score" not in race_entry_cols:
-            print("🛠 race_entries に score を追加します…")
-            await self._execute("""
-                ALTER TABLE race_entries
-                ADD COLUMN score REAL;
-            """)
-            print("✅ score 追加完了")
-
-
-        
-
-        
-        # -----------------------------------------
-        # race_schedules に lottery_done が無ければ追加
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "lottery_done" not in existing_cols:
-            print("🛠 race_schedules に lottery_done カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE race_schedules
-                ADD COLUMN lottery_done BOOLEAN DEFAULT FALSE;
-            """)
-            print("✅ lottery_done カラム追加完了")
-
-        await self._execute("""
-            UPDATE race_schedules
-            SET lottery_done = FALSE
-            WHERE lottery_done IS NULL;
-        """)
-        # -----------------------------------------
-        # race_schedules に locked が無ければ追加
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "locked" not in existing_cols:
-            print("🛠 race_schedules に locked カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE race_schedules
-                ADD COLUMN locked BOOLEAN DEFAULT FALSE;
-            """)
-            print("✅ locked カラム追加完了")
-
-        # NULL対策（念のため）
-        await self._execute("""
-            UPDATE race_schedules
-            SET locked = FALSE
-            WHERE locked IS NULL;
-        """)
-
-        # -----------------------------------------
-        # race_schedules に reward_paid が無ければ追加
-        # -----------------------------------------
-        if "reward_paid" not in existing_cols:
-            print("🛠 race_schedules に reward_paid カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE race_schedules
-                ADD COLUMN reward_paid BOOLEAN DEFAULT FALSE;
-            """)
-            print("✅ reward_paid カラム追加完了")
-
-        # NULL対策（念のため）
-        await self._execute("""
-            UPDATE race_schedules
-            SET reward_paid = FALSE
-            WHERE reward_paid IS NULL;
-        """)
-
-
-        # -----------------------------------------
-        # race_schedules テーブルに レース用
-        # -----------------------------------------
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules';
-        """)
-
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "race_date" not in existing_cols:
-            print("🛠 race_schedules テーブルに race_date カラムを追加します…")
-            await self._execute("""
-                ALTER TABLE race_schedules
-                ADD COLUMN race_date DATE;
-            """)
-
-            # 既存データがあれば今日の日付を入れる
-            await self._execute("""
-                UPDATE race_schedules
-                SET race_date = CURRENT_DATE
-                WHERE race_date IS NULL;
-            """)
-
-            print("✅ race_date カラム追加完了")
-        # --------------------------------------------------
-        # おあしすっち：通知時刻の正規化（安全版）
-        # --------------------------------------------------
-        now = time.time()
-
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-        cols = {row["column_name"] for row in col_check}
-
-        # 💩 うんち：次回チェック時刻が未設定の個体
-        if "next_poop_check_at" in cols:
-            await self._execute("""
-                UPDATE oasistchi_pets
-                SET next_poop_check_at = $1
-                WHERE next_poop_check_at = 0;
-            """, now + 3600)
-
-        # 🤚 なでなで：last_pet があるのに予定時刻が無い個体
-        if "pet_ready_at" in cols:
-            await self._execute("""
-                UPDATE oasistchi_pets
-                SET pet_ready_at = last_pet + 10800
-                WHERE last_pet > 0 AND pet_ready_at = 0;
-            """)
-        
-
-        col_check = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'oasistchi_pets';
-        """)
-        existing_cols = {row["column_name"] for row in col_check}
-
-        ALERT_COLUMNS = {
-            "poop_alerted": "BOOLEAN NOT NULL DEFAULT FALSE",
-            "hunger_alerted": "BOOLEAN NOT NULL DEFAULT FALSE",
-            "pet_ready_alerted_for": "REAL NOT NULL DEFAULT 0",
-        }
-        for col, col_type in ALERT_COLUMNS.items():
-            if col not in existing_cols:
-                print(f"🛠 oasistchi_pets に {col} カラムを追加します…")
-                await self._execute(f"ALTER TABLE oasistchi_pets ADD COLUMN {col} {col_type};")
-        # 初期設定が無ければ作成
-        exists = await self._execute("""
-            INSERT INTO settings
-                (id, admin_roles, currency_unit,
-                 log_pay, log_manage, log_interview, log_salary, log_hotel, log_backup)
-            VALUES
-                (1, ARRAY[]::TEXT[], 'rrc',
-                 NULL, NULL, NULL, NULL, NULL, NULL)
-            ON CONFLICT (id) DO NOTHING;
-        """)
-
-        print("🔧 Settings 初期化行を作成しました")
-
-        # db.py の init_db() 内、hotel_settings 作成の後あたりに追記
-        col_check = await self._fetch("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_name = 'hotel_settings';
-        """)
-        existing_cols = {row["column_name"] for row in col_check}
-
-        if "category_ids" not in existing_cols:
-            await self._execute("""
-                ALTER TABLE hotel_settings ADD COLUMN category_ids TEXT[];
-            """)
-            await self._execute("""
-                UPDATE hotel_settings SET category_ids = ARRAY[]::TEXT[] WHERE category_ids IS NULL;
-            """)
-
-        # ==================================================
-        #テーブル初期化
-        # ==================================================
-        await self.init_jumbo_tables()
-        await self.ensure_race_schedule_columns()
-        await self.ensure_race_entry_columns()
-        await self.ensure_race_results_columns()
-        await self.ensure_race_schedule_time_text()
-        await self.init_race_tables()
-
-
-    # ------------------------------------------------------
-    #   ユーザー残高（ギルド別管理）
-    # ------------------------------------------------------
-    async def get_user(self, user_id, guild_id):
-        await self._ensure_pool()
-        user_id = str(user_id)
-        guild_id = str(guild_id)
-        await self._execute("""
-            INSERT INTO users (user_id, guild_id, balance)
-            VALUES ($1, $2, 0)
-            ON CONFLICT (user_id, guild_id) DO NOTHING
-        """, user_id, guild_id)
-        return await self._fetchrow(
-            "SELECT * FROM users WHERE user_id=$1 AND guild_id=$2",
-            user_id, guild_id
-        )
-
-    async def set_balance(self, user_id, guild_id, amount):
-        await self._ensure_pool()
-        async with self._lock:
-            await self._execute(
-                """
-                INSERT INTO users (user_id, guild_id, balance)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (user_id, guild_id)
-                DO UPDATE SET balance = $3
-                """,
-                user_id, guild_id, amount
-            )
-
-
-    async def add_balance(self, user_id, guild_id, amount):
-        await self._ensure_pool()
-        user_id = str(user_id)
-        guild_id = str(guild_id)
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval("""
-                INSERT INTO users (user_id, guild_id, balance)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (user_id, guild_id)
-                DO UPDATE SET balance = users.balance + $3
-                RETURNING balance
-            """, user_id, guild_id, amount)
-
-    async def remove_balance(self, user_id, guild_id, amount):
-        await self._ensure_pool()
-        user_id = str(user_id)
-        guild_id = str(guild_id)
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval("""
-                UPDATE users
-                SET balance = GREATEST(0, balance - $3)
-                WHERE user_id=$1 AND guild_id=$2
-                RETURNING balance
-            """, user_id, guild_id, amount) or 0
-
-
-    async def get_all_balances(self, guild_id):
-        await self._ensure_pool()
-        return await self._fetch(
-            "SELECT * FROM users WHERE guild_id=$1 ORDER BY balance DESC",
-            guild_id
-        )
-
-    # ------------------------------------------------------
-    #   給料ロール関連
-    # ------------------------------------------------------
-    async def set_salary(self, role_id, salary):
-        await self._execute("""
-            INSERT INTO role_salaries (role_id, salary)
-            VALUES ($1, $2)
-            ON CONFLICT (role_id)
-            DO UPDATE SET salary=$2;
-        """, role_id, salary)
-
-    async def get_salaries(self):
-        return await self._fetch("SELECT * FROM role_salaries")
-
-    # ------------------------------------------------------
-    #   Settings
-    # ------------------------------------------------------
-    async def get_settings(self):
-        await self._ensure_pool()
-        return await self._fetchrow(
-            "SELECT * FROM settings WHERE id = 1"
-        )
-
-    async def update_settings(self, **kwargs):
-        columns = []
-        values = []
-        idx = 1
-
-        for key, value in kwargs.items():
-            columns.append(f"{key} = ${idx}")
-            values.append(value)
-            idx += 1
-
-        sql = f"UPDATE settings SET {', '.join(columns)} WHERE id = 1"
-        await self._execute(sql, *values)
-
-    # ------------------------------------------------------
-    #   ホテルチケット管理
-    # ------------------------------------------------------
-    async def get_tickets(self, user_id, guild_id):
-        row = await self._fetchrow(
-            "SELECT tickets FROM hotel_tickets WHERE user_id=$1 AND guild_id=$2",
-            user_id, guild_id
-        )
-        if not row:
-            # 自動作成
-            await self._execute(
-                "INSERT INTO hotel_tickets (user_id, guild_id, tickets) VALUES ($1, $2, 0)",
-                user_id, guild_id
-            )
-            return 0
-        return row["tickets"]
-
-    async def add_tickets(self, user_id, guild_id, amount):
-        current = await self.get_tickets(user_id, guild_id)
-        new_amount = current + amount
-        await self._execute(
-            "UPDATE hotel_tickets SET tickets=$1 WHERE user_id=$2 AND guild_id=$3",
-            new_amount, user_id, guild_id
-        )
-        return new_amount
-
-    async def remove_tickets(self, user_id, guild_id, amount):
-        current = await self.get_tickets(user_id, guild_id)
-        new_amount = max(0, current - amount)
-        await self._execute(
-            "UPDATE hotel_tickets SET tickets=$1 WHERE user_id=$2 AND guild_id=$3",
-            new_amount, user_id, guild_id
-        )
-        return new_amount
-
-    # ------------------------------------------------------
-    #   ホテルルーム管理
-    # ------------------------------------------------------
-    async def save_room(self, channel_id, guild_id, owner_id, expire_at):
-        await self._execute("""
-            INSERT INTO hotel_rooms (channel_id, guild_id, owner_id, expire_at)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (channel_id)
-            DO UPDATE SET expire_at=$4;
-        """, channel_id, guild_id, owner_id, expire_at)
-
-    async def delete_room(self, channel_id):
-        await self._execute(
-            "DELETE FROM hotel_rooms WHERE channel_id=$1",
-            channel_id
-        )
-
-    async def get_room(self, channel_id):
-        return await self._fetchrow(
-            "SELECT * FROM hotel_rooms WHERE channel_id=$1",
-            channel_id
-        )
-    # ------------------------------------------------------
-    #   バックアップ用スナップショット
-    #   users（残高）と hotel_tickets（チケット）をまとめてJSON化
-    # ------------------------------------------------------
     async def export_user_snapshot(self) -> dict:
         """全ユーザーの残高・チケットをまとめて取得してJSON用dictで返す"""
 
-        users_rows = await self._fetch(
-            "SELECT user_id, guild_id, balance FROM users"
-        )
-        tickets_rows = await self._fetch(
-            "SELECT user_id, guild_id, tickets FROM hotel_tickets"
-        )
-
-        users = []
-        for r in users_rows:
-            users.append(
-                {
-                    "user_id": str(r["user_id"]),
-                    "guild_id": str(r["guild_id"]),
-                    "balance": int(r["balance"]),
-                }
-            )
-
-        tickets = []
-        for r in tickets_rows:
-            tickets.append(
-                {
-                    "user_id": str(r["user_id"]),
-                    "guild_id": str(r["guild_id"]),
-                    "tickets": int(r["tickets"]),
-                }
-            )
-
-        return {
+        snapshot = {
             "version": 1,
-            "users": users,
-            "tickets": tickets,
+            "users": [],
+            "tickets": [],
         }
+        async for kind, rows in self.iter_user_snapshot():
+            snapshot[kind].extend(rows)
+
+        return snapshot
+
+    async def write_user_snapshot(self, path: str) -> dict:
+        """
+        export_user_snapshot と同じ形式のJSONをファイルへ書き出す。
+        行数が多くてもメモリに全件載せない。
+        return: {"users": 件数, "tickets": 件数}
+        """
+        counts = {"users": 0, "tickets": 0}
+        current = None
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('{"version": 1')
+
+            async for kind, rows in self.iter_user_snapshot():
+                for row in rows:
+                    if kind != current:
+                        if current is not None:
+                            f.write("]")
+                        f.write(f', "{kind}": [')
+                        current = kind
+                    elif counts[kind]:
+                        f.write(", ")
+                    f.write(json.dumps(row, ensure_ascii=False))
+                    counts[kind] += 1
+
+            if current is not None:
+                f.write("]")
+            # 0件だったキーも空配列で出す
+            for kind in ("users", "tickets"):
+                if counts[kind] == 0:
+                    f.write(f', "{kind}": []')
+            f.write("}")
+
+        return counts
 
     # ------------------------------------------------------
     #   スナップショットからの復元
     #   overwrite=True のときは全削除してから上書き
+    #   一時テーブルへ COPY → INSERT ... ON CONFLICT で1トランザクション
     # ------------------------------------------------------
-    async def import_user_snapshot(self, snapshot: dict, overwrite: bool = False):
-        """export_user_snapshot で出力したJSONから復元する"""
-
-        if overwrite:
-            # 全削除してから入れ直す
-            await self._execute("TRUNCATE TABLE users")
-            await self._execute("TRUNCATE TABLE hotel_tickets")
-
-        # users の復元
-        for row in snapshot.get("users", []):
-            user_id = str(row["user_id"])
-            guild_id = str(row["guild_id"])
-            balance = int(row["balance"])
-
-            exists = await self._fetchrow(
-                "SELECT 1 FROM users WHERE user_id=$1 AND guild_id=$2",
-                user_id, guild_id,
-            )
-            if exists:
-                await self._execute(
-                    "UPDATE users SET balance=$1 WHERE user_id=$2 AND guild_id=$3",
-                    balance, user_id, guild_id,
-                )
-            else:
-                await self._execute(
-                    "INSERT INTO users (user_id, guild_id, balance) VALUES ($1, $2, $3)",
-                    user_id, guild_id, balance,
-                )
+    async def import_user_snapshot(self, snapshot: dict, overwrite: bool = False) -> dict:
+        """
+        export_user_snapshot で出力したJSONから復元する
+        return: {"users": 件数, "tickets": 件数}
+        """
+        await self._ensure_pool()
 
-        # hotel_tickets の復元
-        for row in snapshot.get("tickets", []):
-            user_id = str(row["user_id"])
-            guild_id = str(row["guild_id"])
-            tickets = int(row["tickets"])
+        users = [
+            (str(r["user_id"]), str(r["guild_id"]), int(r["balance"]))
+            for r in snapshot.get("users", [])
+        ]
+        tickets = [
+            (str(r["user_id"]), str(r["guild_id"]), int(r["tickets"]))
+            for r in snapshot.get("tickets", [])
+        ]
 
-            exists = await self._fetchrow(
-                "SELECT 1 FROM hotel_tickets WHERE user_id=$1 AND guild_id=$2",
-                user_id, guild_id,
-            )
-            if exists:
-                await self._execute(
-                    "UPDATE hotel_tickets SET tickets=$1 WHERE user_id=$2 AND guild_id=$3",
-                    tickets, user_id, guild_id,
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+
+                if overwrite:
+                    # 全削除してから入れ直す
+                    await conn.execute(
+                        "TRUNCATE TABLE users, balance_ledger, balance_checkpoints, hotel_tickets"
+                    )
+                else:
+                    # 復元中に残高が動くと台帳の差分がずれるので書き込みだけ止める
+                    await conn.execute(
+                        "LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE"
+                    )
+
+                await conn.execute("""
+                    CREATE TEMP TABLE restore_users (
+                        user_id TEXT,
+                        guild_id TEXT,
+                        balance BIGINT
+                    ) ON COMMIT DROP;
+
+                    CREATE TEMP TABLE restore_tickets (
+                        user_id TEXT,
+                        guild_id TEXT,
+                        tickets INTEGER
+                    ) ON COMMIT DROP;
+                """)
+
+                await conn.copy_records_to_table(
+                    "restore_users",
+                    records=users,
+                    columns=["user_id", "guild_id", "balance"]
                 )
-            else:
-                await self._execute(
-                    "INSERT INTO hotel_tickets (user_id, guild_id, tickets) "
-                    "VALUES ($1, $2, $3)",
-                    user_id, guild_id, tickets,
+                await conn.copy_records_to_table(
+                    "restore_tickets",
+                    records=tickets,
+                    columns=["user_id", "guild_id", "tickets"]
                 )
 
+                # users の復元（差分は台帳に restore として残す）
+                # 同じキーが複数あれば後勝ち（ctid 順 = COPY した順）
+                await conn.execute("""
+                    WITH src AS (
+                        SELECT DISTINCT ON (user_id, guild_id)
+                            user_id, guild_id, balance
+                        FROM restore_users
+                        ORDER BY user_id, guild_id, ctid DESC
+                    ),
+                    old AS (
+                        SELECT u.user_id, u.guild_id, u.balance
+                        FROM users u
+                        JOIN src USING (user_id, guild_id)
+                    ),
+                    up AS (
+                        INSERT INTO users (user_id, guild_id, balance)
+                        SELECT user_id, guild_id, balance FROM src
+                        ON CONFLICT (user_id, guild_id)
+                        DO UPDATE SET balance = EXCLUDED.balance
+                        RETURNING user_id, guild_id, balance
+                    )
+                    INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason)
+                    SELECT
+                        up.guild_id,
+                        up.user_id,
+                        up.balance - COALESCE(old.balance, 0),
+                        up.balance,
+                        'restore'
+                    FROM up
+                    LEFT JOIN old USING (user_id, guild_id)
+                    WHERE up.balance <> COALESCE(old.balance, 0)
+                """)
+
+                # hotel_tickets の復元
+                await conn.execute("""
+                    INSERT INTO hotel_tickets (user_id, guild_id, tickets)
+                    SELECT DISTINCT ON (user_id, guild_id)
+                        user_id, guild_id, tickets
+                    FROM restore_tickets
+                    ORDER BY user_id, guild_id, ctid DESC
+                    ON CONFLICT (user_id, guild_id)
+                    DO UPDATE SET tickets = EXCLUDED.tickets
+                """)
+
+        return {"users": len(users), "tickets": len(tickets)}
+
 # ======================================================
 #   年末ジャンボ（JUMBO）機能
 # ======================================================
 
-    # --------------------------------------------------
-    #   テーブル初期化（init_db から呼ばれる想定）
-    # --------------------------------------------------
-    async def init_jumbo_tables(self):
-        await self._ensure_pool()
-
-        # 開催設定
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS jumbo_config (
-                guild_id TEXT PRIMARY KEY,
-                title TEXT NOT NULL,
-                description TEXT NOT NULL,
-                deadline TIMESTAMP NOT NULL,
-                is_open BOOLEAN NOT NULL DEFAULT TRUE,
-                winning_number VARCHAR(6),
-                prize_paid BOOLEAN DEFAULT FALSE,
-                panel_channel_id TEXT,
-                panel_message_id TEXT
-            );
-        """)
-
-        # 購入番号
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS jumbo_entries (
-                guild_id TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                number VARCHAR(6) NOT NULL,
-                PRIMARY KEY (guild_id, number)
-            );
-        """)
-
-        # 当選者
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS jumbo_winners (
-                guild_id TEXT NOT NULL,
-                rank INTEGER NOT NULL,
-                number VARCHAR(6) NOT NULL,
-                user_id TEXT NOT NULL,
-                match_count INTEGER,
-                prize BIGINT DEFAULT 0,
-                PRIMARY KEY (guild_id, rank, number)
-            );
-        """)
-
     # --------------------------------------------------
     #   開催設定
     # --------------------------------------------------
@@ -2134,7 +1312,7 @@ class Database:
     ):
         await self._ensure_pool()
 
-        async with self._lock:
+        async with self._locks("users", guild_id, user_id):
             async with self.pool.acquire() as conn:
                 async with conn.transaction():
 
@@ -2157,13 +1335,9 @@ class Database:
                         raise RuntimeError("残高不足")
 
                     # ② 残高減算
-                    await conn.execute(
-                        """
-                        UPDATE users
-                        SET balance = balance - $1
-                        WHERE user_id=$2 AND guild_id=$3
-                        """,
-                        price, user_id, guild_id
+                    await self.apply_balance_delta(
+                        user_id, guild_id, -price, "egg_purchase", egg_type,
+                        conn=conn
                     )
 
                     # ③ たまご追加
@@ -2266,13 +1440,9 @@ class Database:
                 # -------------------------
                 # 残高減算
                 # -------------------------
-                await conn.execute(
-                    """
-                    UPDATE users
-                    SET balance = balance - $1
-                    WHERE user_id=$2 AND guild_id=$3
-                    """,
-                    price, user_id, guild_id
+                await self.apply_balance_delta(
+                    user_id, guild_id, -price, "egg_purchase", adult["key"],
+                    conn=conn
                 )
 
                 # -------------------------
@@ -2387,13 +1557,9 @@ class Database:
                 # -------------------------
                 # 残高減算
                 # -------------------------
-                await conn.execute(
-                    """
-                    UPDATE users
-                    SET balance = balance - $1
-                    WHERE user_id=$2 AND guild_id=$3
-                    """,
-                    price, user_id, guild_id
+                await self.apply_balance_delta(
+                    user_id, guild_id, -price, "slot_purchase",
+                    conn=conn
                 )
 
                 # -------------------------
@@ -2417,7 +1583,7 @@ class Database:
     # -------------------------------
     async def update_oasistchi_pet(self, pet_id: int, **fields):
         await self._ensure_pool()
-        async with self._lock:
+        async with self._locks("oasistchi_pets", pet_id):
 
             cols = []
             vals = []
@@ -2448,7 +1614,7 @@ class Database:
 
     async def get_oasistchi_pet(self, pet_id: int):
         await self._ensure_pool()
-        async with self._lock:
+        async with self._locks("oasistchi_pets", pet_id):
             return await self._fetchrow(
                 "SELECT * FROM oasistchi_pets WHERE id=$1",
                 pet_id
@@ -2459,7 +1625,7 @@ class Database:
     # -------------------------------
     async def get_oasistchi_owned_adult_keys(self, user_id: str) -> set[str]:
         await self._ensure_pool()
-        async with self._lock:
+        async with self._locks("oasistchi_dex", user_id):
             rows = await self._fetch(
                 "SELECT adult_key FROM oasistchi_dex WHERE user_id=$1",
                 user_id
@@ -2471,7 +1637,7 @@ class Database:
     # -------------------------------
     async def add_oasistchi_dex(self, user_id: str, adult_key: str):
         await self._ensure_pool()
-        async with self._lock:
+        async with self._locks("oasistchi_dex", user_id):
             await self._execute(
                 """
                 INSERT INTO oasistchi_dex (user_id, adult_key)
@@ -2524,7 +1690,7 @@ class Database:
 
     async def delete_oasistchi_pet(self, pet_id: int):
         await self._ensure_pool()
-        async with self._lock:
+        async with self._locks("oasistchi_pets", pet_id):
             await self._execute(
                 "DELETE FROM oasistchi_pets WHERE id=$1",
                 pet_id
@@ -2585,213 +1751,194 @@ class Database:
             ORDER BY race_time
         """, race_date, guild_id)
 
-    async def generate_today_races(self, guild_id: str, race_date: date):
-        cols = await self._fetch("""
-            SELECT column_name, is_nullable
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules'
-            ORDER BY ordinal_position;
-        """)
-        print("[RACE DEBUG] race_schedules columns:")
-        for c in cols:
-            print(f"  {c['column_name']} | nullable={c['is_nullable']}")
-        # 念のため同日分を削除（再生成耐性）
-        await self._execute("""
-            DELETE FROM race_schedules
+    async def get_race_schedules_by_date(self, race_date: date):
+        """全ギルドの指定日レース（スケジューラーの起動時読み込み用）"""
+        return await self._fetch("""
+            SELECT *
+            FROM race_schedules
             WHERE race_date = $1
-              AND guild_id = $2;
-        """, race_date, str(guild_id))
-
-        for i, race_time in enumerate(RACE_TIMES, start=1):
-            await self._execute("""
-                INSERT INTO race_schedules (
-                    guild_id,
-                    race_no,
-                    race_time,
-                    entry_open_minutes,
-                    max_entries,
-                    entry_fee,
-                    created_at,
-                    race_date,
-                    distance,
-                    surface,
-                    condition
-                )
-                VALUES ($1, $2, $3, $4, $5, $6, NOW(), $7, $8, $9, $10);
-            """,
-            str(guild_id),          # ← ★ これが必須
-            i,                      # race_no
-            race_time,
-            ENTRY_OPEN_MINUTES,
-            8,
-            50000,
-            race_date,
-            random.choice(DISTANCES),
-            random.choice(SURFACES),
-            random.choice(CONDITIONS),
-            )
-
-    async def has_today_race_schedules(self, race_date: date, guild_id: str) -> bool:
-        return await self._fetchval("""
-            SELECT EXISTS(
-                SELECT 1
-                FROM race_schedules
-                WHERE race_date = $1
-                  AND guild_id = $2
-            )
-        """, race_date, guild_id)
-
-    # -----------------------------------------
-    # race_schedules テーブル カラム補完
-    # -----------------------------------------
-    async def ensure_race_schedule_columns(self):
-        cols = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules';
-        """)
-        existing = {c["column_name"] for c in cols}
-
-        alter_sqls = []
-
-        if "guild_id" not in existing:
-            alter_sqls.append("ADD COLUMN guild_id TEXT")
-
-        if "race_date" not in existing:
-            alter_sqls.append("ADD COLUMN race_date DATE")
+            ORDER BY guild_id, race_time
+        """, race_date)
 
-        if "distance" not in existing:
-            alter_sqls.append("ADD COLUMN distance TEXT")
+    async def get_race_schedule(self, schedule_id: int):
+        return await self._fetchrow("""
+            SELECT *
+            FROM race_schedules
+            WHERE id = $1
+        """, int(schedule_id))
 
-        if "surface" not in existing:
-            alter_sqls.append("ADD COLUMN surface TEXT")
+    async def generate_today_races(self, guild_id: str, race_date: date):
+        """指定日のレースを作り直す（既存分は削除）"""
+        await self._ensure_pool()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    DELETE FROM race_schedules
+                    WHERE race_date = $1
+                      AND guild_id = $2
+                """, race_date, str(guild_id))
 
-        if "condition" not in existing:
-            alter_sqls.append("ADD COLUMN condition TEXT")
+                await self.generate_race_calendar(
+                    [guild_id], race_date, days=1, conn=conn
+                )
 
-        if "race_finished" not in existing:
-            alter_sqls.append("ADD COLUMN race_finished BOOLEAN DEFAULT FALSE")
+        # 表示キャッシュはコミット後に捨てる
+        race_cache.bump(guild_id)
 
-        if "result_sent" not in existing:
-            alter_sqls.append("ADD COLUMN result_sent BOOLEAN DEFAULT FALSE")
+    # =========================
+    # レースカレンダー（複数日・全ギルド一括）
+    # =========================
+    @staticmethod
+    def build_race_calendar(guild_ids, start_date: date, days: int, seed=None) -> list:
+        """
+        (guild_id, 日付) ごとのレース一覧を作る。
+        距離・馬場・状態の抽選は seed + guild_id + 日付 から決まるので、
+        同じ seed なら何度作っても同じ番組になる。
+        return: [(guild_id, race_no, race_time, race_date, distance, surface, condition), ...]
+        """
+        seed = RACE_CALENDAR_SEED if seed is None else seed
+        rows = []
 
-        if alter_sqls:
-            sql = "ALTER TABLE race_schedules " + ", ".join(alter_sqls) + ";"
-            print("🛠 race_schedules カラム補完:", sql)
-            await self._execute(sql)
+        for guild_id in guild_ids:
+            guild_id = str(guild_id)
 
-    # -----------------------------------------
-    # race_entries テーブル カラム補完
-    # -----------------------------------------
-    async def ensure_race_entry_columns(self):
-        cols = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_entries';
-        """)
-        existing = {c["column_name"] for c in cols}
+            for offset in range(days):
+                race_date = start_date + timedelta(days=offset)
+                rng = random.Random(f"{seed}:{guild_id}:{race_date.isoformat()}")
 
-        alter_sqls = []
+                for race_no, race_time in enumerate(RACE_TIMES, start=1):
+                    rows.append((
+                        guild_id,
+                        race_no,
+                        race_time,
+                        race_date,
+                        rng.choice(DISTANCES),
+                        rng.choice(SURFACES),
+                        rng.choice(CONDITIONS),
+                    ))
 
-        if "guild_id" not in existing:
-            alter_sqls.append("ADD COLUMN guild_id TEXT")
+        return rows
 
-        if "entry_fee" not in existing:
-            alter_sqls.append("ADD COLUMN entry_fee INTEGER DEFAULT 50000")
+    async def generate_race_calendar(
+        self,
+        guild_ids,
+        start_date: date,
+        days: int = None,
+        seed=None,
+        *,
+        conn=None
+    ) -> int:
+        """
+        start_date から days 日分のレースを全ギルド分まとめて1文で作成。
+        すでにレースがある (guild_id, 日付) はそのまま（作り直さない）。
+        return: 作成したレース数
+        """
+        await self._ensure_pool()
+        days = days or RACE_CALENDAR_DAYS
 
-        if alter_sqls:
-            sql = "ALTER TABLE race_entries " + ", ".join(alter_sqls) + ";"
-            print("🛠 race_entries カラム補完:", sql)
-            await self._execute(sql)
+        rows = self.build_race_calendar(guild_ids, start_date, days, seed)
+        if not rows:
+            return 0
 
-    # -----------------------------------------
-    # race_results テーブル カラム補完（救済版）
-    # -----------------------------------------
-    async def ensure_race_results_columns(self):
-        cols = await self._fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = 'race_results';
-        """)
-        existing = {c["column_name"] for c in cols}
+        cols = list(zip(*rows))
 
-        # まず不足カラムを追加
-        if "guild_id" not in existing:
-            print("🛠 race_results に guild_id を追加します…")
-            await self._execute("ALTER TABLE race_results ADD COLUMN guild_id TEXT;")
+        result = await self._execute("""
+            WITH c AS (
+                SELECT *
+                FROM unnest(
+                    $1::text[], $2::int[], $3::text[], $4::date[],
+                    $5::text[], $6::text[], $7::text[]
+                ) AS t(guild_id, race_no, race_time, race_date, distance, surface, condition)
+            )
+            INSERT INTO race_schedules (
+                guild_id,
+                race_no,
+                race_time,
+                entry_open_minutes,
+                max_entries,
+                entry_fee,
+                created_at,
+                race_date,
+                distance,
+                surface,
+                condition
+            )
+            SELECT
+                c.guild_id,
+                c.race_no,
+                c.race_time,
+                $8,
+                8,
+                50000,
+                NOW(),
+                c.race_date,
+                c.distance,
+                c.surface,
+                c.condition
+            FROM c
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM race_schedules s
+                WHERE s.guild_id = c.guild_id
+                  AND s.race_date = c.race_date
+            )
+        """,
+            list(cols[0]),
+            list(cols[1]),
+            list(cols[2]),
+            list(cols[3]),
+            list(cols[4]),
+            list(cols[5]),
+            list(cols[6]),
+            ENTRY_OPEN_MINUTES,
+            conn=conn
+        )
 
-        if "race_date" not in existing:
-            print("🛠 race_results に race_date を追加します…")
-            await self._execute("ALTER TABLE race_results ADD COLUMN race_date DATE;")
+        # 表示キャッシュを捨てる（最新レースが変わる）
+        for guild_id in {r[0] for r in rows}:
+            race_cache.bump(guild_id)
 
-        if "schedule_id" not in existing:
-            print("🛠 race_results に schedule_id を追加します…")
-            await self._execute("ALTER TABLE race_results ADD COLUMN schedule_id INTEGER;")
+        # "INSERT 0 <件数>"
+        return int(result.split()[-1])
 
-        if "pet_id" not in existing:
-            print("🛠 race_results に pet_id を追加します…")
-            await self._execute("ALTER TABLE race_results ADD COLUMN pet_id INTEGER;")
+    async def ensure_race_calendar(self, guild_ids, today: date) -> int:
+        """
+        全ギルドで今日から RACE_CALENDAR_MIN_DAYS 日分のレースがあれば何もしない（読むだけ）。
+        足りなければ RACE_CALENDAR_DAYS 日分をまとめて作る。
+        return: 作成したレース数
+        """
+        guild_ids = [str(g) for g in guild_ids]
+        if not guild_ids:
+            return 0
 
-        if "rank" not in existing:
-            print("🛠 race_results に rank を追加します…")
-            await self._execute("ALTER TABLE race_results ADD COLUMN rank INTEGER;")
+        min_days = min(RACE_CALENDAR_MIN_DAYS, RACE_CALENDAR_DAYS)
 
-        if "final_score" not in existing:
-            print("   race_results に final_score を追加します…")
-            await self._execute("ALTER TABLE race_results ADD COLUMN final_score DOUBLE PRECISION;")
+        covered = await self._fetchval("""
+            SELECT COUNT(*)
+            FROM (
+                SELECT DISTINCT guild_id, race_date
+                FROM race_schedules
+                WHERE guild_id = ANY($1::text[])
+                  AND race_date >= $2
+                  AND race_date < $2 + $3::int
+            ) s
+        """, guild_ids, today, min_days)
 
-        if "user_id" not in existing:
-            print("🛠 race_results に user_id を追加します…")
-            await self._execute(
-                "ALTER TABLE race_results ADD COLUMN user_id TEXT;"
-            )
+        if covered >= len(guild_ids) * min_days:
+            return 0
 
-        if "position" not in existing:
-            print("🛠 race_results に position を追加します…")
-            await self._execute(
-                "ALTER TABLE race_results ADD COLUMN position INTEGER;"
-            )
+        return await self.generate_race_calendar(guild_ids, today)
 
-        if "reward" not in existing:
-            print("🛠 race_results に reward を追加します…")
-            await self._execute(
-                "ALTER TABLE race_results ADD COLUMN reward INTEGER DEFAULT 0;"
+    async def has_today_race_schedules(self, race_date: date, guild_id: str) -> bool:
+        return await self._fetchval("""
+            SELECT EXISTS(
+                SELECT 1
+                FROM race_schedules
+                WHERE race_date = $1
+                  AND guild_id = $2
             )
+        """, race_date, guild_id)
 
-        # guild_id の既存データ補完（あっても害なし）
-        try:
-            await self._execute("""
-                UPDATE race_results rr
-                SET guild_id = rs.guild_id
-                FROM race_schedules rs
-                WHERE rr.schedule_id = rs.id
-                  AND rr.race_date   = rs.race_date
-                  AND (rr.guild_id IS NULL OR rr.guild_id = '');
-            """)
-        except Exception as e:
-            print(f"[RACE MIGRATE WARNING] {e!r}")
-
-        print("✅ race_results カラム補完完了")
-
-            
-    # -----------------------------------------
-    # 型修正用の補完
-    # -----------------------------------------
-    async def ensure_race_schedule_time_text(self):
-        col = await self._fetchrow("""
-            SELECT data_type
-            FROM information_schema.columns
-            WHERE table_name = 'race_schedules'
-              AND column_name = 'race_time';
-        """)
-
-        if col and col["data_type"] != "text":
-            print("🛠 race_schedules.race_time を TEXT に変更します")
-            await self._execute("""
-                ALTER TABLE race_schedules
-                ALTER COLUMN race_time TYPE TEXT
-                USING race_time::text;
-            """)
     # -----------------------------------------
     # レース関係関数
     # -----------------------------------------
@@ -2833,7 +1980,7 @@ class Database:
     # 返金
     # -----------------------------------------
     async def refund_entry(self, user_id: str, guild_id: str, amount: int):
-        await self.add_balance(user_id, guild_id, amount)
+        await self.add_balance(user_id, guild_id, amount, reason="race_refund")
     # -----------------------------------------
     # 同日・他レースエントリー無効化
     # -----------------------------------------
@@ -2967,13 +2114,17 @@ class Database:
     # 抽選済みフラグ
     # =====================================================
     async def mark_race_lottery_done(self, race_id: int):
-        await self._execute("""
+        guild_id = await self._fetchval("""
             UPDATE race_schedules
             SET lottery_done = TRUE,
                 locked = TRUE
             WHERE id = $1
+            RETURNING guild_id
         """, race_id)
 
+        if guild_id is not None:
+            race_cache.bump(guild_id, race_id)
+
 
     # =====================================================
     # かぶりなしたまご
@@ -3058,25 +2209,33 @@ class Database:
         rank: int,
         score: float
     ):
-        await self._execute("""
+        guild_id = await self._fetchval("""
             UPDATE race_entries
             SET rank = $1,
                 score = $2
             WHERE schedule_id = $3
               AND pet_id = $4
+            RETURNING guild_id
         """, rank, score, schedule_id, pet_id)
 
+        if guild_id is not None:
+            race_cache.bump(guild_id, schedule_id)
+
     # --------------------------------------------------
     # レース完了
     # --------------------------------------------------
     async def mark_race_finished(self, race_id: int):
         await self._ensure_pool()
-        await self._execute("""
+        guild_id = await self._fetchval("""
             UPDATE race_schedules
             SET race_finished = TRUE
             WHERE id = $1
+            RETURNING guild_id
         """, race_id)
 
+        if guild_id is not None:
+            race_cache.bump(guild_id, race_id)
+
     # --------------------------------------------------
     # 未完了レース取得（日付）
     # --------------------------------------------------
@@ -3114,49 +2273,6 @@ class Database:
         """, race_id, status)
 
 
-    # ======================================================
-    #   レースWeb機能（おあしすっち）※衝突回避版
-    # ======================================================
-    async def init_race_tables(self):
-        await self._ensure_pool()
-
-        # ★ race_schedules / race_entries（抽選用）と衝突するので別名にする
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS web_races (
-                race_id TEXT PRIMARY KEY,
-                guild_id TEXT NOT NULL,
-                race_time TIMESTAMP NOT NULL,
-                status TEXT NOT NULL,
-                result_channel_id TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS web_race_entries (
-                race_id TEXT NOT NULL,
-                pet_id TEXT NOT NULL,
-                owner_id TEXT NOT NULL,
-                pet_key TEXT NOT NULL,
-                condition TEXT NOT NULL,
-                speed INTEGER NOT NULL,
-                power INTEGER NOT NULL,
-                stamina INTEGER NOT NULL,
-                odds REAL NOT NULL,
-                PRIMARY KEY (race_id, pet_id)
-            );
-        """)
-
-        await self._execute("""
-            CREATE TABLE IF NOT EXISTS web_race_bets (
-                race_id TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                pet_id TEXT NOT NULL,
-                amount INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        
     # --------------------------------------------------
     # API用：出走馬（selected）を oasistchi_pets とJOINして返す
     # speed/power/stamina は「base + train」を優先して0を回避
@@ -3217,10 +2333,26 @@ class Database:
         self,
         guild_id: str,
         race_date: date,
-        schedule_id: int
+        schedule_id: int,
+        seed: int | None = None
     ):
+        """
+        pending から出走馬を抽選（同ユーザー1頭・最大8頭）。
+        seed: 抽選の乱数シード。省略時は新しく作り race_schedules.lottery_seed に記録
+              （同じシードと pending 一覧で結果を再現できる）
+        return: {
+            "selected":  当選エントリー（抽選順 = 枠順）,
+            "cancelled": 落選エントリー（返金候補。entry_fee / paid を含む）,
+            "seed":      使ったシード
+        }
+        """
         await self._ensure_pool()
 
+        if seed is None:
+            seed = random.randrange(2 ** 63)
+
+        rng = random.Random(seed)
+
         async with self.pool.acquire() as conn:
             async with conn.transaction():
 
@@ -3236,22 +2368,22 @@ class Database:
                 """, schedule_id)
 
                 if not race:
-                    return {"selected": [], "cancelled": []}
+                    return {"selected": [], "cancelled": [], "seed": seed}
 
                 # pending取得（同じconn）
                 entries = await conn.fetch("""
-                    SELECT *
+                    SELECT id, user_id
                     FROM race_entries
                     WHERE guild_id = $1
                       AND race_date = $2
                       AND schedule_id = $3
                       AND status = 'pending'
-                    ORDER BY created_at
+                    ORDER BY created_at, id
                 """, str(guild_id), race_date, schedule_id)
 
 
                 if len(entries) < 2:
-                    return {"selected": [], "cancelled": []}
+                    return {"selected": [], "cancelled": [], "seed": seed}
 
                 # =========================
                 # 同ユーザー1頭制限
@@ -3260,71 +2392,274 @@ class Database:
                 user_map = {}
 
                 for e in entries:
-                    uid = e["user_id"]
-                    user_map.setdefault(uid, []).append(e)
+                    user_map.setdefault(e["user_id"], []).append(e["id"])
 
-                filtered = []
-
-                for uid, pets in user_map.items():
-                    filtered.append(random.choice(pets))
+                filtered = [rng.choice(ids) for ids in user_map.values()]
 
                 # =========================
                 # 抽選
                 # =========================
 
-                max_entries = min(8, len(filtered))
-                selected = random.sample(filtered, max_entries)
+                max_entries = min(8, len(filtered))
+                selected_ids = rng.sample(filtered, max_entries)
+
+                # =========================
+                # 当落を1文で反映（落選分は返金候補としてそのまま返す）
+                # =========================
+                rows = await conn.fetch("""
+                    WITH drawn AS (
+                        UPDATE race_entries
+                        SET status = CASE
+                            WHEN id = ANY($2::int[]) THEN 'selected'
+                            ELSE 'cancelled'
+                        END
+                        WHERE id = ANY($3::int[])
+                        RETURNING *
+                    ),
+                    locked AS (
+                        UPDATE race_schedules
+                        SET lottery_done = TRUE,
+                            locked = TRUE,
+                            lottery_seed = $4
+                        WHERE id = $1
+                    )
+                    SELECT * FROM drawn
+                """,
+                    schedule_id,
+                    selected_ids,
+                    [e["id"] for e in entries],
+                    seed
+                )
+
+                by_id = {r["id"]: r for r in rows}
+                selected = [by_id[i] for i in selected_ids]
+                cancelled = [r for r in rows if r["status"] == "cancelled"]
+
+        print(
+            f"[RACE LOTTERY] race_id={schedule_id} seed={seed} "
+            f"pending={len(entries)} selected={len(selected)} cancelled={len(cancelled)}"
+        )
+
+        # コミット後に勝率推定（出走馬が確定してから）
+        self.schedule_race_probabilities(guild_id, race_date, schedule_id)
+        race_cache.bump(guild_id, schedule_id)
+
+        # 締切時点の単勝プールを DB と突き合わせ
+        await pool_aggregator.verify(self, guild_id, race_date, schedule_id)
+
+        return {
+            "selected": selected,
+            "cancelled": cancelled,
+            "seed": seed
+        }
+
+    # =========================
+    # 出走馬（シミュレーター入力）取得
+    # =========================
+    async def _fetch_race_runners(self, conn, guild_id, race_date, schedule_id):
+        rows = await conn.fetch("""
+            SELECT
+                e.user_id,
+                e.pet_id,
+                -- race_entries に枠番カラムは無い（finalize_race と同じく None）
+                NULL::INTEGER AS gate,
+                p.passive_skill,
+                p.adult_key,
+                COALESCE(p.base_speed, 0) + COALESCE(p.train_speed, 0) AS speed,
+                COALESCE(p.base_power, 0) + COALESCE(p.train_power, 0) AS power,
+                COALESCE(p.base_stamina, 0) + COALESCE(p.train_stamina, 0) AS stamina
+            FROM race_entries e
+            LEFT JOIN oasistchi_pets p ON p.id = e.pet_id
+            WHERE e.guild_id = $1
+              AND e.race_date = $2
+              AND e.schedule_id = $3
+              AND e.status = 'selected'
+            ORDER BY e.created_at, e.id
+        """, str(guild_id), race_date, schedule_id)
+
+        return [dict(r) for r in rows]
+
+    async def preview_race_passives(self, guild_id, race_date, schedule_id):
+        """出走確定馬のパッシブ倍率（デバッグ表示用）"""
+        await self._ensure_pool()
+
+        async with self.pool.acquire() as conn:
+            race = await conn.fetchrow("""
+                SELECT distance, surface
+                FROM race_schedules
+                WHERE id = $1
+            """, schedule_id)
+
+            if not race or race["distance"] not in race_engine.DISTANCE_BALANCE:
+                return []
+
+            entries = await self._fetch_race_runners(
+                conn, guild_id, race_date, schedule_id
+            )
+
+        field = race_engine.RaceField(entries, race)
+
+        return [
+            {**p, "user_id": e["user_id"], "passive_skill": e["passive_skill"]}
+            for e, p in zip(entries, field.passive_preview())
+        ]
+
+    # =========================
+    # 勝率推定（Monte Carlo）
+    # =========================
+    def schedule_race_probabilities(self, guild_id, race_date, schedule_id):
+        """estimate_race_probabilities をバックグラウンドで実行"""
+        async def runner():
+            try:
+                await self.estimate_race_probabilities(guild_id, race_date, schedule_id)
+            except Exception as e:
+                print(f"[RACE PROB ERROR] race_id={schedule_id} err={e!r}")
+
+        task = asyncio.create_task(runner())
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+
+    async def estimate_race_probabilities(
+        self,
+        guild_id,
+        race_date,
+        schedule_id: int,
+        n_sims: int | None = None,
+        seed: int | None = None
+    ):
+        """
+        出走確定済みレースを n_sims 回シミュレーションし、
+        単勝・複勝（3着以内）・3連単の確率を race_probabilities に保存する。
+        seed 省略時は schedule_id（同じレースなら再計算しても同じ値）。
+        """
+        await self._ensure_pool()
+
+        n_sims = n_sims or RACE_PROB_SIMS
+        seed = schedule_id if seed is None else seed
 
-                selected_users = {e["user_id"] for e in selected}
-                selected_entry_ids = {e["id"] for e in selected}
+        async with self.pool.acquire() as conn:
+            race = await conn.fetchrow("""
+                SELECT distance, surface
+                FROM race_schedules
+                WHERE id = $1
+            """, schedule_id)
 
-                cancelled = []
+            if not race:
+                return None
 
-                for e in entries:
+            entries = await self._fetch_race_runners(
+                conn, guild_id, race_date, schedule_id
+            )
 
-                    if e["id"] in selected_entry_ids:
-                        status = "selected"
+        if len(entries) < 2:
+            return None
 
-                    elif e["user_id"] in selected_users:
-                        # 同ユーザー他ペット
-                        status = "cancelled"
+        # CPU 処理はイベントループを止めないよう別スレッドで
+        probs = await asyncio.to_thread(
+            race_engine.estimate_probabilities,
+            entries, dict(race), n_sims, seed
+        )
 
-                    else:
-                        status = "cancelled"
+        await self._execute("""
+            INSERT INTO race_probabilities
+            (schedule_id, guild_id, race_date, n_sims, seed, win, top3, trifecta)
+            VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7::jsonb, $8::jsonb)
+            ON CONFLICT (schedule_id)
+            DO UPDATE SET
+                n_sims = EXCLUDED.n_sims,
+                seed = EXCLUDED.seed,
+                win = EXCLUDED.win,
+                top3 = EXCLUDED.top3,
+                trifecta = EXCLUDED.trifecta,
+                created_at = NOW()
+        """,
+            schedule_id,
+            str(guild_id),
+            race_date,
+            n_sims,
+            seed,
+            json.dumps(probs["win"]),
+            json.dumps(probs["top3"]),
+            json.dumps(probs["trifecta"])
+        )
 
-                    await conn.execute("""
-                        UPDATE race_entries
-                        SET status = $1
-                        WHERE id = $2
-                    """, status, e["id"])
+        data = {
+            "guild_id": str(guild_id),
+            "n_sims": n_sims,
+            "seed": seed,
+            **self._probs_keys_to_int(probs)
+        }
+        self._remember_race_probs(schedule_id, data)
 
-                    if status == "cancelled":
-                        cancelled.append(e)
+        print(
+            f"[RACE PROB] race_id={schedule_id} runners={len(entries)} "
+            f"sims={n_sims} seed={seed}"
+        )
+        return data
 
+    async def get_race_probabilities(self, schedule_id: int):
+        """
+        推定済みの確率（未計算なら None）。
+        return: {"guild_id", "n_sims", "seed", "win": {pet_id: p}, "top3": {pet_id: p},
+                 "trifecta": {"a-b-c": p}}
+        """
+        cached = self._race_probs.get(schedule_id)
+        if cached is not None:
+            return cached
 
+        row = await self._fetchrow("""
+            SELECT guild_id, n_sims, seed, win, top3, trifecta
+            FROM race_probabilities
+            WHERE schedule_id = $1
+        """, schedule_id)
 
+        if not row:
+            return None
 
+        def load(v):
+            return json.loads(v) if isinstance(v, str) else v
+
+        data = {
+            "guild_id": row["guild_id"],
+            "n_sims": row["n_sims"],
+            "seed": row["seed"],
+            **self._probs_keys_to_int({
+                "win": load(row["win"]),
+                "top3": load(row["top3"]),
+                "trifecta": load(row["trifecta"]),
+            })
+        }
 
-                await conn.execute("""
-                    UPDATE race_schedules
-                    SET lottery_done = TRUE,
-                        locked = TRUE
-                    WHERE id = $1
-                """, schedule_id)
+        self._remember_race_probs(schedule_id, data)
+        return data
 
-                return {
-                    "selected": selected,
-                    "cancelled": cancelled
-                }
+    @staticmethod
+    def _probs_keys_to_int(probs: dict) -> dict:
+        # JSON のキーは文字列になるので pet_id を int に揃える
+        return {
+            "win": {int(k): v for k, v in probs["win"].items()},
+            "top3": {int(k): v for k, v in probs["top3"].items()},
+            "trifecta": dict(probs["trifecta"]),
+        }
+
+    def _remember_race_probs(self, schedule_id, data):
+        self._race_probs.pop(schedule_id, None)
+        self._race_probs[schedule_id] = data
+        while len(self._race_probs) > RACE_PROB_CACHE_SIZE:
+            self._race_probs.pop(next(iter(self._race_probs)))
 
     # =========================
     # レース設定取得
     # =========================
     async def get_race_settings(self, guild_id: str):
         await self._ensure_pool()
-        return await self._fetchrow(
-            "SELECT * FROM race_settings WHERE guild_id=$1",
-            str(guild_id)
+        return await self._config.get(
+            ("race_settings", guild_id),
+            lambda: self._fetchrow(
+                "SELECT * FROM race_settings WHERE guild_id=$1",
+                str(guild_id)
+            )
         )
 
     # =========================
@@ -3338,6 +2673,7 @@ class Database:
             ON CONFLICT (guild_id)
             DO UPDATE SET result_channel_id=$2
         """, str(guild_id), str(channel_id))
+        self._config.invalidate("race_settings", guild_id)
 
 
 
@@ -3371,17 +2707,19 @@ class Database:
 
 
     async def get_latest_open_race(self, guild_id):
+        # カレンダーは数日先まであるので、今日より先の日付は見ない
         return await self._fetchrow("""
             SELECT *
             FROM race_schedules
             WHERE guild_id = $1
               AND lottery_done = TRUE
+              AND race_date <= $2
             ORDER BY race_date DESC, race_no DESC
             LIMIT 1
-        """, guild_id)
+        """, guild_id, datetime.now(JST).date())
 
     async def place_bet(self, guild_id, race_date, schedule_id, user_id, pet_id, amount):
-        async with self._lock:
+        async with self._locks("race_pools", guild_id, race_date, schedule_id):
 
             # ① 馬券保存
             await self._execute("""
@@ -3408,6 +2746,319 @@ class Database:
                 DO UPDATE SET total_amount = race_pet_pools.total_amount + $5
             """, guild_id, race_date, schedule_id, pet_id, amount)
 
+            # ④ メモリ集計・表示キャッシュにも反映
+            pool_aggregator.add(guild_id, race_date, schedule_id, pet_id, amount)
+            race_cache.bump(guild_id, schedule_id)
+
+    # ======================================================
+    # 購入共通：上限チェック前のユーザー行ロック
+    # ======================================================
+    async def _lock_user_row(self, conn, guild_id, user_id):
+        """購入の上限チェック前に users 行を FOR UPDATE（未登録なら何もしない）"""
+        await conn.execute("""
+            SELECT 1
+            FROM users
+            WHERE guild_id = $1
+              AND user_id = $2
+            FOR UPDATE
+        """, guild_id, user_id)
+
+    # ======================================================
+    # 単勝購入（Web）：検証・減算・記録・プール加算をユーザー行ロック＋1ステートメントで
+    # ======================================================
+    async def buy_race_bet(
+        self,
+        guild_id,
+        schedule_id,
+        user_id,
+        pet_id,
+        amount,
+        *,
+        max_amount,
+        allow_closed=False
+    ):
+        """
+        return: {
+            "status": "ok" / "race_not_found" / "closed" / "limit" / "no_user" / "balance",
+            "race_date", "user_total"（今回分を含む）, "balance_after",
+            "total_pool", "pet_pool"（今回分を含む最新プール）
+        }
+        users 行をロックしてから購入済み合計を数えるので、同じユーザーの同時購入でも
+        上限を超えない。残高も UPDATE の条件で再確認する。
+        """
+        await self._ensure_pool()
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 先に users 行をロックしてから上限を数える
+                # （同じユーザーの同時購入で合計が古いスナップショットにならないように）
+                await self._lock_user_row(conn, str(guild_id), str(user_id))
+
+                row = await conn.fetchrow("""
+                    WITH race AS (
+                        SELECT id, race_date, lottery_done
+                        FROM race_schedules
+                        WHERE id = $1::INTEGER
+                          AND guild_id = $2::TEXT
+                    ),
+                    spent AS (
+                        SELECT COALESCE(SUM(amount), 0)::BIGINT AS total
+                        FROM race_bets
+                        WHERE guild_id = $2
+                          AND schedule_id = $1
+                          AND user_id = $3::TEXT
+                    ),
+                    usr AS (
+                        SELECT balance
+                        FROM users
+                        WHERE user_id = $3
+                          AND guild_id = $2
+                    ),
+                    chk AS (
+                        SELECT
+                            race.id,
+                            race.race_date,
+                            spent.total AS spent,
+                            CASE
+                                WHEN race.id IS NULL THEN 'race_not_found'
+                                WHEN race.lottery_done AND NOT $7::BOOLEAN THEN 'closed'
+                                WHEN spent.total + $5::INTEGER > $6::BIGINT THEN 'limit'
+                                WHEN usr.balance IS NULL THEN 'no_user'
+                                WHEN usr.balance < $5 THEN 'balance'
+                                ELSE 'ok'
+                            END AS status
+                        FROM spent
+                        LEFT JOIN race ON TRUE
+                        LEFT JOIN usr ON TRUE
+                    ),
+                    debit AS (
+                        UPDATE users u
+                        SET balance = u.balance - $5
+                        FROM chk
+                        WHERE chk.status = 'ok'
+                          AND u.user_id = $3
+                          AND u.guild_id = $2
+                          AND u.balance >= $5
+                        RETURNING u.balance
+                    ),
+                    ledger AS (
+                        INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+                        SELECT $2, $3, -$5, balance, 'race_bet', $1::TEXT
+                        FROM debit
+                    ),
+                    bet AS (
+                        INSERT INTO race_bets
+                        (race_id, guild_id, race_date, schedule_id, user_id, pet_id, amount)
+                        SELECT chk.id::TEXT, $2, chk.race_date, chk.id, $3, $4::INTEGER, $5
+                        FROM chk, debit
+                    ),
+                    total_pool AS (
+                        INSERT INTO race_pools
+                        (guild_id, race_date, schedule_id, total_pool)
+                        SELECT $2, chk.race_date, chk.id, $5
+                        FROM chk, debit
+                        ON CONFLICT (guild_id, race_date, schedule_id)
+                        DO UPDATE SET total_pool = race_pools.total_pool + EXCLUDED.total_pool
+                        RETURNING total_pool
+                    ),
+                    pet_pool AS (
+                        INSERT INTO race_pet_pools
+                        (guild_id, race_date, schedule_id, pet_id, total_amount)
+                        SELECT $2, chk.race_date, chk.id, $4, $5
+                        FROM chk, debit
+                        ON CONFLICT (guild_id, race_date, schedule_id, pet_id)
+                        DO UPDATE SET total_amount = race_pet_pools.total_amount + EXCLUDED.total_amount
+                        RETURNING total_amount
+                    )
+                    SELECT
+                        CASE
+                            -- 検証後に残高が減っていた（同時購入）
+                            WHEN chk.status = 'ok' AND NOT EXISTS (SELECT 1 FROM debit) THEN 'balance'
+                            ELSE chk.status
+                        END AS status,
+                        chk.race_date,
+                        chk.spent + $5 AS user_total,
+                        (SELECT balance FROM debit) AS balance_after,
+                        (SELECT total_pool FROM total_pool) AS total_pool,
+                        (SELECT total_amount FROM pet_pool) AS pet_pool
+                    FROM chk
+                """,
+                    int(schedule_id),
+                    str(guild_id),
+                    str(user_id),
+                    int(pet_id),
+                    int(amount),
+                    int(max_amount),
+                    bool(allow_closed)
+                )
+
+        if row["status"] == "ok":
+            race_cache.bump(guild_id, schedule_id)
+
+        return dict(row)
+
+    async def buy_race_bets(self, guild_id, schedule_id, bets, *, max_amount, allow_closed=False):
+        """
+        単勝購入のまとめ処理（グループコミット用）。同じレースの bet を1トランザクションで。
+        bets  : [(user_id, pet_id, amount), ...]（到着順。判定もこの順）
+        return: bets と同じ並びの結果リスト（各要素は buy_race_bet と同じ形）
+        残高はロックしてから1件ずつ判定し、プールへの加算はバッチ全体で1回。
+        """
+        await self._ensure_pool()
+        guild_id = str(guild_id)
+        schedule_id = int(schedule_id)
+        bets = [(str(u), int(p), int(a)) for u, p, a in bets]
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+
+                race = await conn.fetchrow("""
+                    SELECT id, race_date, lottery_done
+                    FROM race_schedules
+                    WHERE id = $1
+                      AND guild_id = $2
+                """, schedule_id, guild_id)
+
+                if not race:
+                    return [{"status": "race_not_found"} for _ in bets]
+
+                if race["lottery_done"] and not allow_closed:
+                    return [{"status": "closed"} for _ in bets]
+
+                race_date = race["race_date"]
+                user_ids = sorted({u for u, _, _ in bets})
+
+                # 残高ロック（ユーザー順に取ってデッドロックを避ける）
+                balance_rows = await conn.fetch("""
+                    SELECT user_id, balance
+                    FROM users
+                    WHERE guild_id = $1
+                      AND user_id = ANY($2::text[])
+                    ORDER BY user_id
+                    FOR UPDATE
+                """, guild_id, user_ids)
+
+                spent_rows = await conn.fetch("""
+                    SELECT user_id, SUM(amount) AS total
+                    FROM race_bets
+                    WHERE guild_id = $1
+                      AND schedule_id = $2
+                      AND user_id = ANY($3::text[])
+                    GROUP BY user_id
+                """, guild_id, schedule_id, user_ids)
+
+                balances = {r["user_id"]: r["balance"] for r in balance_rows}
+                spent = {r["user_id"]: int(r["total"]) for r in spent_rows}
+
+                # -------------------------
+                # 到着順に1件ずつ判定
+                # -------------------------
+                results = []
+                accepted = []
+
+                for user_id, pet_id, amount in bets:
+                    user_total = spent.get(user_id, 0) + amount
+                    balance = balances.get(user_id)
+
+                    if user_total > max_amount:
+                        status = "limit"
+                    elif balance is None:
+                        status = "no_user"
+                    elif balance < amount:
+                        status = "balance"
+                    else:
+                        status = "ok"
+
+                    result = {"status": status, "race_date": race_date}
+
+                    if status == "ok":
+                        spent[user_id] = user_total
+                        balances[user_id] = balance - amount
+
+                        result["user_total"] = user_total
+                        result["balance_after"] = balance - amount
+                        accepted.append((user_id, pet_id, amount, balance - amount, result))
+
+                    results.append(result)
+
+                if not accepted:
+                    return results
+
+                # -------------------------
+                # 減算・台帳・bet・プールを1ステートメントで
+                # -------------------------
+                pool_rows = await conn.fetch("""
+                    WITH b AS (
+                        SELECT *
+                        FROM unnest($4::text[], $5::int[], $6::int[], $7::bigint[])
+                            WITH ORDINALITY AS t(user_id, pet_id, amount, balance_after, n)
+                    ),
+                    debit AS (
+                        UPDATE users u
+                        SET balance = u.balance - s.amount
+                        FROM (
+                            SELECT user_id, SUM(amount) AS amount
+                            FROM b
+                            GROUP BY user_id
+                        ) s
+                        WHERE u.user_id = s.user_id
+                          AND u.guild_id = $1
+                    ),
+                    ledger AS (
+                        INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+                        SELECT $1, user_id, -amount, balance_after, 'race_bet', $2::INTEGER::TEXT
+                        FROM b
+                        ORDER BY n
+                    ),
+                    bet AS (
+                        INSERT INTO race_bets
+                        (race_id, guild_id, race_date, schedule_id, user_id, pet_id, amount)
+                        SELECT $2::TEXT, $1, $3, $2, user_id, pet_id, amount
+                        FROM b
+                        ORDER BY n
+                    ),
+                    total_pool AS (
+                        INSERT INTO race_pools
+                        (guild_id, race_date, schedule_id, total_pool)
+                        SELECT $1, $3, $2, SUM(amount)
+                        FROM b
+                        ON CONFLICT (guild_id, race_date, schedule_id)
+                        DO UPDATE SET total_pool = race_pools.total_pool + EXCLUDED.total_pool
+                        RETURNING total_pool
+                    ),
+                    pet_pool AS (
+                        INSERT INTO race_pet_pools
+                        (guild_id, race_date, schedule_id, pet_id, total_amount)
+                        SELECT $1, $3, $2, pet_id, SUM(amount)
+                        FROM b
+                        GROUP BY pet_id
+                        ON CONFLICT (guild_id, race_date, schedule_id, pet_id)
+                        DO UPDATE SET total_amount = race_pet_pools.total_amount + EXCLUDED.total_amount
+                        RETURNING pet_id, total_amount
+                    )
+                    SELECT NULL::INTEGER AS pet_id, total_pool AS amount FROM total_pool
+                    UNION ALL
+                    SELECT pet_id, total_amount FROM pet_pool
+                """,
+                    guild_id,
+                    schedule_id,
+                    race_date,
+                    [a[0] for a in accepted],
+                    [a[1] for a in accepted],
+                    [a[2] for a in accepted],
+                    [a[3] for a in accepted]
+                )
+
+        total_pool = next(r["amount"] for r in pool_rows if r["pet_id"] is None)
+        pet_pools = {r["pet_id"]: r["amount"] for r in pool_rows if r["pet_id"] is not None}
+
+        for _, pet_id, _, _, result in accepted:
+            result["total_pool"] = total_pool
+            result["pet_pool"] = pet_pools[pet_id]
+
+        race_cache.bump(guild_id, schedule_id)
+        return results
+
     async def get_race_pool(self, guild_id, race_date, schedule_id):
         row = await self._fetchrow("""
             SELECT total_pool
@@ -3419,7 +3070,16 @@ class Database:
 
         return row["total_pool"] if row else 0
 
+    async def get_race_pool_keys(self, race_date):
+        """指定日にプールがあるレース（メモリ集計の起動時読み込み用）"""
+        return await self._fetch("""
+            SELECT guild_id, race_date, schedule_id
+            FROM race_pools
+            WHERE race_date = $1
+        """, race_date)
+
     async def get_pool_data(self, guild_id, race_date, schedule_id):
+        """DB から直接読む（表示には race_pools.pool_aggregator を使う）"""
         total_row = await self._fetchrow("""
             SELECT total_pool
             FROM race_pools
@@ -3442,8 +3102,17 @@ class Database:
 
         return total_pool, pet_pools
 
-    async def finalize_race(self, guild_id, race_date, schedule_id, distance):
+    # 着順ごとのオーナー賞金（4着以下は RACE_REWARD_OTHERS）
+    RACE_REWARDS = {1: 50000, 2: 30000, 3: 10000}
+    RACE_REWARDS_MAIN = {1: 200000, 2: 150000, 3: 100000}   # 第6レース
+    RACE_REWARD_OTHERS = 5000
 
+    async def finalize_race(self, guild_id, race_date, schedule_id, distance):
+        """
+        レース確定：シミュレーション → 結果保存 → オーナー賞金。
+        出走頭数に関係なく往復回数は一定
+        （締切行ロック・出走馬・結果一括保存・賞金一括入金の4ステートメント）。
+        """
         guild_id = str(guild_id)
         schedule_id = int(schedule_id)
 
@@ -3471,88 +3140,44 @@ class Database:
                     return []
 
                 # =========================
-                # 🐎 出走確定馬取得
+                # 🐎 出走確定馬 + ペット能力（1クエリ）
                 # =========================
-                raw_entries = await conn.fetch("""
-                    SELECT *
-                    FROM race_entries
-                    WHERE guild_id = $1
-                      AND race_date = $2
-                      AND schedule_id = $3
-                      AND status = 'selected'
-                """, guild_id, race_date, schedule_id)
+                entries = await self._fetch_race_runners(
+                    conn, guild_id, race_date, schedule_id
+                )
 
-                if not raw_entries:
+                if not entries:
                     return []
 
-                entries = []
-
-                for e in raw_entries:
-
-                    pet = await conn.fetchrow("""
-                        SELECT
-                            passive_skill,
-                            adult_key,
-                            base_speed,
-                            train_speed,
-                            base_power,
-                            train_power,
-                            base_stamina,
-                            train_stamina
-                        FROM oasistchi_pets
-                        WHERE id = $1
-                    """, e["pet_id"])
-
-
-                    entries.append({
-                        "user_id": e["user_id"],
-                        "pet_id": e["pet_id"],
-                        "passive_skill": pet["passive_skill"] if pet else None,
-                        "adult_key": pet["adult_key"] if pet else None,
-                        "speed": ((pet["base_speed"] or 0) + (pet["train_speed"] or 0)) if pet else 0,
-                        "power": ((pet["base_power"] or 0) + (pet["train_power"] or 0)) if pet else 0,
-                        "stamina": ((pet["base_stamina"] or 0) + (pet["train_stamina"] or 0)) if pet else 0,
-                        "gate": e.get("gate"),
-
-
-
-
-                    })
-
                 # simulate
                 results = self.simulate_race(entries, race)
 
                 # =========================
                 # 🏆 結果保存 + 賞金処理4.15
                 # =========================
-                for r in results:
-
-                    rank = int(r["rank"])
-                    score = int(r["score"])
-                    pet_id = int(r["pet_id"])
-                    schedule_id_int = schedule_id
-
-                    # 報酬計算
-                    if race["race_no"] == 6:
-                        rewards = {
-                            1: 200000,
-                            2: 150000,
-                            3: 100000
-                        }
-                    else:
-                        rewards = {
-                            1: 50000,
-                            2: 30000,
-                            3: 10000
-                        }
+                if race["race_no"] == 6:
+                    rewards = self.RACE_REWARDS_MAIN
+                else:
+                    rewards = self.RACE_REWARDS
 
-                    reward = rewards.get(rank, 5000)
+                for r in results:
+                    r["reward"] = rewards.get(int(r["rank"]), self.RACE_REWARD_OTHERS)
 
-                    # race_results 保存
-                    await conn.execute("""
+                # race_results 保存 / race_entries 更新 / 通算成績加算 / 支払い完了フラグを1文で
+                await conn.execute("""
+                    WITH r AS (
+                        SELECT *
+                        FROM unnest(
+                            $3::int[], $4::text[], $5::int[],
+                            $6::double precision[], $7::real[],
+                            $8::int[], $9::text[]
+                        ) AS t(pet_id, user_id, rank, final_score, score, reward, debug)
+                    ),
+                    saved AS (
                         INSERT INTO race_results
                         (guild_id, race_date, schedule_id, pet_id, user_id, position, rank, final_score, reward, debug)
-                        VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
+                        SELECT $1, $2, $10, pet_id, user_id, rank, rank, final_score, reward, debug::jsonb
+                        FROM r
                         ON CONFLICT (race_date, schedule_id, pet_id)
                         DO UPDATE SET
                             user_id = EXCLUDED.user_id,
@@ -3561,85 +3186,285 @@ class Database:
                             final_score = EXCLUDED.final_score,
                             reward = EXCLUDED.reward,
                             debug = EXCLUDED.debug
-                    """,
-                        guild_id,
-                        race_date,
-                        schedule_id_int,
-                        pet_id,
-                        str(r["user_id"]),
-                        rank,
-                        rank,
-                        score,
-                        reward,
-                        json.dumps(r.get("debug", {}))
-                    )
-                    # race_entries 更新
-
-                    await conn.execute("""
-                        UPDATE race_entries
-                        SET rank = $1,
-                            score = $2,
-                            debug_json = $3
-                        WHERE schedule_id = $4
-                          AND pet_id = $5
-                    """,
-                        rank,
-                        float(r["score"]),
-                        json.dumps(r.get("debug", {})),
-                        schedule_id_int,
-                        pet_id
+                    ),
+                    ranked AS (
+                        UPDATE race_entries e
+                        SET rank = r.rank,
+                            score = r.score,
+                            debug_json = r.debug::jsonb
+                        FROM r
+                        WHERE e.schedule_id = $10
+                          AND e.pet_id = r.pet_id
+                    ),
+                    stats AS (
+                        INSERT INTO pet_race_stats AS s
+                        (guild_id, pet_id, distance, starts, wins, podiums, earnings, last_schedule_id)
+                        SELECT $1, pet_id, $11::text, 1,
+                               (rank = 1)::int, (rank <= 3)::int, reward, $10
+                        FROM r
+                        WHERE $11::text IS NOT NULL
+                        ON CONFLICT (guild_id, pet_id, distance)
+                        DO UPDATE SET
+                            starts = s.starts + 1,
+                            wins = s.wins + EXCLUDED.wins,
+                            podiums = s.podiums + EXCLUDED.podiums,
+                            earnings = s.earnings + EXCLUDED.earnings,
+                            last_schedule_id = EXCLUDED.last_schedule_id,
+                            updated_at = NOW()
                     )
-
-                    # 💰 オーナー賞金
-                    if reward > 0:
-                        await conn.execute("""
-                            INSERT INTO users (user_id, guild_id, balance)
-                            VALUES ($1, $2, $3)
-                            ON CONFLICT (user_id, guild_id)
-                            DO UPDATE SET balance = users.balance + $3
-                        """,
-                            str(r["user_id"]),
-                            guild_id,
-                            reward
-                        )
-                        print(f"[OWNER PRIZE] rank={rank} user={r['user_id']} prize={reward}")
-
-                # =========================
-                # 🔐 賞金支払い完了フラグ
-                # =========================
-                await conn.execute("""
                     UPDATE race_schedules
                     SET reward_paid = TRUE
-                    WHERE id = $1
-                """, schedule_id)
+                    WHERE id = $10
+                """,
+                    guild_id,
+                    race_date,
+                    [int(r["pet_id"]) for r in results],
+                    [str(r["user_id"]) for r in results],
+                    [int(r["rank"]) for r in results],
+                    [int(r["score"]) for r in results],
+                    [float(r["score"]) for r in results],
+                    [r["reward"] for r in results],
+                    [json.dumps(r.get("debug", {})) for r in results],
+                    schedule_id,
+                    race["distance"]
+                )
 
-                return results
+                # 💰 オーナー賞金（全員分を1文で入金）
+                await self.apply_balance_deltas(
+                    guild_id,
+                    [(r["user_id"], r["reward"]) for r in results if r["reward"] > 0],
+                    floor=None,
+                    reason="race_reward",
+                    ref=schedule_id,
+                    conn=conn
+                )
 
-    async def get_latest_active_race(self, guild_id: str):
+                print(
+                    f"[OWNER PRIZE] race_id={schedule_id} "
+                    + " ".join(f"{r['rank']}:{r['user_id']}={r['reward']}" for r in results)
+                )
+
+        race_cache.bump(guild_id, schedule_id)
+        # 締切後は購入が無いのでメモリのプールは不要（表示は DB から読み直す）
+        pool_aggregator.drop(guild_id, race_date, schedule_id)
+        return results
+
+    # =========================
+    # 通算成績（pet_race_stats）
+    # =========================
+    async def rebuild_pet_race_stats(self, guild_id=None) -> int:
         """
-        open / locked / racing のいずれかの
-        最新レースを取得する（観戦用）
+        race_entries / race_results から通算成績を作り直す（バックフィル）。
+        guild_id: 指定ギルドだけ（None なら全ギルド）
+        return: 作成した行数
         """
         await self._ensure_pool()
+        guild_id = None if guild_id is None else str(guild_id)
 
         async with self.pool.acquire() as conn:
-            return await conn.fetchrow("""
-                SELECT *
-                FROM race_schedules
-                WHERE guild_id = $1
-                  AND phase IN ('open', 'locked', 'racing')
-                ORDER BY race_date DESC, race_no DESC
-                LIMIT 1
-            """, guild_id)
+            async with conn.transaction():
+                await conn.execute(DELETE_STATS, guild_id)
+                result = await conn.execute(REBUILD_STATS, guild_id)
+
+        # "INSERT 0 <件数>"
+        return int(result.split()[-1])
+
+    async def get_pet_ranking(self, guild_id: str, distance: str, limit: int = 50):
+        """距離別の勝利数ランキング（索引で上位 N 件）"""
+        return await self._fetch("""
+            SELECT
+                p.id AS pet_id,
+                p.name,
+                p.adult_key,
+
+                p.base_speed,
+                p.train_speed,
+                p.base_power,
+                p.train_power,
+                p.base_stamina,
+                p.train_stamina,
+
+                p.passive_skill,
+                p.user_id,
+
+                s.wins AS win_count,
+                s.starts,
+                s.podiums,
+                s.earnings
+
+            FROM pet_race_stats s
+
+            JOIN oasistchi_pets p
+              ON p.id = s.pet_id
+
+            WHERE s.guild_id = $1
+              AND s.distance = $2
+              AND s.wins > 0
+
+            ORDER BY s.wins DESC
+            LIMIT $3
+        """, str(guild_id), distance, limit)
+
+    async def get_pet_career(self, guild_id: str, pet_id: int):
+        """
+        return: (ペット行 or None, [距離別成績, ...])
+        """
+        rows = await self._fetch("""
+            SELECT
+                p.id AS pet_id,
+                p.name,
+                p.adult_key,
+                p.user_id,
+                p.passive_skill,
+                s.distance,
+                s.starts,
+                s.wins,
+                s.podiums,
+                s.earnings,
+                s.last_schedule_id
+            FROM oasistchi_pets p
+            LEFT JOIN pet_race_stats s
+              ON s.pet_id = p.id
+             AND s.guild_id = $1
+            WHERE p.id = $2
+            ORDER BY s.distance
+        """, str(guild_id), int(pet_id))
+
+        if not rows:
+            return None, []
+
+        stats = [r for r in rows if r["distance"] is not None]
+        return rows[0], stats
+
+    async def get_latest_active_race(self, guild_id: str):
+        """
+        今日のレースのうち、まだ終わっていない一番早いもの
+        （受付中・締切後・レース中。観戦用）。無ければ None
+        終わった = 結果送信済み、または発走から RACE_DURATION_MINUTES 経過
+        （出走が揃わず結果が出ないレースもあるので時刻でも切る）
+        """
+        now = datetime.now(JST)
+        # race_date + race_time は JST のタイムゾーン無し時刻
+        ended_before = (now - timedelta(minutes=RACE_DURATION_MINUTES)).replace(tzinfo=None)
+
+        return await self._fetchrow("""
+            SELECT *
+            FROM race_schedules
+            WHERE guild_id = $1
+              AND race_date = $2
+              AND race_finished IS NOT TRUE
+              AND race_date + race_time::time > $3
+            ORDER BY race_time, race_no
+            LIMIT 1
+        """, str(guild_id), now.date(), ended_before)
 
 
     async def get_hotel_sub_role(self, guild_id: str):
+        row = await self.get_hotel_settings(guild_id)
+        return row["sub_role"] if row else None
+
+    # =========================
+    # ホテル設定
+    # =========================
+    async def get_hotel_settings(self, guild_id: str):
         await self._ensure_pool()
-        row = await self._fetchrow(
-            "SELECT sub_role FROM hotel_settings WHERE guild_id=$1",
-            str(guild_id)
+        return await self._config.get(
+            ("hotel_settings", guild_id),
+            lambda: self._fetchrow(
+                "SELECT * FROM hotel_settings WHERE guild_id=$1",
+                str(guild_id)
+            )
+        )
+
+    async def get_all_hotel_settings(self):
+        await self._ensure_pool()
+        return await self._fetch("SELECT * FROM hotel_settings")
+
+    async def save_hotel_settings(
+        self,
+        guild_id: str,
+        manager_role: str,
+        log_channel: str,
+        sub_role: str,
+        ticket_price_1: int,
+        ticket_price_10: int,
+        ticket_price_30: int,
+        category_ids: list[str]
+    ):
+        await self._ensure_pool()
+        await self._execute("""
+            INSERT INTO hotel_settings (
+                guild_id, manager_role, log_channel, sub_role,
+                ticket_price_1, ticket_price_10, ticket_price_30,
+                category_ids
+            )
+            VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
+            ON CONFLICT (guild_id)
+            DO UPDATE SET
+                manager_role=$2,
+                log_channel=$3,
+                sub_role=$4,
+                ticket_price_1=$5,
+                ticket_price_10=$6,
+                ticket_price_30=$7,
+                category_ids=$8
+        """,
+            str(guild_id),
+            manager_role,
+            log_channel,
+            sub_role,
+            ticket_price_1,
+            ticket_price_10,
+            ticket_price_30,
+            category_ids
+        )
+        self._config.invalidate("hotel_settings", guild_id)
+
+    # =========================
+    # サブスク設定
+    # =========================
+    async def get_subscription_settings(self, guild_id: str):
+        await self._ensure_pool()
+        return await self._config.get(
+            ("subscription_settings", guild_id),
+            lambda: self._fetchrow(
+                "SELECT * FROM subscription_settings WHERE guild_id=$1",
+                str(guild_id)
+            )
+        )
+
+    async def save_subscription_settings(
+        self,
+        guild_id: str,
+        standard_role: str, standard_price: int,
+        regular_role: str, regular_price: int,
+        premium_role: str, premium_price: int,
+        log_channel: str
+    ):
+        await self._ensure_pool()
+        await self._execute("""
+            INSERT INTO subscription_settings (
+                guild_id,
+                standard_role, standard_price,
+                regular_role, regular_price,
+                premium_role, premium_price,
+                log_channel
+            )
+            VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
+            ON CONFLICT (guild_id)
+            DO UPDATE SET
+                standard_role=$2, standard_price=$3,
+                regular_role=$4, regular_price=$5,
+                premium_role=$6, premium_price=$7,
+                log_channel=$8
+        """,
+            str(guild_id),
+            standard_role, standard_price,
+            regular_role, regular_price,
+            premium_role, premium_price,
+            log_channel
         )
-        return row["sub_role"] if row else None
+        self._config.invalidate("subscription_settings", guild_id)
 
     # ======================================================
     # 3連単プール表示3.1
@@ -3757,6 +3582,100 @@ class Database:
         odds = total_pool / combo_amount
         return round(odds, 2)
 
+    # ======================================================
+    # 3連単オッズ表（全組み合わせ・Web表示用）
+    # ======================================================
+    async def get_trifecta_matrix(self, guild_id, schedule_id):
+        """
+        出走馬の並び（抽選順）と、全組み合わせの購入額を1クエリで取得。
+        pools の並び: 出走馬の添字 (i, j, k) を i → j → k の順に回し、同じ馬を含むものを飛ばす
+                     （8頭なら 8P3 = 336 要素）
+        return: {"runners": [pet_id, ...], "total_pool": int, "pools": [int, ...]}
+                レースが無ければ None
+        """
+        guild_id = str(guild_id)
+        schedule_id = int(schedule_id)
+
+        return await trifecta_matrix_cache.get(
+            ("trifecta_matrix", guild_id, schedule_id),
+            lambda: self._load_trifecta_matrix(guild_id, schedule_id)
+        )
+
+    async def _load_trifecta_matrix(self, guild_id, schedule_id):
+        rows = await self._fetch("""
+            WITH race AS (
+                SELECT id, race_date
+                FROM race_schedules
+                WHERE id = $2
+                  AND guild_id = $1
+            ),
+            runners AS (
+                SELECT array_agg(e.pet_id ORDER BY e.created_at, e.id) AS ids
+                FROM race_entries e
+                JOIN race r ON r.id = e.schedule_id AND r.race_date = e.race_date
+                WHERE e.guild_id = $1
+                  AND e.status = 'selected'
+            ),
+            combos AS (
+                SELECT
+                    b.first_pet_id,
+                    b.second_pet_id,
+                    b.third_pet_id,
+                    SUM(b.amount) AS amount
+                FROM race_trifecta_bets b
+                JOIN race r ON r.id = b.schedule_id AND r.race_date = b.race_date
+                WHERE b.guild_id = $1
+                GROUP BY b.first_pet_id, b.second_pet_id, b.third_pet_id
+            )
+            SELECT
+                runners.ids AS runners,
+                combos.first_pet_id,
+                combos.second_pet_id,
+                combos.third_pet_id,
+                combos.amount
+            FROM race
+            CROSS JOIN runners
+            LEFT JOIN combos ON TRUE
+        """, guild_id, schedule_id)
+
+        if not rows:
+            return None
+
+        runners = list(rows[0]["runners"] or [])
+        index = {pet_id: i for i, pet_id in enumerate(runners)}
+        n = len(runners)
+
+        # 全購入額（出走取消馬を含む組み合わせも総額には入れる）
+        total_pool = 0
+        amounts = {}
+
+        for r in rows:
+            if r["amount"] is None:
+                continue
+            total_pool += r["amount"]
+            key = (
+                index.get(r["first_pet_id"]),
+                index.get(r["second_pet_id"]),
+                index.get(r["third_pet_id"]),
+            )
+            amounts[key] = r["amount"]
+
+        pools = [
+            amounts.get((i, j, k), 0)
+            for i in range(n)
+            for j in range(n) if j != i
+            for k in range(n) if k != i and k != j
+        ]
+
+        return {
+            "runners": runners,
+            "total_pool": total_pool,
+            "pools": pools
+        }
+
+    def invalidate_trifecta_matrix(self, guild_id, schedule_id):
+        trifecta_matrix_cache.invalidate("trifecta_matrix", guild_id, schedule_id)
+
     # ======================================================
     # 3連単：ユーザー購入口数取得
     # ======================================================
@@ -3823,7 +3742,9 @@ class Database:
         user_id = str(user_id)
         schedule_id = int(schedule_id)
         amount = int(amount)
-        race_date = str(race_date)
+        # DATE 列なので date で渡す（"YYYY-MM-DD" も受け付ける）
+        if isinstance(race_date, str):
+            race_date = date.fromisoformat(race_date)
 
         # =========================
         # 0) 入力チェック（口数制限）
@@ -3845,57 +3766,117 @@ class Database:
 
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-
-                # =========================
-                # ① 残高ロック
-                # =========================
-                balance_row = await conn.fetchrow("""
-                    SELECT balance
-                    FROM users
-                    WHERE user_id=$1 AND guild_id=$2
-                    FOR UPDATE
-                """, user_id, guild_id)
-
-                if not balance_row:
-                    raise RuntimeError("ユーザー未登録")
-
-                if balance_row["balance"] < amount:
-                    raise RuntimeError("残高不足")
-
-                # =========================
-                # ★ 1.5) 3連単の購入上限チェック（このレース合計）
-                # =========================
-                user_total = await conn.fetchval("""
-                    SELECT COALESCE(SUM(amount), 0)
-                    FROM race_trifecta_bets
-                    WHERE guild_id=$1
-                      AND race_date=$2
-                      AND schedule_id=$3
-                      AND user_id=$4
-                """, guild_id, race_date, schedule_id, user_id)
-
-                new_total = int(user_total) + amount
-                if new_total > TRIFECTA_MAX_AMOUNT:
-                    remaining = (TRIFECTA_MAX_AMOUNT - int(user_total)) // TRIFECTA_UNIT_PRICE
-                    raise RuntimeError(f"3連単はこのレースで最大10口までです（残り {remaining}口）")
-
-                # =========================
-                # ② 残高減算
-                # =========================
-                await conn.execute("""
-                    UPDATE users
-                    SET balance = balance - $1
-                    WHERE user_id=$2 AND guild_id=$3
-                """, amount, user_id, guild_id)
-
-                # =========================
-                # ③ ユーザー別ベット保存
-                # =========================
-                await conn.execute("""
-                    INSERT INTO race_trifecta_bets
-                    (guild_id, race_date, schedule_id, user_id,
-                     first_pet_id, second_pet_id, third_pet_id, amount)
-                    VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
+                # 先に users 行をロックしてから上限を数える
+                # （同じユーザーの同時購入で合計が古いスナップショットにならないように）
+                await self._lock_user_row(conn, guild_id, user_id)
+
+                row = await conn.fetchrow("""
+                    WITH spent AS (
+                        SELECT COALESCE(SUM(amount), 0)::BIGINT AS total
+                        FROM race_trifecta_bets
+                        WHERE guild_id = $1::TEXT
+                          AND race_date = $2
+                          AND schedule_id = $3::INTEGER
+                          AND user_id = $4::TEXT
+                    ),
+                    usr AS (
+                        SELECT balance
+                        FROM users
+                        WHERE user_id = $4
+                          AND guild_id = $1
+                    ),
+                    chk AS (
+                        SELECT
+                            spent.total AS spent,
+                            CASE
+                                WHEN usr.balance IS NULL THEN 'no_user'
+                                WHEN usr.balance < $8::INTEGER THEN 'balance'
+                                WHEN spent.total + $8 > $9::BIGINT THEN 'limit'
+                                ELSE 'ok'
+                            END AS status
+                        FROM spent
+                        LEFT JOIN usr ON TRUE
+                    ),
+                    debit AS (
+                        UPDATE users u
+                        SET balance = u.balance - $8
+                        FROM chk
+                        WHERE chk.status = 'ok'
+                          AND u.user_id = $4
+                          AND u.guild_id = $1
+                          AND u.balance >= $8
+                        RETURNING u.balance
+                    ),
+                    ledger AS (
+                        INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+                        SELECT $1, $4, -$8, balance, 'trifecta_bet', $3::TEXT
+                        FROM debit
+                    ),
+                    bet AS (
+                        INSERT INTO race_trifecta_bets
+                        (guild_id, race_date, schedule_id, user_id,
+                         first_pet_id, second_pet_id, third_pet_id, amount)
+                        SELECT $1, $2, $3, $4, $5::INTEGER, $6::INTEGER, $7::INTEGER, $8
+                        FROM debit
+                    ),
+                    -- キャリーはロックして最新値を取り、使ったらゼロクリア
+                    carry AS (
+                        UPDATE race_trifecta_carry c
+                        SET carry_over = 0
+                        FROM (
+                            SELECT guild_id, carry_over
+                            FROM race_trifecta_carry
+                            WHERE guild_id = $1
+                            FOR UPDATE
+                        ) old, debit
+                        WHERE c.guild_id = old.guild_id
+                          AND old.carry_over > 0
+                        RETURNING old.carry_over
+                    ),
+                    -- 総プール：行が無ければ carry + amount で作成、あれば carry と今回分を加算
+                    total_pool AS (
+                        INSERT INTO race_trifecta_pools
+                        (guild_id, race_date, schedule_id, total_pool, carry_in)
+                        SELECT
+                            $1, $2, $3,
+                            COALESCE((SELECT carry_over FROM carry), 0) + $8,
+                            COALESCE((SELECT carry_over FROM carry), 0)
+                        FROM debit
+                        ON CONFLICT (guild_id, race_date, schedule_id)
+                        DO UPDATE SET
+                            total_pool = race_trifecta_pools.total_pool + EXCLUDED.total_pool,
+                            carry_in = race_trifecta_pools.carry_in + EXCLUDED.carry_in
+                        RETURNING total_pool
+                    ),
+                    combo_pool AS (
+                        INSERT INTO race_trifecta_combo_pools
+                        (guild_id, race_date, schedule_id,
+                         first_pet_id, second_pet_id, third_pet_id,
+                         total_amount)
+                        SELECT $1, $2, $3, $5, $6, $7, $8
+                        FROM debit
+                        ON CONFLICT (
+                            guild_id,
+                            race_date,
+                            schedule_id,
+                            first_pet_id,
+                            second_pet_id,
+                            third_pet_id
+                        )
+                        DO UPDATE SET total_amount =
+                            race_trifecta_combo_pools.total_amount + EXCLUDED.total_amount
+                        RETURNING total_amount
+                    )
+                    SELECT
+                        CASE
+                            WHEN chk.status = 'ok' AND NOT EXISTS (SELECT 1 FROM debit) THEN 'balance'
+                            ELSE chk.status
+                        END AS status,
+                        chk.spent,
+                        (SELECT balance FROM debit) AS balance_after,
+                        (SELECT total_pool FROM total_pool) AS total_pool,
+                        (SELECT total_amount FROM combo_pool) AS combo_pool
+                    FROM chk
                 """,
                     guild_id,
                     race_date,
@@ -3904,110 +3885,322 @@ class Database:
                     first_pet_id,
                     second_pet_id,
                     third_pet_id,
-                    amount
+                    amount,
+                    TRIFECTA_MAX_AMOUNT
                 )
 
-                # =========================
-                # ④ 総プール更新
-                # =========================
-                pool_row = await conn.fetchrow("""
-                    SELECT total_pool, carry_in
-                    FROM race_trifecta_pools
-                    WHERE guild_id=$1
-                      AND race_date=$2
-                      AND schedule_id=$3
-                    FOR UPDATE
-                """, guild_id, race_date, schedule_id)
+        if row["status"] == "no_user":
+            raise RuntimeError("ユーザー未登録")
 
-                # carry をロックして取得（※ 行が無い可能性あるので後で0扱い）
-                carry = await conn.fetchval("""
-                    SELECT carry_over
-                    FROM race_trifecta_carry
-                    WHERE guild_id=$1
+        if row["status"] == "balance":
+            raise RuntimeError("残高不足")
+
+        if row["status"] == "limit":
+            remaining = (TRIFECTA_MAX_AMOUNT - int(row["spent"])) // TRIFECTA_UNIT_PRICE
+            raise RuntimeError(f"3連単はこのレースで最大10口までです（残り {remaining}口）")
+
+        new_total = int(row["spent"]) + amount
+        remaining_units = (TRIFECTA_MAX_AMOUNT - new_total) // TRIFECTA_UNIT_PRICE
+
+        # コミット後にオッズ表・表示キャッシュを破棄
+        self.invalidate_trifecta_matrix(guild_id, schedule_id)
+        race_cache.bump(guild_id, schedule_id)
+
+        return {
+            "status": "ok",
+            "spent": amount,
+            "user_total": new_total,
+            "remaining_units": remaining_units,
+            "balance_after": row["balance_after"],
+            "total_pool": row["total_pool"],
+            "combo_pool": row["combo_pool"]
+        }
+
+    # ======================================================
+    # 3連単購入（Web）：検証・減算・記録をユーザー行ロック＋1ステートメントで
+    # ======================================================
+    async def buy_trifecta_bet(
+        self,
+        guild_id,
+        schedule_id,
+        user_id,
+        first_pet_id,
+        second_pet_id,
+        third_pet_id,
+        amount,
+        *,
+        max_amount,
+        total_max_amount
+    ):
+        """
+        Web の3連単オッズは race_trifecta_bets の合計から出すので、プール表は触らない。
+        max_amount      : このレースの3連単合計の上限
+        total_max_amount: このレースの単勝＋3連単の合算上限
+        return: {
+            "status": "ok" / "race_not_found" / "limit" / "total_limit" / "balance",
+            "race_date", "user_total"（今回分を含む3連単合計）, "balance_after"
+        }
+        """
+        await self._ensure_pool()
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # 先に users 行をロックしてから上限を数える
+                # （同じユーザーの同時購入で合計が古いスナップショットにならないように）
+                await self._lock_user_row(conn, str(guild_id), str(user_id))
+
+                row = await conn.fetchrow("""
+                    WITH race AS (
+                        SELECT id, race_date
+                        FROM race_schedules
+                        WHERE id = $1::INTEGER
+                          AND guild_id = $2::TEXT
+                    ),
+                    tri AS (
+                        SELECT COALESCE(SUM(b.amount), 0)::BIGINT AS total
+                        FROM race_trifecta_bets b
+                        JOIN race r ON r.race_date = b.race_date
+                        WHERE b.guild_id = $2
+                          AND b.schedule_id = $1
+                          AND b.user_id = $3::TEXT
+                    ),
+                    single AS (
+                        SELECT COALESCE(SUM(amount), 0)::BIGINT AS total
+                        FROM race_bets
+                        WHERE guild_id = $2
+                          AND schedule_id = $1
+                          AND user_id = $3
+                    ),
+                    usr AS (
+                        SELECT balance
+                        FROM users
+                        WHERE user_id = $3
+                          AND guild_id = $2
+                    ),
+                    chk AS (
+                        SELECT
+                            race.id,
+                            race.race_date,
+                            tri.total AS spent,
+                            CASE
+                                WHEN race.id IS NULL THEN 'race_not_found'
+                                WHEN tri.total + $7::INTEGER > $8::BIGINT THEN 'limit'
+                                WHEN single.total + tri.total + $7 > $9::BIGINT THEN 'total_limit'
+                                WHEN usr.balance IS NULL OR usr.balance < $7 THEN 'balance'
+                                ELSE 'ok'
+                            END AS status
+                        FROM tri
+                        CROSS JOIN single
+                        LEFT JOIN race ON TRUE
+                        LEFT JOIN usr ON TRUE
+                    ),
+                    debit AS (
+                        UPDATE users u
+                        SET balance = u.balance - $7
+                        FROM chk
+                        WHERE chk.status = 'ok'
+                          AND u.user_id = $3
+                          AND u.guild_id = $2
+                          AND u.balance >= $7
+                        RETURNING u.balance
+                    ),
+                    ledger AS (
+                        INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+                        SELECT $2, $3, -$7, balance, 'trifecta_bet', $1::TEXT
+                        FROM debit
+                    ),
+                    bet AS (
+                        INSERT INTO race_trifecta_bets
+                        (guild_id, race_date, schedule_id,
+                         user_id, first_pet_id, second_pet_id, third_pet_id, amount)
+                        SELECT $2, chk.race_date, chk.id, $3, $4::INTEGER, $5::INTEGER, $6::INTEGER, $7
+                        FROM chk, debit
+                    )
+                    SELECT
+                        CASE
+                            WHEN chk.status = 'ok' AND NOT EXISTS (SELECT 1 FROM debit) THEN 'balance'
+                            ELSE chk.status
+                        END AS status,
+                        chk.race_date,
+                        chk.spent + $7 AS user_total,
+                        (SELECT balance FROM debit) AS balance_after
+                    FROM chk
+                """,
+                    int(schedule_id),
+                    str(guild_id),
+                    str(user_id),
+                    int(first_pet_id),
+                    int(second_pet_id),
+                    int(third_pet_id),
+                    int(amount),
+                    int(max_amount),
+                    int(total_max_amount)
+                )
+
+        if row["status"] == "ok":
+            # コミット後にオッズ表・表示キャッシュを破棄
+            self.invalidate_trifecta_matrix(guild_id, schedule_id)
+            race_cache.bump(guild_id, schedule_id)
+
+        return dict(row)
+
+    async def buy_trifecta_bets(
+        self,
+        guild_id,
+        schedule_id,
+        bets,
+        *,
+        max_amount,
+        total_max_amount
+    ):
+        """
+        3連単購入のまとめ処理（グループコミット用）。同じレースの bet を1トランザクションで。
+        bets  : [(user_id, first_pet_id, second_pet_id, third_pet_id, amount), ...]（到着順）
+        return: bets と同じ並びの結果リスト（各要素は buy_trifecta_bet と同じ形）
+        """
+        await self._ensure_pool()
+        guild_id = str(guild_id)
+        schedule_id = int(schedule_id)
+        bets = [
+            (str(u), int(f), int(s), int(t), int(a))
+            for u, f, s, t, a in bets
+        ]
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+
+                race = await conn.fetchrow("""
+                    SELECT id, race_date
+                    FROM race_schedules
+                    WHERE id = $1
+                      AND guild_id = $2
+                """, schedule_id, guild_id)
+
+                if not race:
+                    return [{"status": "race_not_found"} for _ in bets]
+
+                race_date = race["race_date"]
+                user_ids = sorted({b[0] for b in bets})
+
+                # 残高ロック（ユーザー順に取ってデッドロックを避ける）
+                balance_rows = await conn.fetch("""
+                    SELECT user_id, balance
+                    FROM users
+                    WHERE guild_id = $1
+                      AND user_id = ANY($2::text[])
+                    ORDER BY user_id
                     FOR UPDATE
-                """, guild_id)
-                carry = int(carry or 0)
+                """, guild_id, user_ids)
+
+                # 3連単・単勝それぞれの購入済み合計
+                spent_rows = await conn.fetch("""
+                    SELECT user_id,
+                           SUM(amount) FILTER (WHERE kind = 'tri') AS tri,
+                           SUM(amount) FILTER (WHERE kind = 'single') AS single
+                    FROM (
+                        SELECT 'tri' AS kind, user_id, amount
+                        FROM race_trifecta_bets
+                        WHERE guild_id = $1
+                          AND race_date = $3
+                          AND schedule_id = $2
+                          AND user_id = ANY($4::text[])
+                        UNION ALL
+                        SELECT 'single', user_id, amount
+                        FROM race_bets
+                        WHERE guild_id = $1
+                          AND schedule_id = $2
+                          AND user_id = ANY($4::text[])
+                    ) x
+                    GROUP BY user_id
+                """, guild_id, schedule_id, race_date, user_ids)
+
+                balances = {r["user_id"]: r["balance"] for r in balance_rows}
+                tri_spent = {r["user_id"]: int(r["tri"] or 0) for r in spent_rows}
+                single_spent = {r["user_id"]: int(r["single"] or 0) for r in spent_rows}
+
+                # -------------------------
+                # 到着順に1件ずつ判定
+                # -------------------------
+                results = []
+                accepted = []
+
+                for user_id, first_id, second_id, third_id, amount in bets:
+                    user_total = tri_spent.get(user_id, 0) + amount
+                    balance = balances.get(user_id)
+
+                    if user_total > max_amount:
+                        status = "limit"
+                    elif single_spent.get(user_id, 0) + user_total > total_max_amount:
+                        status = "total_limit"
+                    elif balance is None or balance < amount:
+                        status = "balance"
+                    else:
+                        status = "ok"
+
+                    result = {"status": status, "race_date": race_date}
+
+                    if status == "ok":
+                        tri_spent[user_id] = user_total
+                        balances[user_id] = balance - amount
+
+                        result["user_total"] = user_total
+                        result["balance_after"] = balance - amount
+                        accepted.append(
+                            (user_id, first_id, second_id, third_id, amount, balance - amount)
+                        )
+
+                    results.append(result)
 
-                if not pool_row:
-                    # プール行が無い → carry + amount で新規作成
+                if accepted:
+                    # 減算・台帳・3連単登録を1ステートメントで
                     await conn.execute("""
-                        INSERT INTO race_trifecta_pools
-                        (guild_id, race_date, schedule_id, total_pool, carry_in)
-                        VALUES ($1,$2,$3,$4,$5)
+                        WITH b AS (
+                            SELECT *
+                            FROM unnest(
+                                $4::text[], $5::int[], $6::int[], $7::int[],
+                                $8::int[], $9::bigint[]
+                            ) WITH ORDINALITY AS t(
+                                user_id, first_pet_id, second_pet_id, third_pet_id,
+                                amount, balance_after, n
+                            )
+                        ),
+                        debit AS (
+                            UPDATE users u
+                            SET balance = u.balance - s.amount
+                            FROM (
+                                SELECT user_id, SUM(amount) AS amount
+                                FROM b
+                                GROUP BY user_id
+                            ) s
+                            WHERE u.user_id = s.user_id
+                              AND u.guild_id = $1
+                        ),
+                        ledger AS (
+                            INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason, ref)
+                            SELECT $1, user_id, -amount, balance_after, 'trifecta_bet', $2::INTEGER::TEXT
+                            FROM b
+                            ORDER BY n
+                        )
+                        INSERT INTO race_trifecta_bets
+                        (guild_id, race_date, schedule_id,
+                         user_id, first_pet_id, second_pet_id, third_pet_id, amount)
+                        SELECT $1, $3, $2,
+                               user_id, first_pet_id, second_pet_id, third_pet_id, amount
+                        FROM b
+                        ORDER BY n
                     """,
                         guild_id,
-                        race_date,
                         schedule_id,
-                        carry + amount,
-                        carry
-                    )
-                else:
-                    # プール行がある → まず carry があれば注入（carry_inも加算）
-                    if carry > 0:
-                        await conn.execute("""
-                            UPDATE race_trifecta_pools
-                            SET total_pool = total_pool + $1,
-                                carry_in  = carry_in  + $1
-                            WHERE guild_id=$2
-                              AND race_date=$3
-                              AND schedule_id=$4
-                        """, carry, guild_id, race_date, schedule_id)
-
-                    # 次に今回購入分を加算
-                    await conn.execute("""
-                        UPDATE race_trifecta_pools
-                        SET total_pool = total_pool + $1
-                        WHERE guild_id=$2
-                          AND race_date=$3
-                          AND schedule_id=$4
-                    """, amount, guild_id, race_date, schedule_id)
-
-                # carry を使ったらゼロクリア
-                if carry > 0:
-                    await conn.execute("""
-                        UPDATE race_trifecta_carry
-                        SET carry_over = 0
-                        WHERE guild_id=$1
-                    """, guild_id)
-
-                # =========================
-                # ⑤ 組み合わせ別プール更新
-                # =========================
-                await conn.execute("""
-                    INSERT INTO race_trifecta_combo_pools
-                    (guild_id, race_date, schedule_id,
-                     first_pet_id, second_pet_id, third_pet_id,
-                     total_amount)
-                    VALUES ($1,$2,$3,$4,$5,$6,$7)
-                    ON CONFLICT (
-                        guild_id,
                         race_date,
-                        schedule_id,
-                        first_pet_id,
-                        second_pet_id,
-                        third_pet_id
+                        *[list(col) for col in zip(*accepted)]
                     )
-                    DO UPDATE SET total_amount =
-                        race_trifecta_combo_pools.total_amount + $7
-                """,
-                    guild_id,
-                    race_date,
-                    schedule_id,
-                    first_pet_id,
-                    second_pet_id,
-                    third_pet_id,
-                    amount
-                )
 
-                remaining_units = (TRIFECTA_MAX_AMOUNT - new_total) // TRIFECTA_UNIT_PRICE
+        if accepted:
+            # コミット後にオッズ表・表示キャッシュを破棄
+            self.invalidate_trifecta_matrix(guild_id, schedule_id)
+            race_cache.bump(guild_id, schedule_id)
 
-                return {
-                    "status": "ok",
-                    "spent": amount,
-                    "user_total": new_total,
-                    "remaining_units": remaining_units,
-                    "balance_after": balance_row["balance"] - amount
-                }
+        return results
 
     # ======================================================
     # 3連単：精算処理（キャリー対応）
@@ -4020,8 +4213,10 @@ class Database:
         next_schedule_id=None  # キャリー先（同日次レース）
     ):
         guild_id = str(guild_id)
-        race_date = str(race_date)
         schedule_id = int(schedule_id)
+        # DATE 列なので date で渡す（"YYYY-MM-DD" も受け付ける）
+        if isinstance(race_date, str):
+            race_date = date.fromisoformat(race_date)
 
         await self._ensure_pool()
 
@@ -4066,24 +4261,60 @@ class Database:
                 total_pool = pool_row["total_pool"]
 
                 # =========================
-                # ③ 的中者取得
+                # ③ 的中馬券の払戻額（最大剰余法・整数）
+                # 各馬券 floor(プール × 購入額 / 的中総額) を配り、
+                # 余りは端数の大きい馬券から1ずつ → プールを過不足なく配分
                 # =========================
                 winners = await conn.fetch("""
-                    SELECT user_id, amount
-                    FROM race_trifecta_bets
-                    WHERE guild_id=$1
-                      AND race_date=$2
-                      AND schedule_id=$3
-                      AND first_pet_id=$4
-                      AND second_pet_id=$5
-                      AND third_pet_id=$6
+                    WITH w AS (
+                        SELECT
+                            id,
+                            user_id,
+                            amount,
+                            SUM(amount) OVER () AS winning_amount,
+                            ($7::bigint * amount) / SUM(amount) OVER () AS base,
+                            ($7::bigint * amount) % SUM(amount) OVER () AS rem
+                        FROM race_trifecta_bets
+                        WHERE guild_id=$1
+                          AND race_date=$2
+                          AND schedule_id=$3
+                          AND first_pet_id=$4
+                          AND second_pet_id=$5
+                          AND third_pet_id=$6
+                    ),
+                    ranked AS (
+                        SELECT
+                            *,
+                            SUM(base) OVER () AS base_total,
+                            ROW_NUMBER() OVER (ORDER BY rem DESC, id) AS rn
+                        FROM w
+                    ),
+                    paid AS (
+                        SELECT
+                            id,
+                            user_id,
+                            amount,
+                            winning_amount,
+                            base + CASE WHEN rn <= $7 - base_total THEN 1 ELSE 0 END AS payout
+                        FROM ranked
+                    ),
+                    marked AS (
+                        UPDATE race_trifecta_bets b
+                        SET payout = p.payout
+                        FROM paid p
+                        WHERE b.id = p.id
+                    )
+                    SELECT id, user_id, amount, winning_amount, payout
+                    FROM paid
+                    ORDER BY id
                 """,
                     guild_id,
                     race_date,
                     schedule_id,
                     first,
                     second,
-                    third
+                    third,
+                    total_pool
                 )
 
                 # =========================
@@ -4091,41 +4322,28 @@ class Database:
                 # =========================
                 if winners:
 
-                    total_winning_amount = sum(w["amount"] for w in winners)
-
-                    payouts = []
-
-                    for w in winners:
-                        share = total_pool * (w["amount"] / total_winning_amount)
-                        share = int(share)
-
-                        await conn.execute("""
-                            UPDATE users
-                            SET balance = balance + $1
-                            WHERE user_id=$2 AND guild_id=$3
-                        """, share, str(w["user_id"]), guild_id)
-
-                        payouts.append({
-                            "user_id": w["user_id"],
-                            "payout": share
-                        })
+                    # 同じユーザーの複数口はまとめて1回で入金
+                    await self.apply_balance_deltas(
+                        guild_id,
+                        [(w["user_id"], w["payout"]) for w in winners],
+                        floor=None,
+                        reason="trifecta_payout",
+                        ref=schedule_id,
+                        conn=conn
+                    )
 
-                    # =========================
-                    # 🔥 レースプールリセット
-                    # =========================
-                    await conn.execute("""
-                        UPDATE race_trifecta_pools
-                        SET total_pool = 0,
-                            carry_in = 0
-                        WHERE guild_id=$1
-                          AND race_date=$2
-                          AND schedule_id=$3
-                    """, guild_id, race_date, schedule_id)
+                    payouts = [
+                        {"user_id": w["user_id"], "payout": w["payout"]}
+                        for w in winners
+                    ]
 
-                    return {
+                    summary = {
                         "status": "hit",
-                        "payouts": payouts,
-                        "total_pool": total_pool
+                        "winning_amount": winners[0]["winning_amount"],
+                        "winning_bets": len(winners),
+                        "winners": len({w["user_id"] for w in winners}),
+                        "paid_total": sum(w["payout"] for w in winners),
+                        "carry_amount": 0
                     }
 
                 # =========================
@@ -4142,20 +4360,91 @@ class Database:
                             race_trifecta_carry.carry_over + $2
                     """, guild_id, total_pool)
 
-                    # 今レースプールはリセット
-                    await conn.execute("""
+                    payouts = []
+
+                    summary = {
+                        "status": "carry",
+                        "winning_amount": 0,
+                        "winning_bets": 0,
+                        "winners": 0,
+                        "paid_total": 0,
+                        "carry_amount": total_pool
+                    }
+
+                # =========================
+                # 🔥 レースプールリセット + 精算サマリー
+                # =========================
+                await conn.execute("""
+                    WITH reset AS (
                         UPDATE race_trifecta_pools
                         SET total_pool = 0,
                             carry_in = 0
                         WHERE guild_id=$1
                           AND race_date=$2
                           AND schedule_id=$3
-                    """, guild_id, race_date, schedule_id)
+                    )
+                    INSERT INTO race_trifecta_settlements (
+                        guild_id, race_date, schedule_id,
+                        first_pet_id, second_pet_id, third_pet_id,
+                        status, total_pool,
+                        winning_amount, winning_bets, winners,
+                        paid_total, carry_amount
+                    )
+                    VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
+                    ON CONFLICT (guild_id, race_date, schedule_id)
+                    DO UPDATE SET
+                        first_pet_id = EXCLUDED.first_pet_id,
+                        second_pet_id = EXCLUDED.second_pet_id,
+                        third_pet_id = EXCLUDED.third_pet_id,
+                        status = EXCLUDED.status,
+                        total_pool = EXCLUDED.total_pool,
+                        winning_amount = EXCLUDED.winning_amount,
+                        winning_bets = EXCLUDED.winning_bets,
+                        winners = EXCLUDED.winners,
+                        paid_total = EXCLUDED.paid_total,
+                        carry_amount = EXCLUDED.carry_amount,
+                        settled_at = NOW()
+                """,
+                    guild_id,
+                    race_date,
+                    schedule_id,
+                    first,
+                    second,
+                    third,
+                    summary["status"],
+                    total_pool,
+                    summary["winning_amount"],
+                    summary["winning_bets"],
+                    summary["winners"],
+                    summary["paid_total"],
+                    summary["carry_amount"]
+                )
 
+                if summary["status"] == "hit":
                     return {
-                        "status": "carry",
-                        "carry_amount": total_pool
+                        "status": "hit",
+                        "payouts": payouts,
+                        "total_pool": total_pool
                     }
+
+                return {
+                    "status": "carry",
+                    "carry_amount": total_pool
+                }
+
+    async def get_trifecta_settlement(self, guild_id, race_date, schedule_id):
+        """精算サマリー（未精算なら None）"""
+        if isinstance(race_date, str):
+            race_date = date.fromisoformat(race_date)
+
+        return await self._fetchrow("""
+            SELECT *
+            FROM race_trifecta_settlements
+            WHERE guild_id=$1
+              AND race_date=$2
+              AND schedule_id=$3
+        """, str(guild_id), race_date, int(schedule_id))
+
     # ======================================================
     # キャリー関係
     # ======================================================
@@ -4239,6 +4528,31 @@ class Database:
                   AND badge = $3
             """, guild_id, user_id, badge)
 
+    # ======================================================
+    # バッジ一括付与 / 一括削除（ロール単位）
+    # ======================================================
+    async def add_user_badges(self, guild_id: str, user_ids: list[str], badge: str) -> int:
+        await self._ensure_pool()
+        rows = await self._fetch("""
+            INSERT INTO user_badges (guild_id, user_id, badge)
+            SELECT $1, u, $3
+            FROM unnest($2::text[]) AS u
+            ON CONFLICT DO NOTHING
+            RETURNING user_id
+        """, str(guild_id), [str(u) for u in user_ids], badge)
+        return len(rows)
+
+    async def remove_user_badges(self, guild_id: str, user_ids: list[str], badge: str) -> int:
+        await self._ensure_pool()
+        rows = await self._fetch("""
+            DELETE FROM user_badges
+            WHERE guild_id = $1
+              AND user_id = ANY($2::text[])
+              AND badge = $3
+            RETURNING user_id
+        """, str(guild_id), [str(u) for u in user_ids], badge)
+        return len(rows)
+
     # ======================================================
     # 単勝：ユーザー購入口数取得
     # ======================================================
@@ -4887,11 +5201,15 @@ class Database:
 
 
     async def get_senryu_channels(self, guild_id: str):
-        return await self._fetch("""
-            SELECT channel_id
-            FROM senryu_channels
-            WHERE guild_id = $1
-        """, guild_id)
+        rows = await self._config.get(
+            ("senryu_channels", guild_id),
+            lambda: self._fetch("""
+                SELECT channel_id
+                FROM senryu_channels
+                WHERE guild_id = $1
+            """, guild_id)
+        )
+        return list(rows)
 
     async def toggle_senryu_channel(self, guild_id: str, channel_id: str):
         row = await self._fetchrow("""
@@ -4907,6 +5225,7 @@ class Database:
                 WHERE guild_id = $1
                   AND channel_id = $2
             """, guild_id, channel_id)
+            self._config.invalidate("senryu_channels", guild_id)
             return False
 
         await self._execute("""
@@ -4916,6 +5235,7 @@ class Database:
             )
             VALUES ($1, $2)
         """, guild_id, channel_id)
+        self._config.invalidate("senryu_channels", guild_id)
 
         return True
 
@@ -0,0 +1,466 @@
+# db_pool.py
+# ============================================================
+# 共有コネクションプール
+# - Bot（Database）と Web API が同じプールを使う
+# - サイズは環境変数で調整（DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE）
+# - 取得待ち時間・使用中コネクション数・SQL実行時間を集計
+# - SQLテンプレート別のレイテンシ分布 / 行数 / 呼び出し元（QueryStats）
+# - DATABASE_URL=ephemeral で使い捨てのローカル Postgres を起動（計測・検証用）
+# ============================================================
+
+import asyncio
+import atexit
+import bisect
+import collections
+import contextlib
+import glob
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncpg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+
+# これ以上待ったら「プール枯渇気味」としてログに出す
+SLOW_ACQUIRE_SEC = float(os.getenv("DB_SLOW_ACQUIRE_SEC", "0.5"))
+
+# これ以上かかった SQL はスロークエリとしてログに出す
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
+
+# ============================================================
+# SQL テンプレート別の集計
+# ============================================================
+_WS_RE = re.compile(r"\s+")
+_NUM_RE = re.compile(r"(?<![$\w])\d+(?:\.\d+)?")
+
+# レイテンシ分布のバケット上限（ms）
+LATENCY_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+
+def normalize_query(query: str) -> str:
+    """空白を潰し、埋め込み数値を ? にしてテンプレート化する"""
+    return _NUM_RE.sub("?", _WS_RE.sub(" ", query).strip())
+
+
+def find_caller() -> str:
+    """
+    SQL を投げた関数を「ファイル:関数名」で返す。
+    db_pool / contextlib と Database の共通ヘルパー（_fetch など）は飛ばす。
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        if (
+            filename not in ("db_pool.py", "contextlib.py")
+            and code.co_name not in ("_fetch", "_fetchrow", "_fetchval", "_execute")
+        ):
+            parent = os.path.basename(os.path.dirname(code.co_filename))
+            if parent in ("cogs", "hotel", "migrations"):
+                filename = f"{parent}/{filename}"
+            return f"{filename}:{code.co_name}"
+        frame = frame.f_back
+    return "?"
+
+
+class QueryStats:
+    """
+    SQL テンプレートごとに
+    ・回数 / 合計・最大時間 / レイテンシ分布
+    ・返した（更新した）行数
+    ・呼び出し元
+    を集計する。閾値を超えたものはスロークエリとしてログと直近一覧に残す。
+    """
+
+    def __init__(self, slow_ms: float = SLOW_QUERY_MS, keep_slow: int = 100):
+        self.slow_ms = slow_ms
+        self._templates: dict[str, dict] = {}
+        self.slow_log = collections.deque(maxlen=keep_slow)
+
+    def record(self, query: str, elapsed: float, rows: int, caller: str, exception=None):
+        template = normalize_query(query)
+        ms = elapsed * 1000
+
+        t = self._templates.get(template)
+        if t is None:
+            t = self._templates[template] = {
+                "count": 0,
+                "errors": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "rows": 0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                "callers": collections.Counter(),
+            }
+
+        t["count"] += 1
+        t["total_ms"] += ms
+        t["max_ms"] = max(t["max_ms"], ms)
+        t["rows"] += rows
+        t["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        t["callers"][caller] += 1
+        if exception is not None:
+            t["errors"] += 1
+
+        if ms >= self.slow_ms:
+            self.slow_log.append({
+                "at": time.time(),
+                "ms": round(ms, 1),
+                "rows": rows,
+                "caller": caller,
+                "query": template,
+            })
+            print(f"[SLOW QUERY] {ms:.1f}ms rows={rows} {caller} :: {template[:200]}")
+
+    def top(self, n: int = 10, order_by: str = "total_ms") -> list[dict]:
+        """order_by: total_ms / max_ms / avg_ms / count / rows"""
+        result = []
+        for template, t in self._templates.items():
+            result.append({
+                "query": template,
+                "count": t["count"],
+                "errors": t["errors"],
+                "total_ms": round(t["total_ms"], 1),
+                "avg_ms": round(t["total_ms"] / t["count"], 2),
+                "max_ms": round(t["max_ms"], 1),
+                "rows": t["rows"],
+                "histogram": dict(zip(
+                    [f"<={b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"],
+                    t["buckets"]
+                )),
+                "callers": t["callers"].most_common(3),
+            })
+
+        result.sort(key=lambda r: r[order_by], reverse=True)
+        return result[:n]
+
+    def reset(self):
+        self._templates.clear()
+        self.slow_log.clear()
+
+
+def _count_rows(method: str, result, args) -> int:
+    if method == "fetch":
+        return len(result) if result is not None else 0
+    if method in ("fetchrow", "fetchval"):
+        return 0 if result is None else 1
+    if method == "executemany":
+        return len(args[0]) if args else 0
+    # execute: "UPDATE 5" / "INSERT 0 3" の末尾
+    if isinstance(result, str):
+        last = result.rsplit(" ", 1)[-1]
+        return int(last) if last.isdigit() else 0
+    return 0
+
+
+class TimedConnection:
+    """
+    acquire() で渡すコネクションの代理。
+    fetch / fetchrow / fetchval / execute / executemany を計測し、
+    それ以外（transaction など）は元のコネクションへ委譲する。
+    """
+
+    def __init__(self, conn, pool: "InstrumentedPool"):
+        self._conn = conn
+        self._pool = pool
+
+    async def _run(self, method, query, args, kwargs):
+        caller = find_caller()
+        started = time.perf_counter()
+        result = None
+        exception = None
+        try:
+            result = await getattr(self._conn, method)(query, *args, **kwargs)
+            return result
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self._pool._on_query(
+                query,
+                time.perf_counter() - started,
+                _count_rows(method, result, args),
+                caller,
+                exception,
+            )
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run("fetch", query, args, kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run("fetchrow", query, args, kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run("fetchval", query, args, kwargs)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._run("execute", query, args, kwargs)
+
+    async def executemany(self, command, args, **kwargs):
+        return await self._run("executemany", command, (args,), kwargs)
+
+    async def copy_records_to_table(self, table_name, **kwargs):
+        # テーブル名をテンプレートとして集計（行数は "COPY n" から）
+        return await self._run("copy_records_to_table", table_name, (), kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class InstrumentedPool:
+    """
+    asyncpg.Pool の薄いラッパー。
+    ・acquire() の待ち時間と使用中数を記録
+    ・acquire() が返すコネクション（TimedConnection）で SQL 実行時間を記録
+    ・それ以外の属性は元の Pool にそのまま委譲
+    """
+
+    def __init__(self):
+        self._pool: asyncpg.Pool | None = None
+
+        self.in_use = 0
+        self.peak_in_use = 0
+
+        self._acquire = {"count": 0, "total_wait": 0.0, "max_wait": 0.0}
+        self._queries = {"count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0}
+
+        # SQL 完了ごとに呼ばれるフック（query, elapsed, rows, caller, exception）
+        self._query_hooks = []
+
+    async def open(self, dsn: str):
+        self._pool = await asyncpg.create_pool(
+            dsn=dsn,
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+        )
+        print(f"🔌 DBプール作成 min={POOL_MIN_SIZE} max={POOL_MAX_SIZE}")
+
+    def add_query_hook(self, hook):
+        """hook(query, elapsed, rows, caller, exception) を SQL 完了ごとに呼ぶ"""
+        self._query_hooks.append(hook)
+
+    def _on_query(self, query, elapsed, rows, caller, exception):
+        q = self._queries
+        q["count"] += 1
+        q["total_time"] += elapsed
+        q["max_time"] = max(q["max_time"], elapsed)
+        if exception is not None:
+            q["errors"] += 1
+
+        for hook in self._query_hooks:
+            try:
+                hook(query, elapsed, rows, caller, exception)
+            except Exception as e:
+                print("[DB POOL] query hook error:", repr(e))
+
+    # --------------------------------------------------
+    # acquire（待ち時間・使用中数を記録）
+    # --------------------------------------------------
+    @contextlib.asynccontextmanager
+    async def acquire(self, *, timeout=None):
+        started = time.perf_counter()
+
+        async with self._pool.acquire(timeout=timeout) as conn:
+            waited = time.perf_counter() - started
+
+            a = self._acquire
+            a["count"] += 1
+            a["total_wait"] += waited
+            a["max_wait"] = max(a["max_wait"], waited)
+
+            if waited >= SLOW_ACQUIRE_SEC:
+                print(
+                    f"[DB POOL] acquire waited={waited:.3f}s "
+                    f"in_use={self.in_use}/{POOL_MAX_SIZE}"
+                )
+
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            try:
+                yield TimedConnection(conn, self)
+            finally:
+                self.in_use -= 1
+
+    # --------------------------------------------------
+    # Pool 直呼び出し（asyncpg.Pool と同じ使い方）
+    # --------------------------------------------------
+    async def fetch(self, query, *args, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, timeout=timeout)
+
+    async def fetchrow(self, query, *args, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, timeout=timeout)
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, column=column, timeout=timeout)
+
+    async def execute(self, query, *args, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command, args, *, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.executemany(command, args, timeout=timeout)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def __getattr__(self, name):
+        # get_size() / get_idle_size() などは元の Pool へ
+        pool = self.__dict__.get("_pool")
+        if pool is None:
+            raise AttributeError(name)
+        return getattr(pool, name)
+
+    # --------------------------------------------------
+    # 集計
+    # --------------------------------------------------
+    def stats(self) -> dict:
+        a = self._acquire
+        q = self._queries
+        return {
+            "size": self._pool.get_size() if self._pool else 0,
+            "idle": self._pool.get_idle_size() if self._pool else 0,
+            "min_size": POOL_MIN_SIZE,
+            "max_size": POOL_MAX_SIZE,
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+            "acquire": {
+                "count": a["count"],
+                "avg_wait": round(a["total_wait"] / a["count"], 6) if a["count"] else 0.0,
+                "max_wait": round(a["max_wait"], 6),
+            },
+            "queries": {
+                "count": q["count"],
+                "errors": q["errors"],
+                "avg_time": round(q["total_time"] / q["count"], 6) if q["count"] else 0.0,
+                "max_time": round(q["max_time"], 6),
+            },
+        }
+
+
+# ============================================================
+# 使い捨てローカル Postgres
+# DATABASE_URL=ephemeral のとき、一時ディレクトリに initdb して起動し、
+# プロセス終了時に停止・削除する。本番と同じ Database / migrations が
+# そのまま動くので、ノートPCでの計測や動作確認に使う。
+# ・initdb / pg_ctl が PATH か /usr/lib/postgresql/*/bin に必要
+# ・initdb の仕様上 root では起動できない
+# ============================================================
+EPHEMERAL_DSN = "ephemeral"
+
+
+def _find_pg_bin(name: str) -> str:
+    path = shutil.which(name)
+    if path:
+        return path
+
+    candidates = sorted(glob.glob(f"/usr/lib/postgresql/*/bin/{name}"))
+    if candidates:
+        return candidates[-1]
+
+    raise RuntimeError(f"{name} が見つかりません（PostgreSQL サーバーが必要です）")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_ephemeral_postgres() -> str:
+    """一時クラスタを起動して DSN を返す"""
+    initdb = _find_pg_bin("initdb")
+    pg_ctl = _find_pg_bin("pg_ctl")
+
+    datadir = tempfile.mkdtemp(prefix="oasis_pg_")
+    port = _free_port()
+
+    subprocess.run(
+        [initdb, "-D", datadir, "-U", "postgres", "-A", "trust",
+         "-E", "UTF8", "--no-sync"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+    # 計測用なので耐障害性は切って速くする
+    options = (
+        f"-p {port} -k {datadir} -c listen_addresses=127.0.0.1 "
+        "-c fsync=off -c synchronous_commit=off -c full_page_writes=off"
+    )
+    subprocess.run(
+        [pg_ctl, "-D", datadir, "-o", options,
+         "-l", os.path.join(datadir, "postgres.log"), "-w", "start"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+    def stop():
+        subprocess.run(
+            [pg_ctl, "-D", datadir, "-m", "immediate", "stop"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(datadir, ignore_errors=True)
+
+    atexit.register(stop)
+
+    print(f"🧪 一時Postgres起動 port={port} dir={datadir}")
+    return f"postgresql://postgres@127.0.0.1:{port}/postgres"
+
+
+# ============================================================
+# プロセス内で1つだけ作る
+# ============================================================
+_shared_pool: InstrumentedPool | None = None
+
+# 共有プールに最初から付けておくテンプレート集計
+query_stats = QueryStats()
+_open_lock = asyncio.Lock()
+
+
+async def get_pool() -> InstrumentedPool:
+    """共有プールを返す（初回呼び出しで作成）"""
+    global _shared_pool
+
+    if _shared_pool is not None:
+        return _shared_pool
+
+    async with _open_lock:
+        if _shared_pool is None:
+            dsn = os.getenv("DATABASE_URL")
+            if not dsn:
+                raise RuntimeError("DATABASE_URL が設定されていません")
+
+            if dsn == EPHEMERAL_DSN:
+                dsn = await asyncio.to_thread(start_ephemeral_postgres)
+
+            pool = InstrumentedPool()
+            pool.add_query_hook(query_stats.record)
+            await pool.open(dsn)
+            _shared_pool = pool
+
+    return _shared_pool
+
+
+async def close_pool():
+    global _shared_pool
+
+    if _shared_pool is not None:
+        await _shared_pool.close()
+        _shared_pool = None
@@ -0,0 +1,93 @@
+# migrations/__init__.py
+# ============================================================
+# スキーママイグレーション
+# - schema_version テーブルに適用済みバージョンを記録
+# - migrations/vNNNN_*.py を番号順に適用
+# - 適用済みDBでは「バージョン確認1回」だけで終わる
+# ============================================================
+
+import importlib
+import pkgutil
+
+import asyncpg
+
+# Bot と Web API が同時に起動しても二重適用しないためのロックキー
+MIGRATION_LOCK_KEY = 0x6F617369
+
+
+def load_migrations() -> list:
+    """migrations/vNNNN_*.py を読み込んで VERSION 順に返す"""
+    modules = []
+
+    for info in pkgutil.iter_modules(__path__):
+        if not info.name.startswith("v"):
+            continue
+        modules.append(importlib.import_module(f"{__name__}.{info.name}"))
+
+    modules.sort(key=lambda m: m.VERSION)
+
+    versions = [m.VERSION for m in modules]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"マイグレーション番号が重複しています: {versions}")
+
+    return modules
+
+
+MIGRATIONS = load_migrations()
+LATEST_VERSION = MIGRATIONS[-1].VERSION if MIGRATIONS else 0
+
+
+async def get_schema_version(conn) -> int:
+    """適用済みの最新バージョン（未初期化なら0）"""
+    try:
+        return await conn.fetchval(
+            "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+        )
+    except asyncpg.exceptions.UndefinedTableError:
+        return 0
+
+
+async def run_migrations(pool) -> int:
+    """
+    未適用のマイグレーションを1トランザクションで適用する。
+    return: 適用後のスキーマバージョン
+    """
+    async with pool.acquire() as conn:
+
+        # 最新なら1往復で終了（通常の再起動はここ）
+        current = await get_schema_version(conn)
+        if current >= LATEST_VERSION:
+            return current
+
+        async with conn.transaction():
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock($1)",
+                MIGRATION_LOCK_KEY
+            )
+
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT NOW()
+                )
+            """)
+
+            # ロック待ちの間に別プロセスが適用済みの可能性がある
+            current = await get_schema_version(conn)
+
+            for m in MIGRATIONS:
+                if m.VERSION <= current:
+                    continue
+
+                print(f"🛠 マイグレーション v{m.VERSION:04d} {m.DESCRIPTION}")
+                await m.upgrade(conn)
+
+                await conn.execute("""
+                    INSERT INTO schema_version (version, description)
+                    VALUES ($1, $2)
+                """, m.VERSION, m.DESCRIPTION)
+
+                current = m.VERSION
+
+        return current
@@ -0,0 +1,631 @@
+# migrations/v0001_baseline.py
+# ============================================================
+# ベースライン
+# 旧 Database.init_db / init_jumbo_tables / ensure_race_* /
+# init_race_tables / web_api.ensure_schema が毎回起動時に
+# 行っていたテーブル作成・カラム補完をまとめたもの。
+# 既存DBに対しても安全に流せるよう、すべて IF NOT EXISTS で書く。
+# ============================================================
+
+VERSION = 1
+DESCRIPTION = "baseline schema"
+
+
+# =========================
+# テーブル作成
+# =========================
+CREATE_TABLES = """
+-- Users テーブル（ギルド別通貨管理）
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT NOT NULL,
+    guild_id TEXT NOT NULL,
+    balance INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, guild_id)
+);
+
+-- 給料ロールテーブル
+CREATE TABLE IF NOT EXISTS role_salaries (
+    role_id TEXT PRIMARY KEY,
+    salary INTEGER NOT NULL
+);
+
+-- Settings テーブル（1行固定）
+CREATE TABLE IF NOT EXISTS settings (
+    id INTEGER PRIMARY KEY,
+    admin_roles TEXT[],
+    currency_unit TEXT,
+    log_pay TEXT,
+    log_manage TEXT,
+    log_interview TEXT,
+    log_salary TEXT,
+    log_hotel TEXT,
+    log_backup TEXT
+);
+
+-- サブスク設定テーブル
+CREATE TABLE IF NOT EXISTS subscription_settings (
+    guild_id TEXT PRIMARY KEY,
+    standard_role TEXT,
+    standard_price INTEGER,
+    regular_role TEXT,
+    regular_price INTEGER,
+    premium_role TEXT,
+    premium_price INTEGER,
+    log_channel TEXT
+);
+
+-- 面接設定テーブル
+CREATE TABLE IF NOT EXISTS interview_settings (
+    guild_id TEXT PRIMARY KEY,
+    interviewer_role TEXT,
+    wait_role TEXT,
+    done_role TEXT,
+    reward_amount INTEGER,
+    log_channel TEXT
+);
+
+-- ホテル設定テーブル
+CREATE TABLE IF NOT EXISTS hotel_settings (
+    guild_id TEXT PRIMARY KEY,
+    manager_role TEXT,
+    log_channel TEXT,
+    sub_role TEXT,
+    ticket_price_1 INTEGER,
+    ticket_price_10 INTEGER,
+    ticket_price_30 INTEGER
+);
+
+-- ホテルチケット所持テーブル
+CREATE TABLE IF NOT EXISTS hotel_tickets (
+    user_id TEXT,
+    guild_id TEXT,
+    tickets INTEGER DEFAULT 0,
+    PRIMARY KEY (user_id, guild_id)
+);
+
+-- ホテルルーム管理テーブル
+CREATE TABLE IF NOT EXISTS hotel_rooms (
+    channel_id TEXT PRIMARY KEY,
+    guild_id TEXT,
+    owner_id TEXT,
+    expire_at TIMESTAMP
+);
+
+-- おあしすっち：ユーザーごとの育成枠
+CREATE TABLE IF NOT EXISTS oasistchi_users (
+    user_id TEXT PRIMARY KEY,
+    slots INTEGER NOT NULL DEFAULT 1
+);
+
+-- おあしすっち本体
+CREATE TABLE IF NOT EXISTS oasistchi_pets (
+    id SERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    egg_type TEXT,
+    adult_key TEXT,
+    name TEXT,
+    growth REAL DEFAULT 0,
+    hunger INTEGER DEFAULT 100,
+    happiness INTEGER DEFAULT 50,
+    poop BOOLEAN DEFAULT FALSE,
+    notified_hatch BOOLEAN DEFAULT FALSE,
+    last_pet REAL DEFAULT 0,
+    last_interaction REAL DEFAULT 0,
+    last_tick REAL DEFAULT 0,
+    last_hunger_tick REAL DEFAULT 0,
+    last_unhappy_tick REAL DEFAULT 0,
+    notify_pet BOOLEAN DEFAULT FALSE,
+    notify_care BOOLEAN DEFAULT FALSE,
+    notify_food BOOLEAN DEFAULT FALSE,
+    training_count INTEGER DEFAULT 0
+);
+
+-- レース設定（ギルド別）
+CREATE TABLE IF NOT EXISTS race_settings (
+    guild_id TEXT PRIMARY KEY,
+    result_channel_id TEXT
+);
+
+-- おあしすっち：図鑑（成体履歴）
+CREATE TABLE IF NOT EXISTS oasistchi_dex (
+    user_id TEXT NOT NULL,
+    adult_key TEXT NOT NULL,
+    obtained_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, adult_key)
+);
+
+-- おあしすっち：通知設定
+CREATE TABLE IF NOT EXISTS oasistchi_notify (
+    user_id TEXT PRIMARY KEY,
+    notify_poop BOOLEAN NOT NULL DEFAULT TRUE,
+    notify_food BOOLEAN NOT NULL DEFAULT TRUE,
+    notify_pet_ready BOOLEAN NOT NULL DEFAULT TRUE
+);
+
+-- レース関連テーブル
+CREATE TABLE IF NOT EXISTS race_schedules (
+    id SERIAL PRIMARY KEY,
+    race_no INTEGER NOT NULL,
+    race_time TIME NOT NULL,
+    entry_open_minutes INTEGER NOT NULL,
+    max_entries INTEGER NOT NULL DEFAULT 8,
+    entry_fee INTEGER NOT NULL DEFAULT 50000,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS race_entries (
+    id SERIAL PRIMARY KEY,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    pet_id INTEGER NOT NULL,
+    paid BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE (race_date, schedule_id, pet_id)
+);
+
+-- 馬券：個別馬券（パリミュチュエル方式）
+CREATE TABLE IF NOT EXISTS race_bets (
+    id SERIAL PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    pet_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- レースごとの総プール
+CREATE TABLE IF NOT EXISTS race_pools (
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    total_pool INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, race_date, schedule_id)
+);
+
+-- レース結果テーブル
+CREATE TABLE IF NOT EXISTS race_results (
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    pet_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    final_score DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (guild_id, race_date, schedule_id, pet_id)
+);
+
+-- ペット別プール
+CREATE TABLE IF NOT EXISTS race_pet_pools (
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    pet_id INTEGER NOT NULL,
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, race_date, schedule_id, pet_id)
+);
+
+-- 3連単：サーバー単位キャリー
+CREATE TABLE IF NOT EXISTS race_trifecta_carry (
+    guild_id TEXT PRIMARY KEY,
+    carry_over BIGINT NOT NULL DEFAULT 0
+);
+
+-- 3連単：総プール（キャリー対応）
+CREATE TABLE IF NOT EXISTS race_trifecta_pools (
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    total_pool INTEGER NOT NULL DEFAULT 0,
+    carry_in INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, race_date, schedule_id)
+);
+
+-- 3連単：組み合わせ別プール
+CREATE TABLE IF NOT EXISTS race_trifecta_combo_pools (
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    first_pet_id INTEGER NOT NULL,
+    second_pet_id INTEGER NOT NULL,
+    third_pet_id INTEGER NOT NULL,
+    total_amount INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (
+        guild_id,
+        race_date,
+        schedule_id,
+        first_pet_id,
+        second_pet_id,
+        third_pet_id
+    )
+);
+
+-- 3連単：ユーザー別ベット
+CREATE TABLE IF NOT EXISTS race_trifecta_bets (
+    id SERIAL PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    first_pet_id INTEGER NOT NULL,
+    second_pet_id INTEGER NOT NULL,
+    third_pet_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- ユーザーバッジ
+CREATE TABLE IF NOT EXISTS user_badges (
+    guild_id TEXT NOT NULL,
+    user_id  TEXT NOT NULL,
+    badge    TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (guild_id, user_id, badge)
+);
+
+-- 自動自己紹介設定
+CREATE TABLE IF NOT EXISTS intro_auto_settings (
+    guild_id TEXT PRIMARY KEY,
+    category_ids TEXT,
+    watch_channels TEXT
+);
+
+-- 自己紹介URL
+CREATE TABLE IF NOT EXISTS intro_urls (
+    guild_id TEXT,
+    user_id TEXT,
+    message_url TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+-- 探索クールタイム
+CREATE TABLE IF NOT EXISTS oasistchi_explore (
+    user_id TEXT PRIMARY KEY,
+    last_explore BIGINT
+);
+
+-- スタンプカード
+CREATE TABLE IF NOT EXISTS stamp_cards (
+    guild_id BIGINT,
+    user_id BIGINT,
+    stamps INT DEFAULT 0,
+    last_stamp_date DATE,
+    PRIMARY KEY (guild_id, user_id)
+);
+
+-- 匿名チケット
+CREATE TABLE IF NOT EXISTS anon_tickets (
+    thread_id BIGINT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    guild_id BIGINT NOT NULL,
+    closed BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- 匿名チケット通し番号
+CREATE TABLE IF NOT EXISTS anon_ticket_counter (
+    guild_id BIGINT PRIMARY KEY,
+    counter BIGINT DEFAULT 0
+);
+
+-- 匿名相談パネル
+CREATE TABLE IF NOT EXISTS anon_ticket_panels (
+    panel_id BIGINT PRIMARY KEY,
+    guild_id BIGINT,
+    channel_id BIGINT,
+    title TEXT,
+    body TEXT,
+    first_msg TEXT,
+    role_ids BIGINT[],
+    log_channel_id BIGINT
+);
+
+-- ロール付与パネル
+CREATE TABLE IF NOT EXISTS role_panels (
+    message_id BIGINT PRIMARY KEY,
+    guild_id BIGINT,
+    panel_data JSONB
+);
+
+-- VC転送
+CREATE TABLE IF NOT EXISTS temp_vc_settings (
+    guild_id TEXT NOT NULL,
+    source_vc_id TEXT NOT NULL,
+    max_users INTEGER NOT NULL,
+    names_a TEXT[],
+    names_b TEXT[],
+    name_c TEXT,
+    PRIMARY KEY (guild_id, source_vc_id)
+);
+
+CREATE TABLE IF NOT EXISTS temp_created_vcs (
+    guild_id TEXT NOT NULL,
+    channel_id TEXT PRIMARY KEY,
+    source_vc_id TEXT NOT NULL
+);
+
+-- おあしすっち人気投票
+CREATE TABLE IF NOT EXISTS oasistchi_popularity_votes (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    rank_1 TEXT NOT NULL,
+    rank_2 TEXT NOT NULL,
+    rank_3 TEXT NOT NULL,
+    rank_4 TEXT NOT NULL,
+    rank_5 TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (guild_id, user_id)
+);
+
+-- 川柳
+CREATE TABLE IF NOT EXISTS senryu_channels (
+    guild_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    PRIMARY KEY (guild_id, channel_id)
+);
+
+-- 総選挙
+CREATE TABLE IF NOT EXISTS sosenkyo_votes (
+    guild_id TEXT NOT NULL,
+    voter_id TEXT NOT NULL,
+    category_no INT NOT NULL,
+    target_user_id TEXT NOT NULL,
+    comment TEXT,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (guild_id, voter_id, category_no)
+);
+
+-- 参加 / 退出ログ
+CREATE TABLE IF NOT EXISTS user_join_leave_logs (
+    id SERIAL PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    roles TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- イベントカレンダー
+CREATE TABLE IF NOT EXISTS event_calendar (
+    id SERIAL PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    event_name TEXT NOT NULL,
+    start_date DATE NOT NULL,
+    end_date DATE NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- 年末ジャンボ：開催設定
+CREATE TABLE IF NOT EXISTS jumbo_config (
+    guild_id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    deadline TIMESTAMP NOT NULL,
+    is_open BOOLEAN NOT NULL DEFAULT TRUE,
+    winning_number VARCHAR(6),
+    prize_paid BOOLEAN DEFAULT FALSE,
+    panel_channel_id TEXT,
+    panel_message_id TEXT
+);
+
+-- 年末ジャンボ：購入番号
+CREATE TABLE IF NOT EXISTS jumbo_entries (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    number VARCHAR(6) NOT NULL,
+    PRIMARY KEY (guild_id, number)
+);
+
+-- 年末ジャンボ：当選者
+CREATE TABLE IF NOT EXISTS jumbo_winners (
+    guild_id TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    number VARCHAR(6) NOT NULL,
+    user_id TEXT NOT NULL,
+    match_count INTEGER,
+    prize BIGINT DEFAULT 0,
+    PRIMARY KEY (guild_id, rank, number)
+);
+
+-- レースWeb機能（race_schedules / race_entries と衝突回避の別名）
+CREATE TABLE IF NOT EXISTS web_races (
+    race_id TEXT PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    race_time TIMESTAMP NOT NULL,
+    status TEXT NOT NULL,
+    result_channel_id TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS web_race_entries (
+    race_id TEXT NOT NULL,
+    pet_id TEXT NOT NULL,
+    owner_id TEXT NOT NULL,
+    pet_key TEXT NOT NULL,
+    condition TEXT NOT NULL,
+    speed INTEGER NOT NULL,
+    power INTEGER NOT NULL,
+    stamina INTEGER NOT NULL,
+    odds REAL NOT NULL,
+    PRIMARY KEY (race_id, pet_id)
+);
+
+CREATE TABLE IF NOT EXISTS web_race_bets (
+    race_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    pet_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- アクセスログ
+CREATE TABLE IF NOT EXISTS site_access_stats (
+    date DATE PRIMARY KEY,
+    count INTEGER DEFAULT 0
+);
+"""
+
+
+# =========================
+# カラム補完
+# =========================
+ADD_COLUMNS = """
+ALTER TABLE settings
+    ADD COLUMN IF NOT EXISTS log_pay TEXT,
+    ADD COLUMN IF NOT EXISTS log_manage TEXT,
+    ADD COLUMN IF NOT EXISTS log_interview TEXT,
+    ADD COLUMN IF NOT EXISTS log_salary TEXT,
+    ADD COLUMN IF NOT EXISTS log_hotel TEXT,
+    ADD COLUMN IF NOT EXISTS log_backup TEXT,
+    ADD COLUMN IF NOT EXISTS oasistchi_race_reset_date DATE,
+    ADD COLUMN IF NOT EXISTS race_result_channel_id TEXT,
+    ADD COLUMN IF NOT EXISTS guild_id TEXT;
+
+ALTER TABLE hotel_settings
+    ADD COLUMN IF NOT EXISTS category_ids TEXT[];
+
+ALTER TABLE oasistchi_notify
+    ADD COLUMN IF NOT EXISTS notify_poop BOOLEAN NOT NULL DEFAULT TRUE,
+    ADD COLUMN IF NOT EXISTS notify_food BOOLEAN NOT NULL DEFAULT TRUE,
+    ADD COLUMN IF NOT EXISTS notify_pet_ready BOOLEAN NOT NULL DEFAULT TRUE;
+
+ALTER TABLE oasistchi_pets
+    ADD COLUMN IF NOT EXISTS training_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS raced_today BOOLEAN DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS race_candidate BOOLEAN DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS base_speed INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS base_stamina INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS base_power INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS train_speed INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS train_stamina INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS train_power INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS speed INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS stamina INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS power INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_poop_tick REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_growth_tick REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_hunger_tick REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_unhappy_tick REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS next_poop_check_at REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS poop_notified_at REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS pet_ready_at REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS pet_ready_notified_at REAL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS fixed_adult_key TEXT,
+    ADD COLUMN IF NOT EXISTS poop_alerted BOOLEAN NOT NULL DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS hunger_alerted BOOLEAN NOT NULL DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS pet_ready_alerted_for REAL NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS passive_skill TEXT;
+
+ALTER TABLE race_schedules
+    ADD COLUMN IF NOT EXISTS guild_id TEXT,
+    ADD COLUMN IF NOT EXISTS race_date DATE,
+    ADD COLUMN IF NOT EXISTS distance TEXT,
+    ADD COLUMN IF NOT EXISTS surface TEXT,
+    ADD COLUMN IF NOT EXISTS condition TEXT,
+    ADD COLUMN IF NOT EXISTS race_finished BOOLEAN DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS result_sent BOOLEAN DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS lottery_done BOOLEAN DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS locked BOOLEAN DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS reward_paid BOOLEAN DEFAULT FALSE;
+
+ALTER TABLE race_entries
+    ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending',
+    ADD COLUMN IF NOT EXISTS rank INTEGER,
+    ADD COLUMN IF NOT EXISTS score REAL,
+    ADD COLUMN IF NOT EXISTS debug_json JSONB,
+    ADD COLUMN IF NOT EXISTS guild_id TEXT,
+    ADD COLUMN IF NOT EXISTS entry_fee INTEGER DEFAULT 50000;
+
+ALTER TABLE race_bets
+    ADD COLUMN IF NOT EXISTS race_id TEXT,
+    ADD COLUMN IF NOT EXISTS guild_id TEXT,
+    ADD COLUMN IF NOT EXISTS schedule_id INTEGER,
+    ADD COLUMN IF NOT EXISTS race_date DATE;
+
+ALTER TABLE race_results
+    ADD COLUMN IF NOT EXISTS debug JSONB,
+    ADD COLUMN IF NOT EXISTS guild_id TEXT,
+    ADD COLUMN IF NOT EXISTS race_date DATE,
+    ADD COLUMN IF NOT EXISTS schedule_id INTEGER,
+    ADD COLUMN IF NOT EXISTS pet_id INTEGER,
+    ADD COLUMN IF NOT EXISTS rank INTEGER,
+    ADD COLUMN IF NOT EXISTS final_score DOUBLE PRECISION,
+    ADD COLUMN IF NOT EXISTS user_id TEXT,
+    ADD COLUMN IF NOT EXISTS position INTEGER,
+    ADD COLUMN IF NOT EXISTS reward INTEGER DEFAULT 0;
+
+ALTER TABLE race_trifecta_bets
+    ADD COLUMN IF NOT EXISTS dm_sent BOOLEAN NOT NULL DEFAULT FALSE;
+
+ALTER TABLE jumbo_config
+    ADD COLUMN IF NOT EXISTS paid_ranks INTEGER[];
+
+ALTER TABLE stamp_cards
+    ADD COLUMN IF NOT EXISTS page INT DEFAULT 1;
+
+-- race_time を TEXT に統一（旧DBは TIME 型）
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_name = 'race_schedules'
+          AND column_name = 'race_time'
+          AND data_type <> 'text'
+    ) THEN
+        ALTER TABLE race_schedules
+        ALTER COLUMN race_time TYPE TEXT
+        USING race_time::text;
+    END IF;
+END$$;
+"""
+
+
+# =========================
+# 既存データ補正（1回だけ流せばよいもの）
+# =========================
+BACKFILL = """
+UPDATE stamp_cards SET page = 1 WHERE page IS NULL;
+
+UPDATE race_schedules SET lottery_done = FALSE WHERE lottery_done IS NULL;
+UPDATE race_schedules SET locked = FALSE WHERE locked IS NULL;
+UPDATE race_schedules SET reward_paid = FALSE WHERE reward_paid IS NULL;
+UPDATE race_schedules SET race_date = CURRENT_DATE WHERE race_date IS NULL;
+
+UPDATE hotel_settings SET category_ids = ARRAY[]::TEXT[] WHERE category_ids IS NULL;
+
+UPDATE race_results rr
+SET guild_id = rs.guild_id
+FROM race_schedules rs
+WHERE rr.schedule_id = rs.id
+  AND rr.race_date   = rs.race_date
+  AND (rr.guild_id IS NULL OR rr.guild_id = '');
+
+-- 💩 うんち：次回チェック時刻が未設定の個体
+UPDATE oasistchi_pets
+SET next_poop_check_at = EXTRACT(EPOCH FROM NOW()) + 3600
+WHERE next_poop_check_at = 0;
+
+-- 🤚 なでなで：last_pet があるのに予定時刻が無い個体
+UPDATE oasistchi_pets
+SET pet_ready_at = last_pet + 10800
+WHERE last_pet > 0 AND pet_ready_at = 0;
+
+-- Settings 初期化行
+INSERT INTO settings
+    (id, admin_roles, currency_unit,
+     log_pay, log_manage, log_interview, log_salary, log_hotel, log_backup)
+VALUES
+    (1, ARRAY[]::TEXT[], 'rrc',
+     NULL, NULL, NULL, NULL, NULL, NULL)
+ON CONFLICT (id) DO NOTHING;
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(CREATE_TABLES)
+    await conn.execute(ADD_COLUMNS)
+    await conn.execute(BACKFILL)
@@ -0,0 +1,54 @@
+# migrations/v0002_balance_ledger.py
+# ============================================================
+# 通貨台帳
+# - balance_ledger: 残高の増減を1件ずつ追記（id は単調増加）
+# - balance_checkpoints: 圧縮済み台帳の集計（ユーザー別）
+# users.balance は「チェックポイント + 以降の台帳合計」の投影。
+# 既存残高は reason='opening' の1行として台帳に取り込む。
+# ============================================================
+
+VERSION = 2
+DESCRIPTION = "balance ledger"
+
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    delta BIGINT NOT NULL,
+    balance_after BIGINT NOT NULL,
+    reason TEXT NOT NULL,
+    ref TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- ユーザー別の履歴・照合用
+CREATE INDEX IF NOT EXISTS idx_balance_ledger_user
+ON balance_ledger (guild_id, user_id, id);
+
+-- 圧縮で畳んだ台帳の合計
+-- ledger_id までの台帳は balance に集約済み
+CREATE TABLE IF NOT EXISTS balance_checkpoints (
+    guild_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    balance BIGINT NOT NULL DEFAULT 0,
+    ledger_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (guild_id, user_id)
+);
+"""
+
+
+BACKFILL = """
+-- 既存残高を開始残高として取り込む
+INSERT INTO balance_ledger (guild_id, user_id, delta, balance_after, reason)
+SELECT guild_id, user_id, balance, balance, 'opening'
+FROM users
+WHERE balance <> 0;
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(CREATE_TABLES)
+    await conn.execute(BACKFILL)
@@ -0,0 +1,82 @@
+# migrations/v0003_race_indexes.py
+# ============================================================
+# レース・馬券テーブルの複合インデックス
+# 主キー以外のインデックスが無く、締切・精算・API の
+# ほぼ全クエリが Seq Scan になっていたもの。
+# race_trifecta_combo_pools は主キーが組み合わせキーそのものなので追加なし。
+# ============================================================
+
+VERSION = 3
+DESCRIPTION = "race and betting indexes"
+
+
+CREATE_INDEXES = """
+-- =========================
+-- race_entries
+-- =========================
+-- 抽選・締切・結果（guild_id, race_date, schedule_id, status）
+CREATE INDEX IF NOT EXISTS idx_race_entries_race_status
+ON race_entries (guild_id, race_date, schedule_id, status);
+
+-- schedule_id だけで引くもの（返金・API の出走表など）
+CREATE INDEX IF NOT EXISTS idx_race_entries_schedule_status
+ON race_entries (schedule_id, status);
+
+-- 同日の重複エントリーチェック
+CREATE INDEX IF NOT EXISTS idx_race_entries_pet_date
+ON race_entries (pet_id, race_date);
+
+CREATE INDEX IF NOT EXISTS idx_race_entries_user_date
+ON race_entries (user_id, race_date);
+
+-- ランキング（1着のみ）
+CREATE INDEX IF NOT EXISTS idx_race_entries_wins
+ON race_entries (guild_id, schedule_id, pet_id)
+WHERE rank = 1 AND status = 'selected';
+
+-- =========================
+-- race_schedules
+-- =========================
+CREATE INDEX IF NOT EXISTS idx_race_schedules_guild_date
+ON race_schedules (guild_id, race_date, race_no);
+
+-- =========================
+-- race_bets
+-- =========================
+CREATE INDEX IF NOT EXISTS idx_race_bets_race_user
+ON race_bets (guild_id, race_date, schedule_id, user_id);
+
+-- 精算（schedule_id + 1着 pet_id）
+CREATE INDEX IF NOT EXISTS idx_race_bets_schedule_pet
+ON race_bets (schedule_id, pet_id);
+
+-- =========================
+-- race_trifecta_bets
+-- =========================
+CREATE INDEX IF NOT EXISTS idx_race_trifecta_bets_race_user
+ON race_trifecta_bets (guild_id, race_date, schedule_id, user_id);
+
+-- 的中者検索（組み合わせキー）
+CREATE INDEX IF NOT EXISTS idx_race_trifecta_bets_combo
+ON race_trifecta_bets (
+    guild_id, race_date, schedule_id,
+    first_pet_id, second_pet_id, third_pet_id
+);
+
+-- 購入DM未送信（10秒ごとの監視）
+CREATE INDEX IF NOT EXISTS idx_race_trifecta_bets_undelivered
+ON race_trifecta_bets (id)
+WHERE dm_sent = FALSE;
+
+-- =========================
+-- race_results
+-- =========================
+-- finalize_race の ON CONFLICT (race_date, schedule_id, pet_id) 用
+-- （schedule_id は全ギルドで一意なので主キーと矛盾しない）
+CREATE UNIQUE INDEX IF NOT EXISTS uq_race_results_race_pet
+ON race_results (race_date, schedule_id, pet_id);
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(CREATE_INDEXES)
@@ -0,0 +1,29 @@
+# migrations/v0004_race_probabilities.py
+# ============================================================
+# レース勝率（Monte Carlo 推定）の保存先
+# 抽選確定後に1回だけ計算し、Web は schedule_id で1行引くだけ。
+# - win / top3: {pet_id: 確率}
+# - trifecta:   {"1着-2着-3着": 確率}（8頭なら 8P3 = 336 通り）
+# ============================================================
+
+VERSION = 4
+DESCRIPTION = "race probabilities"
+
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS race_probabilities (
+    schedule_id INTEGER PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    n_sims INTEGER NOT NULL,
+    seed BIGINT NOT NULL,
+    win JSONB NOT NULL,
+    top3 JSONB NOT NULL,
+    trifecta JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(CREATE_TABLES)
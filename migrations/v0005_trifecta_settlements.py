@@ -0,0 +1,38 @@
+# migrations/v0005_trifecta_settlements.py
+# ============================================================
+# 3連単の精算結果
+# - race_trifecta_settlements: レースごとの精算サマリー（1行）
+#   後から払戻額・的中数を見るときに再計算しなくてよい
+# - race_trifecta_bets.payout: 馬券ごとの払戻額（的中のみ、外れは NULL）
+# ============================================================
+
+VERSION = 5
+DESCRIPTION = "trifecta settlements"
+
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS race_trifecta_settlements (
+    guild_id TEXT NOT NULL,
+    race_date DATE NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    first_pet_id INTEGER NOT NULL,
+    second_pet_id INTEGER NOT NULL,
+    third_pet_id INTEGER NOT NULL,
+    status TEXT NOT NULL,               -- 'hit' / 'carry'
+    total_pool BIGINT NOT NULL,
+    winning_amount BIGINT NOT NULL DEFAULT 0,
+    winning_bets INTEGER NOT NULL DEFAULT 0,
+    winners INTEGER NOT NULL DEFAULT 0,
+    paid_total BIGINT NOT NULL DEFAULT 0,
+    carry_amount BIGINT NOT NULL DEFAULT 0,
+    settled_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (guild_id, race_date, schedule_id)
+);
+
+ALTER TABLE race_trifecta_bets
+    ADD COLUMN IF NOT EXISTS payout INTEGER;
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(CREATE_TABLES)
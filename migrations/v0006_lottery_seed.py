@@ -0,0 +1,18 @@
+# migrations/v0006_lottery_seed.py
+# ============================================================
+# 抽選の乱数シードを記録（監査用）
+# 同じシード・同じ pending 一覧なら同じ抽選結果を再現できる。
+# ============================================================
+
+VERSION = 6
+DESCRIPTION = "race lottery seed"
+
+
+ALTER_TABLES = """
+ALTER TABLE race_schedules
+    ADD COLUMN IF NOT EXISTS lottery_seed BIGINT;
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(ALTER_TABLES)
@@ -0,0 +1,76 @@
+# migrations/v0007_pet_race_stats.py
+# ============================================================
+# ペット別・距離別の通算成績（ランキング・戦績用の集計表）
+# - finalize_race が結果保存と同じステートメントで加算する
+# - 既存の履歴はここで1回だけ集計（Database.rebuild_pet_race_stats でやり直せる）
+# ランキングは (guild_id, distance, wins) の索引で上位 N 件を引くだけになる。
+# ============================================================
+
+VERSION = 7
+DESCRIPTION = "pet race stats"
+
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS pet_race_stats (
+    guild_id TEXT NOT NULL,
+    pet_id INTEGER NOT NULL,
+    distance TEXT NOT NULL,
+    starts INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0,
+    podiums INTEGER NOT NULL DEFAULT 0,       -- 3着以内
+    earnings BIGINT NOT NULL DEFAULT 0,       -- オーナー賞金の合計
+    last_schedule_id INTEGER,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (guild_id, pet_id, distance)
+);
+
+-- ランキング（距離別・勝利数順）
+CREATE INDEX IF NOT EXISTS idx_pet_race_stats_ranking
+ON pet_race_stats (guild_id, distance, wins DESC)
+WHERE wins > 0;
+
+-- 戦績（ペット別）
+CREATE INDEX IF NOT EXISTS idx_pet_race_stats_pet
+ON pet_race_stats (pet_id, guild_id);
+"""
+
+
+# $1: guild_id（NULL なら全ギルド）
+DELETE_STATS = """
+DELETE FROM pet_race_stats
+WHERE $1::text IS NULL OR guild_id = $1
+"""
+
+# 着順が付いた出走（race_entries）から集計。賞金は race_results から
+REBUILD_STATS = """
+INSERT INTO pet_race_stats
+(guild_id, pet_id, distance, starts, wins, podiums, earnings, last_schedule_id)
+SELECT
+    re.guild_id,
+    re.pet_id,
+    rs.distance,
+    COUNT(*),
+    COUNT(*) FILTER (WHERE re.rank = 1),
+    COUNT(*) FILTER (WHERE re.rank <= 3),
+    COALESCE(SUM(rr.reward), 0),
+    MAX(re.schedule_id)
+FROM race_entries re
+JOIN race_schedules rs
+  ON rs.id = re.schedule_id
+LEFT JOIN race_results rr
+  ON rr.race_date = re.race_date
+ AND rr.schedule_id = re.schedule_id
+ AND rr.pet_id = re.pet_id
+WHERE re.status = 'selected'
+  AND re.rank IS NOT NULL
+  AND re.guild_id IS NOT NULL
+  AND rs.distance IS NOT NULL
+  AND ($1::text IS NULL OR re.guild_id = $1)
+GROUP BY re.guild_id, re.pet_id, rs.distance
+"""
+
+
+async def upgrade(conn):
+    await conn.execute(CREATE_TABLES)
+    await conn.execute(DELETE_STATS, None)
+    await conn.execute(REBUILD_STATS, None)
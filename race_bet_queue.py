@@ -0,0 +1,103 @@
+# race_bet_queue.py
+# ============================================================
+# 馬券購入のグループコミット（締切直前の集中対策）
+# - 同じレース（キー）に数ミリ秒以内に届いた購入を1バッチにまとめる
+# - バッチは handler(key, items) で1トランザクションとして処理し、
+#   items と同じ並びの結果を各呼び出し元へ返す（受付/拒否は1件ずつ）
+# - 同じキーのバッチは1つずつ。処理中に届いた分は次のバッチに溜まる
+# ============================================================
+
+import asyncio
+
+
+class GroupCommitQueue:
+    """
+    submit(key, item) で投入し、自分の item の結果を待つ。
+    handler は async def handler(key, items) -> [result, ...]。
+    例外を出したらそのバッチの全員に同じ例外を返す。
+    """
+
+    def __init__(self, handler, window_ms: float = 5, max_batch: int = 200, name: str = "bet_queue"):
+        self.handler = handler
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.name = name
+
+        # key -> 受付中のバッチ [(item, future), ...]
+        self._pending = {}
+        # key -> 同じキーのバッチを順番に流すためのロック
+        self._locks = {}
+        # key -> そのロックを待っている/持っているバッチ数（0 になったらロックを捨てる）
+        self._lock_users = {}
+        # 実行中のタスク（GC で消えないように持っておく）
+        self._tasks = set()
+
+    # --------------------------------------------------
+    # 投入
+    # --------------------------------------------------
+    async def submit(self, key, item):
+        future = asyncio.get_running_loop().create_future()
+
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = []
+            self._spawn(self._flush_later(key, batch))
+
+        batch.append((item, future))
+
+        # 上限に達したら待たずに流す
+        if len(batch) >= self.max_batch:
+            del self._pending[key]
+            self._spawn(self._run(key, batch))
+
+        return await future
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # --------------------------------------------------
+    # 実行
+    # --------------------------------------------------
+    async def _flush_later(self, key, batch):
+        await asyncio.sleep(self.window)
+
+        # 上限で先に流れていたら何もしない
+        if self._pending.get(key) is not batch:
+            return
+
+        del self._pending[key]
+        await self._run(key, batch)
+
+    async def _run(self, key, batch):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._lock_users[key] = self._lock_users.get(key, 0) + 1
+
+        try:
+            async with lock:
+                await self._run_locked(key, batch)
+        finally:
+            # レースごとにロックが溜まらないよう、最後の1つが抜けたら捨てる
+            # （release 直後で起こされ待ちのバッチがいる間は残す）
+            self._lock_users[key] -= 1
+            if self._lock_users[key] == 0:
+                del self._lock_users[key]
+                del self._locks[key]
+
+    async def _run_locked(self, key, batch):
+        items = [item for item, _ in batch]
+
+        try:
+            results = await self.handler(key, items)
+        except Exception as e:
+            print(f"[{self.name} ERROR] key={key} size={len(items)} err={e!r}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            # 呼び出し元が切断済み（キャンセル）でもコミットは済んでいる
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,434 @@
+# race_engine.py
+# ============================================================
+# レースシミュレーター（配列版）
+# - 出走馬を列ごとの配列（struct-of-arrays）にまとめる
+# - パッシブは「ステータス倍率ベクトル」に前計算
+# - 乱数はまとめて引き、1回の呼び出しで何千レースでも回せる
+#
+# Database.simulate_race はここの simulate_race を呼ぶ。
+# 同じ乱数列（random.seed）なら従来のループ版と同じ結果になる。
+# ============================================================
+
+import functools
+import random
+from typing import NamedTuple
+
+import numpy as np
+
+# db は race_engine を import するので、属性は呼び出し時に引く
+import db
+
+# 距離ごとの能力バランス（speed/power は速度への寄与、stamina は消耗）
+DISTANCE_BALANCE = {
+    "短距離": {"speed": 1.4, "power": 0.8, "stamina": 0.5},
+    "マイル": {"speed": 1.2, "power": 1.2, "stamina": 0.8},
+    "中距離": {"speed": 0.9, "power": 1.3, "stamina": 1.3},
+    "長距離": {"speed": 0.6, "power": 1.0, "stamina": 1.6},
+}
+
+STAMINA_LOSS_BASE = 50
+STAMINA_OUT_PENALTY = 0.6
+RAND_MIN = 0.95
+RAND_MAX = 1.05
+GUTS_RATE_MAX = 0.10
+
+# speed / stamina / power の並び
+STATS = ("speed", "stamina", "power")
+
+
+# ============================================================
+# パッシブ（スキル）コンパイラ
+# PASSIVE_SKILLS（db.py）はデータのまま、種別ごとの効き方はこの表で決める。
+# 新しい種別は PASSIVE_TYPES に1行足せばよい（if 分岐は増やさない）。
+#
+# scope:     "target"  → passive["target"] の1ステータスに passive["multiplier"]
+#            "all"     → 3ステータスすべてに passive["multiplier"]
+#            "effects" → passive["effects"] の {ステータス: 倍率}
+# race:      レース条件。passive[キー] == race[キー] のときだけ発動
+# entry:     出走馬ごとの条件。"gate" は枠番一致、"same_adult" は同族あり
+# chance:    passive["chance"] の確率で発動
+# rank_step: 倍率 = 1 + 人気順 × rank_step（passive["multiplier"] の代わり）
+# ============================================================
+PASSIVE_TYPES = {
+    "stat":         {"scope": "target"},
+    "all":          {"scope": "all"},
+    "trade":        {"scope": "effects"},
+    "gate_number":  {"scope": "all", "entry": "gate"},
+    "surface":      {"scope": "all", "race": "surface"},
+    "distance":     {"scope": "all", "race": "distance"},
+    "same_adult":   {"scope": "all", "entry": "same_adult"},
+    "chance_boost": {"scope": "all", "chance": True},
+    "odds_rank":    {"scope": "all", "rank_step": 0.02},
+}
+
+NO_EFFECT = (1.0, 1.0, 1.0)
+
+
+class CompiledPassive(NamedTuple):
+    """1スキル × 1レース条件（距離・馬場）に対して前計算した効果"""
+    key: str
+    mult: tuple          # (speed, stamina, power)。レース条件不一致なら NO_EFFECT
+    scope: tuple         # rank_step で倍率をかけるステータス（bool × 3）
+    entry: str | None    # 出走馬ごとの条件
+    entry_value: object  # entry == "gate" のときの枠番
+    chance: float        # 0 なら常時
+    rank_step: float | None
+
+
+@functools.lru_cache(maxsize=None)
+def compile_passive(passive_key, distance, surface):
+    """
+    スキルを (倍率ベクトル, 出走馬条件, 発動確率) に変換する。
+    (スキル, 距離, 馬場) ごとにキャッシュ。スキル無し・不明なら None。
+    """
+    passive = db.PASSIVE_SKILLS.get(passive_key)
+    if not passive:
+        return None
+
+    spec = PASSIVE_TYPES.get(passive["type"], {})
+    scope = spec.get("scope")
+
+    if scope == "target":
+        scope_mask = tuple(k == passive["target"] for k in STATS)
+        mult = tuple(passive["multiplier"] if s else 1.0 for s in scope_mask)
+    elif scope == "all":
+        scope_mask = (True, True, True)
+        mult = (passive.get("multiplier", 1.0),) * 3
+    elif scope == "effects":
+        scope_mask = tuple(k in passive["effects"] for k in STATS)
+        mult = tuple(passive["effects"].get(k, 1.0) for k in STATS)
+    else:
+        # 未知の種別：効果なし（パッシブ持ちとしては扱う）
+        scope_mask = (False, False, False)
+        mult = NO_EFFECT
+
+    # レース条件（距離・馬場）はここで確定させる
+    race_key = spec.get("race")
+    if race_key:
+        current = {"distance": distance, "surface": surface}[race_key]
+        if current != passive[race_key]:
+            mult = NO_EFFECT
+
+    entry = spec.get("entry")
+
+    return CompiledPassive(
+        key=passive_key,
+        mult=mult,
+        scope=scope_mask,
+        entry=entry,
+        entry_value=passive.get(entry) if entry else None,
+        chance=passive["chance"] if spec.get("chance") else 0.0,
+        rank_step=spec.get("rank_step"),
+    )
+
+
+def resolve_passive(compiled: CompiledPassive, context: dict):
+    """
+    出走馬ごとの条件を当てはめる。
+    context: gate / same_adult_exists / odds_rank
+    return: (倍率 (speed, stamina, power), 発動確率)
+    """
+    if compiled.entry == "gate" and context.get("gate") != compiled.entry_value:
+        return NO_EFFECT, 0.0
+
+    if compiled.entry == "same_adult" and not context.get("same_adult_exists"):
+        return NO_EFFECT, 0.0
+
+    if compiled.rank_step is not None:
+        m = 1 + context.get("odds_rank", 1) * compiled.rank_step
+        return tuple(m if s else 1.0 for s in compiled.scope), compiled.chance
+
+    return compiled.mult, compiled.chance
+
+
+def describe_passive(compiled: CompiledPassive) -> dict:
+    """プレビュー・デバッグ表示用"""
+    return {
+        "key": compiled.key,
+        "speed": compiled.mult[0],
+        "stamina": compiled.mult[1],
+        "power": compiled.mult[2],
+        "condition": compiled.entry,
+        "chance": compiled.chance,
+        "active": compiled.mult != NO_EFFECT or compiled.rank_step is not None,
+    }
+
+
+class RaceField:
+    """
+    1レース分の出走馬を配列化したもの。
+    一度作れば simulate_many で何度でも回せる。
+    """
+
+    def __init__(self, entries, race):
+        self.distance = race["distance"]
+        self.surface = race["surface"]
+
+        self.balance = DISTANCE_BALANCE.get(self.distance)
+        if not self.balance:
+            raise ValueError(f"不明な距離: {self.distance}")
+
+        self.entries = list(entries)
+        n = len(self.entries)
+        self.n = n
+
+        self.pet_ids = [e["pet_id"] for e in self.entries]
+        self.user_ids = [e.get("user_id") for e in self.entries]
+        self.passives = [e.get("passive_skill") for e in self.entries]
+
+        # (n, 3) speed / stamina / power
+        self.base = np.array(
+            [[e["speed"] or 0, e["stamina"] or 0, e["power"] or 0] for e in self.entries],
+            dtype=np.float64
+        ).reshape(n, 3)
+
+        happiness = np.array(
+            [e.get("happiness", 0) or 0 for e in self.entries],
+            dtype=np.float64
+        )
+        self.guts_rate = (happiness / 100) * GUTS_RATE_MAX
+
+        # 同族判定：同じ adult_key に別の pet_id がいるか（O(n)）
+        groups: dict = {}
+        for e in self.entries:
+            groups.setdefault(e["adult_key"], set()).add(e["pet_id"])
+        self.same_adult = np.array(
+            [len(groups[e["adult_key"]]) > 1 for e in self.entries],
+            dtype=bool
+        )
+
+        # パッシブ → 倍率ベクトル
+        mult = np.ones((n, 3), dtype=np.float64)
+        chance = np.zeros(n, dtype=np.float64)
+        has_passive = np.zeros(n, dtype=bool)
+
+        for i, e in enumerate(self.entries):
+            compiled = compile_passive(
+                e.get("passive_skill"), self.distance, self.surface
+            )
+            if compiled is None:
+                continue
+
+            mult[i], chance[i] = resolve_passive(compiled, {
+                "gate": e.get("gate"),
+                "same_adult_exists": bool(self.same_adult[i]),
+            })
+            has_passive[i] = True
+
+        self.mult = mult
+        self.chance = chance
+        self.has_passive = has_passive
+
+    def passive_preview(self):
+        """
+        出走馬ごとのパッシブ倍率（Web の出走表・デバッグ表示用）。
+        return: [{pet_id, speed, stamina, power, chance, has_passive}, ...]
+        """
+        return [
+            {
+                "pet_id": self.pet_ids[i],
+                "speed": float(self.mult[i, 0]),
+                "stamina": float(self.mult[i, 1]),
+                "power": float(self.mult[i, 2]),
+                "chance": float(self.chance[i]),
+                "has_passive": bool(self.has_passive[i]),
+            }
+            for i in range(self.n)
+        ]
+
+    # --------------------------------------------------
+    # 乱数
+    # --------------------------------------------------
+    def draw_python(self, rng=random):
+        """
+        従来のループ版と同じ順番で random から引く（結果一致用）。
+        1頭ごとに [勝負師判定] → 根性判定 → 揺らぎ
+        return: (chance_u, guts_u, rand_factor) いずれも shape (n,)
+        """
+        chance_u = np.ones(self.n)
+        guts_u = np.empty(self.n)
+        rand_factor = np.empty(self.n)
+
+        for i in range(self.n):
+            if self.chance[i] > 0:
+                chance_u[i] = rng.random()
+            guts_u[i] = rng.random()
+            rand_factor[i] = rng.uniform(RAND_MIN, RAND_MAX)
+
+        return chance_u, guts_u, rand_factor
+
+    def draw_numpy(self, n_races: int, generator: np.random.Generator):
+        """まとめて引く（Monte Carlo 用）。shape (n_races, n)"""
+        shape = (n_races, self.n)
+        chance_u = generator.random(shape)
+        guts_u = generator.random(shape)
+        rand_factor = RAND_MIN + (RAND_MAX - RAND_MIN) * generator.random(shape)
+        return chance_u, guts_u, rand_factor
+
+    # --------------------------------------------------
+    # スコア計算（shape (n,) でも (R, n) でも可）
+    # --------------------------------------------------
+    def score(self, chance_u, guts_u, rand_factor):
+        # 勝負師：発動しなかった馬は倍率 1
+        fired = chance_u < self.chance
+        always = self.chance == 0
+        active = fired | always
+
+        mult = np.where(active[..., None], self.mult, 1.0)
+        stats = self.base * mult
+
+        # パッシブ持ちは従来どおり int 切り捨て
+        stats = np.where(self.has_passive[:, None], np.trunc(stats), stats)
+
+        speed = stats[..., 0]
+        stamina = stats[..., 1]
+        power = stats[..., 2]
+
+        b = self.balance
+        run = speed * b["speed"] + power * b["power"]
+
+        stamina_after = stamina - STAMINA_LOSS_BASE * b["stamina"]
+        run = np.where(stamina_after <= 0, run * STAMINA_OUT_PENALTY, run)
+
+        guts = guts_u < self.guts_rate
+
+        return {
+            "score": run * rand_factor,
+            "stats": stats,
+            "stamina_after": stamina_after,
+            "guts": guts,
+        }
+
+    # --------------------------------------------------
+    # 1レース（従来の simulate_race と同じ戻り値）
+    # --------------------------------------------------
+    def simulate(self, rng=random):
+        chance_u, guts_u, rand_factor = self.draw_python(rng)
+        out = self.score(chance_u, guts_u, rand_factor)
+
+        scores = out["score"]
+        stats = out["stats"]
+
+        results = []
+        for i, e in enumerate(self.entries):
+            final_score = float(scores[i])
+
+            debug_data = {
+                "base_speed": e["speed"],
+                "after_passive_speed": self._after_passive(stats, e, i, 0),
+
+                "base_power": e["power"],
+                "after_passive_power": self._after_passive(stats, e, i, 2),
+
+                "base_stamina": e["stamina"],
+                "after_passive_stamina": self._after_passive(stats, e, i, 1),
+
+                "stamina_after": float(out["stamina_after"][i]),
+
+                "rand": float(rand_factor[i]),
+                "same_adult": bool(self.same_adult[i]),
+                "passive": self.passives[i],
+                "distance": self.distance,
+                "surface": self.surface,
+                "guts": bool(out["guts"][i]),
+
+                "final_score": final_score
+            }
+
+            results.append({
+                "pet_id": e["pet_id"],
+                "user_id": e["user_id"],
+                "score": final_score,
+                "debug": debug_data
+            })
+
+        results.sort(key=lambda x: x["score"], reverse=True)
+
+        for i, r in enumerate(results):
+            r["rank"] = i + 1
+
+        return results
+
+    def _after_passive(self, stats, e, i, col):
+        # パッシブ無しは元の値そのまま、有りは int（従来どおり）
+        if not self.has_passive[i]:
+            return e[STATS[col]]
+        return int(stats[i, col])
+
+    # --------------------------------------------------
+    # 多数レース（着順インデックスを返す）
+    # --------------------------------------------------
+    def simulate_many(self, n_races: int, seed=None):
+        """
+        n_races 回まとめて走らせる。
+        return: order shape (n_races, n)
+                order[r, k] = r回目のレースで k+1 着だった馬の添字
+        """
+        generator = np.random.default_rng(seed)
+        out = self.score(*self.draw_numpy(n_races, generator))
+
+        # 同点は出走順（従来の安定ソートと同じ）
+        return np.argsort(-out["score"], axis=1, kind="stable")
+
+
+def simulate_race(entries, race, rng=random):
+    """Database.simulate_race の中身"""
+    return RaceField(entries, race).simulate(rng)
+
+
+# ============================================================
+# Monte Carlo 確率推定
+# ============================================================
+def estimate_probabilities(entries, race, n_sims: int, seed: int):
+    """
+    実際のレースモデルを n_sims 回走らせて確率を数える。
+    return: {
+        "win":      {pet_id: 1着確率},
+        "top3":     {pet_id: 3着以内確率},
+        "trifecta": {"a-b-c": 3連単確率}   # nP3 通りすべて（0 も含む）
+    }
+    """
+    field = RaceField(entries, race)
+    n = field.n
+    pet_ids = field.pet_ids
+
+    if n == 0:
+        return {"win": {}, "top3": {}, "trifecta": {}}
+
+    order = field.simulate_many(n_sims, seed=seed)
+
+    # 1着
+    win = np.bincount(order[:, 0], minlength=n) / n_sims
+
+    # 3着以内
+    top_k = min(3, n)
+    top3 = np.bincount(order[:, :top_k].ravel(), minlength=n) / n_sims
+
+    result = {
+        "win": {pet_ids[i]: float(win[i]) for i in range(n)},
+        "top3": {pet_ids[i]: float(top3[i]) for i in range(n)},
+        "trifecta": {},
+    }
+
+    if n < 3:
+        return result
+
+    # 3連単：(1着, 2着, 3着) を1つの整数にして数える
+    code = (order[:, 0] * n + order[:, 1]) * n + order[:, 2]
+    counts = np.bincount(code, minlength=n ** 3).reshape(n, n, n) / n_sims
+
+    for a in range(n):
+        for b in range(n):
+            if b == a:
+                continue
+            for c in range(n):
+                if c == a or c == b:
+                    continue
+                key = trifecta_key(pet_ids[a], pet_ids[b], pet_ids[c])
+                result["trifecta"][key] = float(counts[a, b, c])
+
+    return result
+
+
+def trifecta_key(first, second, third) -> str:
+    return f"{first}-{second}-{third}"
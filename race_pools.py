@@ -0,0 +1,158 @@
+# race_pools.py
+# ============================================================
+# 単勝プールのメモリ集計（パリミュチュエル）
+# - キー: (guild_id, race_date, schedule_id)
+# - 正は race_pools / race_pet_pools（DB）。メモリはその写し
+# - 馬券購入のコミット後に add() で加算 → オッズ表示は DB を読まない
+# - 起動時・締切時に DB と突き合わせ、ずれていれば DB に合わせる
+# Bot と Web API が同じプロセスなので、モジュール単位で1つ共有する。
+# ============================================================
+
+import asyncio
+
+
+class PoolAggregator:
+
+    def __init__(self):
+        # key -> {"total": int, "pets": {pet_id: int}}
+        self._pools = {}
+        # 読み込み中のキー -> 読み込み中に add() があったか
+        self._loading = {}
+        self._load_locks = {}
+
+    @staticmethod
+    def make_key(guild_id, race_date, schedule_id):
+        return (str(guild_id), race_date, int(schedule_id))
+
+    # --------------------------------------------------
+    # 読み出し（2回目以降はメモリだけ）
+    # --------------------------------------------------
+    async def get(self, db, guild_id, race_date, schedule_id):
+        """return: (total_pool, {pet_id: total_amount})"""
+        key = self.make_key(guild_id, race_date, schedule_id)
+
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = await self._load(db, key)
+
+        return pool["total"], pool["pets"]
+
+    def add(self, guild_id, race_date, schedule_id, pet_id, amount: int):
+        """DB コミット後に呼ぶ（未読み込みのレースは次の get で DB から読む）"""
+        key = self.make_key(guild_id, race_date, schedule_id)
+
+        if key in self._loading:
+            # 読み込み中のスナップショットに入っていない可能性 → 読み直させる
+            self._loading[key] = True
+            return
+
+        pool = self._pools.get(key)
+        if pool is None:
+            return
+
+        pool["total"] += amount
+        pool["pets"][int(pet_id)] = pool["pets"].get(int(pet_id), 0) + amount
+
+    # --------------------------------------------------
+    # 破棄（確定後・日付切り替え時）
+    # --------------------------------------------------
+    def drop(self, guild_id, race_date, schedule_id):
+        """確定したレースをメモリから外す（以降の get は DB から読み直し）"""
+        self._drop(self.make_key(guild_id, race_date, schedule_id))
+
+    def evict_before(self, race_date) -> int:
+        """race_date より前の日付のレースをすべて外す。return: 外したレース数"""
+        # date / 'YYYY-MM-DD' のどちらでも比べられるように文字列で
+        cutoff = str(race_date)
+        keys = [
+            key for key in set(self._pools) | set(self._load_locks)
+            if str(key[1]) < cutoff
+        ]
+
+        for key in keys:
+            self._drop(key)
+
+        return len(keys)
+
+    def _drop(self, key):
+        self._pools.pop(key, None)
+
+        # 読み込み中のロックは残す（_refresh 側で使い終わる）
+        lock = self._load_locks.get(key)
+        if lock is not None and not lock.locked():
+            del self._load_locks[key]
+
+    # --------------------------------------------------
+    # DB 読み込み・突き合わせ
+    # --------------------------------------------------
+    async def _load(self, db, key):
+        pool = self._pools.get(key)
+        if pool is not None:
+            return pool
+        return await self._refresh(db, key)
+
+    async def _refresh(self, db, key):
+        """DB から読み直してメモリを置き換える（同じキーは1つずつ）"""
+        lock = self._load_locks.setdefault(key, asyncio.Lock())
+
+        async with lock:
+            while True:
+                self._loading[key] = False
+                try:
+                    guild_id, race_date, schedule_id = key
+                    total, pets = await db.get_pool_data(guild_id, race_date, schedule_id)
+                finally:
+                    dirty = self._loading.pop(key)
+
+                # 読み込み中に購入があったら、その分が入った状態で読み直す
+                if not dirty:
+                    break
+
+            pool = {"total": total, "pets": dict(pets)}
+            self._pools[key] = pool
+            return pool
+
+    async def verify(self, db, guild_id, race_date, schedule_id) -> bool:
+        """
+        メモリと DB を比較。ずれていれば DB の値に置き換える。
+        return: 一致していたか（未読み込みなら読み込んで True）
+        """
+        key = self.make_key(guild_id, race_date, schedule_id)
+
+        current = self._pools.get(key)
+        if current is None:
+            await self._refresh(db, key)
+            return True
+
+        before = {
+            "total": current["total"],
+            "pets": {k: v for k, v in current["pets"].items() if v},
+        }
+
+        fresh = await self._refresh(db, key)
+
+        ok = (
+            before["total"] == fresh["total"]
+            and before["pets"] == {k: v for k, v in fresh["pets"].items() if v}
+        )
+
+        if not ok:
+            print(
+                f"[POOL MISMATCH] key={key} "
+                f"memory={before['total']} db={fresh['total']}"
+            )
+
+        return ok
+
+    async def warm(self, db, race_date) -> int:
+        """指定日の全レースを読み込む（起動時）。return: 読み込んだレース数"""
+        rows = await db.get_race_pool_keys(race_date)
+
+        for r in rows:
+            await self.verify(db, r["guild_id"], r["race_date"], r["schedule_id"])
+
+        return len(rows)
+
+
+# プロセス内で共有
+pool_aggregator = PoolAggregator()
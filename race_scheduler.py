@@ -0,0 +1,131 @@
+# race_scheduler.py
+# ============================================================
+# 締切スケジューラー（レース用）
+# - (締切時刻, 種類, キー) を min-heap で持ち、次の締切まで眠る
+# - 締切が来たら種類ごとのハンドラーを呼ぶ（抽選・確定・結果送信など）
+# - 状態の正は DB。起動時・日付変更時は DB から heap を作り直す
+# ポーリングしないので、締切が無い間は DB に触らない。
+# ============================================================
+
+import asyncio
+import heapq
+import itertools
+import time
+import traceback
+
+
+class DeadlineScheduler:
+    """
+    schedule(when, kind, key) で登録、on(kind, handler) でハンドラー登録。
+    handler は async def handler(key)。例外を出したら retry_sec 後に再実行。
+    同じ (kind, key) を再登録すると前の登録は無効（締切の付け替え）。
+    """
+
+    def __init__(self, name: str = "scheduler", retry_sec: float = 30):
+        self.name = name
+        self.retry_sec = retry_sec
+
+        self._heap = []
+        self._seq = itertools.count()
+        # (kind, key) -> 有効な seq（heap 上の古い登録は取り出し時に捨てる）
+        self._live = {}
+        self._handlers = {}
+
+        self._wake = asyncio.Event()
+        self._task = None
+
+    # --------------------------------------------------
+    # 登録
+    # --------------------------------------------------
+    def on(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    def schedule(self, when: float, kind: str, key):
+        """when: UNIX 秒（過去なら即実行）"""
+        seq = next(self._seq)
+        self._live[(kind, key)] = seq
+        heapq.heappush(self._heap, (when, seq, kind, key))
+
+        # 先頭が変わったかもしれないので眠りを起こす
+        self._wake.set()
+
+    def cancel(self, kind: str, key):
+        self._live.pop((kind, key), None)
+
+    def cancel_where(self, predicate):
+        """predicate(kind, key) が真の登録をすべて取り消す"""
+        for kind, key in list(self._live):
+            if predicate(kind, key):
+                del self._live[(kind, key)]
+
+    def pending(self) -> list:
+        """有効な登録を締切順に [(when, kind, key), ...]（デバッグ表示用）"""
+        return sorted(
+            (when, kind, key)
+            for when, seq, kind, key in self._heap
+            if self._live.get((kind, key)) == seq
+        )
+
+    # --------------------------------------------------
+    # 実行
+    # --------------------------------------------------
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        print(f"[{self.name}] started")
+
+        while True:
+            self._wake.clear()
+
+            # 取り消し済みの先頭を捨てる
+            while self._heap:
+                when, seq, kind, key = self._heap[0]
+                if self._live.get((kind, key)) == seq:
+                    break
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                await self._wake.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, seq, kind, key = heapq.heappop(self._heap)
+            del self._live[(kind, key)]
+
+            await self._fire(kind, key)
+
+    async def _fire(self, kind, key):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            print(f"[{self.name}] no handler kind={kind} key={key}")
+            return
+
+        try:
+            await handler(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[{self.name} ERROR] kind={kind} key={key} err={e!r}")
+            traceback.print_exc()
+
+            # 後から登録し直されていなければリトライ
+            if (kind, key) not in self._live:
+                self.schedule(time.time() + self.retry_sec, kind, key)
@@ -0,0 +1,190 @@
+# race_stream.py
+# ============================================================
+# レースのライブ配信（Server-Sent Events）
+# - レースごとに producer を1つだけ動かし、接続中の全クライアントへ配る
+# - producer は変更通知（race_cache.bump）かフェーズ切り替え時刻で起き、
+#   snapshot を1回作って前回との差分だけを送る
+#     phase    : {"phase", "status"}       status = open / locked / racing / finished
+#     odds     : {"total_pool", "pets"}    pets は変わった馬だけ {pet_id: {"odds", "pool"}}
+#     trifecta : {"total_pool", "combos"}  combos は変わった組み合わせだけ {"a-b-c": {"pool", "odds"}}
+# - 接続直後は snapshot（全体）を1回送る
+# 見ている人がいなくなったら producer も止める。
+# ============================================================
+
+import asyncio
+import contextlib
+import itertools
+import json
+import time
+
+
+RACE_STREAM_DEBOUNCE = 0.2   # 連続した購入をまとめて1回で読む（秒）
+RACE_STREAM_RETRY = 5        # snapshot 失敗時の再試行間隔（秒）
+RACE_STREAM_QUEUE = 100      # クライアントごとの未送信上限（超えたら切断）
+
+
+def format_event(name: str, data, event_id=None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {name}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+def _changed(prev: dict, cur: dict) -> dict:
+    """cur のうち prev と違うもの（消えたキーは None）"""
+    changed = {k: v for k, v in cur.items() if prev.get(k) != v}
+    for k in prev.keys() - cur.keys():
+        changed[k] = None
+    return changed
+
+
+def diff_states(prev: dict, cur: dict) -> list:
+    """return: [(event 名, data), ...]"""
+    events = []
+
+    if (prev["phase"], prev["status"]) != (cur["phase"], cur["status"]):
+        events.append(("phase", {"phase": cur["phase"], "status": cur["status"]}))
+
+    pets = _changed(prev["pets"], cur["pets"])
+    if pets or prev["total_pool"] != cur["total_pool"]:
+        events.append(("odds", {"total_pool": cur["total_pool"], "pets": pets}))
+
+    combos = _changed(prev["trifecta"], cur["trifecta"])
+    if combos or prev["trifecta_total"] != cur["trifecta_total"]:
+        events.append(("trifecta", {"total_pool": cur["trifecta_total"], "combos": combos}))
+
+    return events
+
+
+class RaceStreamHub:
+    """
+    snapshot は async def snapshot(guild_id, schedule_id) -> (state, 次のフェーズ切り替え UNIX 秒 or None)。
+    state = {"phase", "status", "total_pool", "pets", "trifecta_total", "trifecta"}
+    """
+
+    def __init__(self, snapshot, debounce: float = RACE_STREAM_DEBOUNCE):
+        self.snapshot = snapshot
+        self.debounce = debounce
+
+        # (guild_id, schedule_id) -> 接続中クライアントのキュー
+        self._subs = {}
+        # (guild_id, schedule_id) -> 最後に配った state
+        self._state = {}
+        self._wake = {}
+        self._tasks = {}
+        self._seq = itertools.count(1)
+
+    # --------------------------------------------------
+    # 変更通知（race_cache.add_listener で登録）
+    # --------------------------------------------------
+    def notify(self, guild_id, schedule_id=None):
+        guild_id = str(guild_id)
+
+        for (g, s), wake in self._wake.items():
+            if g == guild_id and (schedule_id is None or s == int(schedule_id)):
+                wake.set()
+
+    # --------------------------------------------------
+    # 接続
+    # --------------------------------------------------
+    @contextlib.asynccontextmanager
+    async def subscribe(self, guild_id, schedule_id):
+        """
+        async with hub.subscribe(g, s) as queue: で SSE 文字列を受け取る。
+        None が来たら終了（送信が追いつかないクライアント）。
+        """
+        key = (str(guild_id), int(schedule_id))
+        queue = asyncio.Queue(maxsize=RACE_STREAM_QUEUE)
+
+        self._subs.setdefault(key, set()).add(queue)
+
+        state = self._state.get(key)
+        if state is not None:
+            queue.put_nowait(format_event("snapshot", state, next(self._seq)))
+
+        self._ensure_producer(key)
+
+        try:
+            yield queue
+        finally:
+            subs = self._subs.get(key)
+            if subs is not None:
+                subs.discard(queue)
+                if not subs:
+                    self._stop_producer(key)
+
+    def viewers(self, guild_id, schedule_id) -> int:
+        return len(self._subs.get((str(guild_id), int(schedule_id)), ()))
+
+    # --------------------------------------------------
+    # producer（レースごとに1つ）
+    # --------------------------------------------------
+    def _ensure_producer(self, key):
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            self._wake[key] = asyncio.Event()
+            self._tasks[key] = asyncio.create_task(self._produce(key))
+
+    def _stop_producer(self, key):
+        self._subs.pop(key, None)
+        self._state.pop(key, None)
+        self._wake.pop(key, None)
+
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _produce(self, key):
+        guild_id, schedule_id = key
+        wake = self._wake[key]
+
+        while key in self._subs:
+            # 読み込み中の通知は次のループで拾う
+            wake.clear()
+
+            try:
+                state, next_change = await self.snapshot(guild_id, schedule_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[RACE STREAM ERROR] key={key} err={e!r}")
+                state, next_change = None, time.time() + RACE_STREAM_RETRY
+
+            if state is not None:
+                self._publish(key, state)
+
+            timeout = None
+            if next_change is not None:
+                timeout = max(0.0, next_change - time.time())
+
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            # 締切前の連続購入はまとめて1回で読む
+            await asyncio.sleep(self.debounce)
+
+    def _publish(self, key, state):
+        prev = self._state.get(key)
+        self._state[key] = state
+
+        if prev is None:
+            events = [("snapshot", state)]
+        else:
+            events = diff_states(prev, state)
+
+        for name, data in events:
+            message = format_event(name, data, next(self._seq))
+
+            for queue in list(self._subs.get(key, ())):
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    # 追いつかないクライアントは切る（再接続で snapshot から）
+                    self._subs[key].discard(queue)
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(None)
@@ -0,0 +1,171 @@
+# response_cache.py
+# ============================================================
+# レース表示 API のレスポンスキャッシュ（ETag 付き）
+# - キー: (エンドポイント, 引数...)。中身は JSON バイト列と ETag
+# - 無効化はバージョン番号で行う
+#     bump(guild_id, schedule_id): 馬券購入・抽選・確定など（そのレース＋ギルド）
+#     bump(guild_id)             : 日程生成・リセットなど（ギルドの全レース）
+# - フェーズ（entry / betting / racing / closed）は時刻で変わるので、
+#   次の切り替え時刻で切れるようにする。取りこぼし対策に TTL も持つ
+# 同じキーの作り直しは1つずつ（観戦者が一斉に来ても DB 読み込みは1回）。
+# Bot と Web API が同じプロセスなので、モジュール単位で1つ共有する。
+# ============================================================
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import NamedTuple
+
+
+RACE_CACHE_TTL = float(os.getenv("RACE_CACHE_TTL", "10"))
+RACE_CACHE_MAX_ENTRIES = 2048
+
+
+class CachedResponse(NamedTuple):
+    stamp: tuple          # 作成時のバージョン
+    expires_at: float     # UNIX 秒
+    data: dict            # JSON 化済みの dict（上書きして返す用）
+    body: bytes
+    etag: str
+
+
+def encode_json(data) -> tuple:
+    """return: (body, etag)。JSONResponse と同じ書式で出す"""
+    body = json.dumps(
+        data,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    return body, etag
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    """If-None-Match（複数指定・W/ 付き・*）と比較"""
+    if not if_none_match:
+        return False
+
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+
+class ResponseCache:
+
+    def __init__(self, ttl: float = RACE_CACHE_TTL):
+        self.ttl = ttl
+
+        # ("race", guild_id, schedule_id) / ("guild", guild_id) / ("all", guild_id) -> 番号
+        self._versions = {}
+        self._entries = {}
+        self._locks = {}
+        # bump の通知先 fn(guild_id, schedule_id or None)
+        self._listeners = []
+
+    # --------------------------------------------------
+    # 無効化
+    # --------------------------------------------------
+    def add_listener(self, fn):
+        """変更通知を受け取る（ライブ配信用）"""
+        self._listeners.append(fn)
+
+    def bump(self, guild_id, schedule_id=None):
+        guild_id = str(guild_id)
+
+        self._bump(("guild", guild_id))
+
+        if schedule_id is None:
+            # ギルド全体の変更 → レース単位のキャッシュも全部切る
+            self._bump(("all", guild_id))
+        else:
+            self._bump(("race", guild_id, int(schedule_id)))
+
+        for fn in self._listeners:
+            fn(guild_id, schedule_id)
+
+    def _bump(self, scope):
+        self._versions[scope] = self._versions.get(scope, 0) + 1
+
+    def _stamp(self, guild_id, schedule_id) -> tuple:
+        guild_id = str(guild_id)
+
+        if schedule_id is None:
+            return (self._versions.get(("guild", guild_id), 0),)
+
+        return (
+            self._versions.get(("all", guild_id), 0),
+            self._versions.get(("race", guild_id, int(schedule_id)), 0),
+        )
+
+    # --------------------------------------------------
+    # 取得
+    # --------------------------------------------------
+    async def get(self, key, guild_id, schedule_id, builder) -> CachedResponse:
+        """
+        key        : (エンドポイント, 引数...)
+        schedule_id: レース単位で無効化するなら schedule_id、ギルド単位なら None
+        builder    : async () -> (JSON 化済み dict, 次のフェーズ切り替え UNIX 秒 or None)
+                     例外（404 など）はキャッシュせずそのまま投げる
+        """
+        entry = self._entries.get(key)
+        if self._fresh(entry, guild_id, schedule_id):
+            return entry
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+
+        async with lock:
+            # 待っている間に他のリクエストが作っていればそれを返す
+            entry = self._entries.get(key)
+            if self._fresh(entry, guild_id, schedule_id):
+                return entry
+
+            # 読み込み前のバージョンで記録（読み込み中の変更は次で拾う）
+            stamp = self._stamp(guild_id, schedule_id)
+            data, valid_until = await builder()
+
+            expires_at = time.time() + self.ttl
+            if valid_until is not None:
+                expires_at = min(expires_at, valid_until)
+
+            body, etag = encode_json(data)
+            entry = CachedResponse(stamp, expires_at, data, body, etag)
+
+            if len(self._locks) >= RACE_CACHE_MAX_ENTRIES:
+                self._prune()
+
+            self._entries[key] = entry
+            return entry
+
+    def _fresh(self, entry, guild_id, schedule_id) -> bool:
+        return (
+            entry is not None
+            and entry.expires_at > time.time()
+            and entry.stamp == self._stamp(guild_id, schedule_id)
+        )
+
+    def _prune(self):
+        now = time.time()
+
+        for key, entry in list(self._entries.items()):
+            if entry.expires_at <= now:
+                del self._entries[key]
+
+        # 作り直し中でないロックは捨てる（404 だったキーのロックもここで消える）
+        for key, lock in list(self._locks.items()):
+            if key not in self._entries and not lock.locked():
+                del self._locks[key]
+
+
+# プロセス内で共有
+race_cache = ResponseCache()
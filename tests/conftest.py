@@ -0,0 +1,313 @@
+# tests/conftest.py
+# ============================================================
+# テスト用の共通フィクスチャ
+# - DATABASE_URL=ephemeral（db_pool の使い捨てローカル Postgres）で
+#   本番と同じ Database / migrations を動かす
+# - 起動時に1回だけ履歴データ（ユーザー・ペット・過去レース・馬券）を流し込む
+# - initdb が無い / root で実行している / asyncpg が無いときはスキップ
+#
+# 非同期メソッドは run(coro) でセッション共通のイベントループに流す
+# （プールはループに紐づくので、ループは1つだけ）。
+# ============================================================
+
+import asyncio
+import os
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+
+GUILD_ID = "900000000000000001"
+
+# 履歴データの規模（中規模サーバー数か月分くらい）
+N_USERS = 2000
+N_PETS = 3000
+HISTORY_DAYS = 30
+ENTRIES_PER_RACE = 16        # 8頭選出 + 8頭落選
+BETS_PER_RACE = 200          # 単勝
+TRIFECTA_BETS_PER_RACE = 200
+
+USER_ID_BASE = 100000
+INITIAL_BALANCE = 100_000_000
+
+
+def _require_backend():
+    """一時 Postgres を起動できない環境ならスキップ"""
+    pytest.importorskip("asyncpg")
+
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        pytest.skip("initdb は root では実行できない")
+
+    import db_pool
+
+    try:
+        db_pool._find_pg_bin("initdb")
+        db_pool._find_pg_bin("pg_ctl")
+    except RuntimeError as e:
+        pytest.skip(str(e))
+
+
+# ============================================================
+# イベントループ
+# ============================================================
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+
+    if "db_pool" in sys.modules:
+        import db_pool
+        loop.run_until_complete(db_pool.close_pool())
+
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def run(loop):
+    return loop.run_until_complete
+
+
+# ============================================================
+# Database（一時 Postgres + migrations + 履歴データ）
+# ============================================================
+@pytest.fixture(scope="session")
+def database(run):
+    _require_backend()
+
+    # 本番の DATABASE_URL が入っていても必ず使い捨ての方へ向ける
+    os.environ["DATABASE_URL"] = "ephemeral"
+
+    import db
+
+    database = db.Database()
+    run(database.init_db())
+    run(seed_history(database))
+
+    return database
+
+
+@pytest.fixture(scope="session")
+def seed(database):
+    return Seeder(database)
+
+
+async def seed_history(database):
+    """ユーザー・ペット・過去 HISTORY_DAYS 日分の確定済みレースと馬券"""
+    import db
+
+    today = date.today()
+
+    async with database.pool.acquire() as conn:
+        async with conn.transaction():
+
+            # ユーザー
+            await conn.execute("""
+                INSERT INTO users (user_id, guild_id, balance)
+                SELECT ($2 + g)::text, $1, $4
+                FROM generate_series(1, $3) g
+                ON CONFLICT (user_id, guild_id) DO NOTHING
+            """, GUILD_ID, USER_ID_BASE, N_USERS, INITIAL_BALANCE)
+
+            # ペット（成体・40種・全パッシブを順番に、1つおきに無し）
+            await conn.execute("""
+                INSERT INTO oasistchi_pets (
+                    user_id, stage, adult_key, name, happiness,
+                    base_speed, base_stamina, base_power,
+                    train_speed, train_stamina, train_power,
+                    passive_skill
+                )
+                SELECT
+                    ($1 + 1 + g % $2)::text,
+                    'adult',
+                    'adult_' || (g % 40),
+                    'pet' || g,
+                    g % 101,
+                    50 + g % 150,
+                    40 + (g * 3) % 90,
+                    50 + (g * 7) % 150,
+                    g % 30,
+                    g % 20,
+                    g % 25,
+                    -- 配列の範囲外は NULL（パッシブ無し）
+                    ($4::text[])[1 + g % (array_length($4::text[], 1) + 1)]
+                FROM generate_series(1, $3) g
+            """, USER_ID_BASE, N_USERS, N_PETS, list(db.PASSIVE_SKILLS))
+
+            # 過去のレース（確定・支払い済み）
+            await conn.execute("""
+                INSERT INTO race_schedules (
+                    guild_id, race_no, race_time, entry_open_minutes, race_date,
+                    distance, surface, condition,
+                    lottery_done, locked, race_finished, result_sent, reward_paid
+                )
+                SELECT
+                    $1, n, ($3::text[])[n], 60, $2::date - d,
+                    ($4::text[])[1 + (d + n) % array_length($4::text[], 1)],
+                    ($5::text[])[1 + (d * n) % array_length($5::text[], 1)],
+                    ($6::text[])[1 + (d + 2 * n) % array_length($6::text[], 1)],
+                    TRUE, TRUE, TRUE, TRUE, TRUE
+                FROM generate_series(1, $7) d
+                CROSS JOIN generate_series(1, array_length($3::text[], 1)) n
+            """, GUILD_ID, today, db.RACE_TIMES, db.DISTANCES, db.SURFACES,
+                db.CONDITIONS, HISTORY_DAYS)
+
+            # 出走（8頭選出＋着順、残りは落選）
+            await conn.execute("""
+                WITH pets AS (
+                    SELECT id, user_id, row_number() OVER (ORDER BY id) - 1 AS i
+                    FROM oasistchi_pets
+                )
+                INSERT INTO race_entries (
+                    race_date, schedule_id, user_id, pet_id, guild_id,
+                    status, rank, score, entry_fee
+                )
+                SELECT
+                    s.race_date, s.id, p.user_id, p.id, s.guild_id,
+                    CASE WHEN k <= 8 THEN 'selected' ELSE 'cancelled' END,
+                    CASE WHEN k <= 8 THEN k END,
+                    CASE WHEN k <= 8 THEN 1000 - k * 10 END,
+                    50000
+                FROM race_schedules s
+                CROSS JOIN generate_series(1, $2) k
+                JOIN pets p ON p.i = (s.id * $2 + k) % $3
+                WHERE s.guild_id = $1
+                  AND s.race_finished
+            """, GUILD_ID, ENTRIES_PER_RACE, N_PETS)
+
+            await conn.execute("""
+                INSERT INTO race_results (
+                    guild_id, race_date, schedule_id, pet_id, user_id,
+                    position, rank, final_score, reward
+                )
+                SELECT e.guild_id, e.race_date, e.schedule_id, e.pet_id, e.user_id,
+                       e.rank, e.rank, e.score,
+                       CASE e.rank WHEN 1 THEN 50000 WHEN 2 THEN 30000 WHEN 3 THEN 10000 ELSE 5000 END
+                FROM race_entries e
+                WHERE e.guild_id = $1
+                  AND e.status = 'selected'
+            """, GUILD_ID)
+
+            # 単勝
+            await conn.execute("""
+                INSERT INTO race_bets (guild_id, race_date, schedule_id, user_id, pet_id, amount)
+                SELECT s.guild_id, s.race_date, s.id,
+                       ($3 + 1 + (s.id * 7919 + b) % $4)::text,
+                       e.pet_id,
+                       1000 * (1 + b % 10)
+                FROM race_schedules s
+                CROSS JOIN generate_series(1, $2) b
+                JOIN race_entries e
+                  ON e.schedule_id = s.id
+                 AND e.status = 'selected'
+                 AND e.rank = 1 + b % 8
+                WHERE s.guild_id = $1
+                  AND s.race_finished
+            """, GUILD_ID, BETS_PER_RACE, USER_ID_BASE, N_USERS)
+
+            # 3連単
+            await conn.execute("""
+                INSERT INTO race_trifecta_bets (
+                    guild_id, race_date, schedule_id, user_id,
+                    first_pet_id, second_pet_id, third_pet_id, amount, dm_sent
+                )
+                SELECT s.guild_id, s.race_date, s.id,
+                       ($3 + 1 + (s.id * 104729 + b) % $4)::text,
+                       e1.pet_id, e2.pet_id, e3.pet_id,
+                       10000,
+                       TRUE
+                FROM race_schedules s
+                CROSS JOIN generate_series(1, $2) b
+                JOIN race_entries e1
+                  ON e1.schedule_id = s.id AND e1.status = 'selected' AND e1.rank = 1 + b % 8
+                JOIN race_entries e2
+                  ON e2.schedule_id = s.id AND e2.status = 'selected' AND e2.rank = 1 + (b + 1) % 8
+                JOIN race_entries e3
+                  ON e3.schedule_id = s.id AND e3.status = 'selected' AND e3.rank = 1 + (b + 3) % 8
+                WHERE s.guild_id = $1
+                  AND s.race_finished
+            """, GUILD_ID, TRIFECTA_BETS_PER_RACE, USER_ID_BASE, N_USERS)
+
+    # ランキング用の通算成績
+    await database.rebuild_pet_race_stats(GUILD_ID)
+
+
+# ============================================================
+# テストごとのデータ作成
+# ============================================================
+class Seeder:
+    """
+    ベンチマーク・テスト用に「抽選済み・未確定」のレースを作る。
+    出走馬はペットを先頭から順番に使う（同じ馬が続けて出ないように）。
+    """
+
+    guild_id = GUILD_ID
+
+    def __init__(self, database):
+        self.database = database
+        self._race_count = 0
+        self._pet_offset = 0
+
+    @staticmethod
+    def user_id(i: int) -> str:
+        """履歴で作ったユーザー（i は何番目でもよい）"""
+        return str(USER_ID_BASE + 1 + i % N_USERS)
+
+    @classmethod
+    def user_ids(cls, n: int = N_USERS) -> list:
+        return [cls.user_id(i) for i in range(min(n, N_USERS))]
+
+    async def race(self, runners: int = 8, race_date: date | None = None, distance: str | None = None):
+        """return: race_schedules の行（dict）"""
+        import db
+
+        self._race_count += 1
+        n = self._race_count % len(db.RACE_TIMES)
+        race_date = race_date or date.today() + timedelta(days=1)
+
+        async with self.database.pool.acquire() as conn:
+            async with conn.transaction():
+                race = await conn.fetchrow("""
+                    INSERT INTO race_schedules (
+                        guild_id, race_no, race_time, entry_open_minutes, race_date,
+                        distance, surface, condition, lottery_done, locked
+                    )
+                    VALUES ($1, $2, $3, 60, $4, $5, $6, $7, TRUE, TRUE)
+                    RETURNING *
+                """,
+                    GUILD_ID,
+                    n + 1,
+                    db.RACE_TIMES[n],
+                    race_date,
+                    distance or db.DISTANCES[n % len(db.DISTANCES)],
+                    db.SURFACES[n % len(db.SURFACES)],
+                    db.CONDITIONS[n % len(db.CONDITIONS)]
+                )
+
+                await conn.execute("""
+                    WITH pets AS (
+                        SELECT id, user_id
+                        FROM oasistchi_pets
+                        ORDER BY id
+                        OFFSET $4
+                        LIMIT $5
+                    )
+                    INSERT INTO race_entries (
+                        race_date, schedule_id, user_id, pet_id, guild_id, status, entry_fee
+                    )
+                    SELECT $2, $3, user_id, id, $1, 'selected', 50000
+                    FROM pets
+                """, GUILD_ID, race_date, race["id"], self._pet_offset, runners)
+
+        self._pet_offset = (self._pet_offset + runners) % (N_PETS - runners)
+        return dict(race)
+
+    async def runner_ids(self, schedule_id: int) -> list:
+        rows = await self.database._fetch("""
+            SELECT pet_id
+            FROM race_entries
+            WHERE schedule_id = $1
+              AND status = 'selected'
+            ORDER BY id
+        """, schedule_id)
+        return [r["pet_id"] for r in rows]
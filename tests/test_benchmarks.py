@@ -0,0 +1,123 @@
+# tests/test_benchmarks.py
+# ============================================================
+# 重い処理のベンチマーク（pytest-benchmark）
+#   pytest tests/test_benchmarks.py --benchmark-only
+# - レース確定（8頭）
+# - 3連単購入（1件ずつ、毎回別ユーザー）
+# - おあしすっちの時間経過処理（oasistchi_tick 1周分）
+# - 給料配布（全ユーザーへ一括加算）
+# 履歴データは conftest の seed_history（数千ユーザー・数万馬券）。
+# ============================================================
+
+import itertools
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+
+FINALIZE_ROUNDS = 30
+TRIFECTA_ROUNDS = 200
+TICK_PETS = 300          # oasistchi_tick 1周で回すペット数
+TICK_ROUNDS = 10
+
+
+def test_finalize_race(benchmark, database, seed, run):
+
+    def setup():
+        race = run(seed.race(8))
+        return (race,), {}
+
+    def finalize(race):
+        return run(database.finalize_race(
+            race["guild_id"], race["race_date"], race["id"], race["distance"]
+        ))
+
+    results = benchmark.pedantic(finalize, setup=setup, rounds=FINALIZE_ROUNDS)
+
+    assert sorted(r["rank"] for r in results) == list(range(1, 9))
+
+
+def test_place_trifecta_bet(benchmark, database, seed, run):
+    race = run(seed.race(8))
+    combos = list(itertools.permutations(run(seed.runner_ids(race["id"])), 3))
+    counter = itertools.count()
+
+    def setup():
+        # 1人10口までなので毎回別ユーザー
+        i = next(counter)
+        return (seed.user_id(i), combos[i % len(combos)]), {}
+
+    def place(user_id, combo):
+        return run(database.place_trifecta_bet(
+            seed.guild_id, race["race_date"], race["id"], user_id, *combo, 10000
+        ))
+
+    result = benchmark.pedantic(place, setup=setup, rounds=TRIFECTA_ROUNDS)
+
+    assert result["status"] == "ok"
+    assert result["total_pool"] >= TRIFECTA_ROUNDS * 10000
+
+
+def test_process_time_tick(benchmark, database, run):
+    oasistchi = pytest.importorskip("cogs.oasistchi")
+
+    async def no_dm(user_id):
+        raise RuntimeError("テストでは DM を送らない")
+
+    # process_time_tick が使うのは self.bot（db / fetch_user）だけ
+    cog = SimpleNamespace(bot=SimpleNamespace(db=database, fetch_user=no_dm))
+
+    def setup():
+        # 毎回「空腹・うんち・なでなで」が進む状態に戻す
+        random.seed(0)
+        pets = run(database._fetch("""
+            UPDATE oasistchi_pets
+            SET hunger = 60,
+                poop = FALSE,
+                poop_alerted = FALSE,
+                hunger_alerted = FALSE,
+                last_hunger_tick = $1::float8 - 3 * 3600,
+                next_poop_check_at = 0,
+                pet_ready_at = $1::float8 - 3600,
+                pet_ready_notified_at = 0
+            WHERE id IN (
+                SELECT id FROM oasistchi_pets ORDER BY id LIMIT $2
+            )
+            RETURNING *
+        """, time.time(), TICK_PETS))
+        return (pets,), {}
+
+    def tick(pets):
+        async def loop():
+            for pet in pets:
+                await oasistchi.OasistchiCog.process_time_tick(cog, pet)
+
+        run(loop())
+
+    benchmark.pedantic(tick, setup=setup, rounds=TICK_ROUNDS)
+
+    hungry = run(database._fetchval("""
+        SELECT COUNT(*)
+        FROM oasistchi_pets
+        WHERE hunger_alerted
+    """))
+    assert hungry >= TICK_PETS
+
+
+def test_salary_payout(benchmark, database, seed, run):
+    user_ids = seed.user_ids()
+    deltas = [(uid, 1000 + (i % 5) * 500) for i, uid in enumerate(user_ids)]
+
+    def payout():
+        return run(database.apply_balance_deltas(
+            seed.guild_id, deltas, floor=None, reason="salary"
+        ))
+
+    result = benchmark(payout)
+
+    assert len(result["balances"]) == len(user_ids)
+    assert not result["rejected"]
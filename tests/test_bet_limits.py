@@ -0,0 +1,85 @@
+# tests/test_bet_limits.py
+# ============================================================
+# 同じユーザーの同時購入でもレースごとの購入上限を超えないこと
+# 別コネクションで users 行を握っている間に2件を同時に投げ、
+# 2件とも上限チェックまで進んだ状態から競らせる。
+# ============================================================
+
+import asyncio
+
+import pytest
+
+
+async def race_two_purchases(database, guild_id, user_id, buy):
+    """users 行をロックしたまま buy() を2つ走らせ、ロックを離してから結果を集める"""
+    async with database.pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                SELECT 1
+                FROM users
+                WHERE guild_id = $1
+                  AND user_id = $2
+                FOR UPDATE
+            """, guild_id, user_id)
+
+            tasks = [asyncio.ensure_future(buy()) for _ in range(2)]
+            # 2件ともロック待ちに入るまで待つ
+            await asyncio.sleep(0.3)
+
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_place_trifecta_bet_limit_under_concurrency(database, seed, run):
+    race = run(seed.race(8))
+    first, second, third = run(seed.runner_ids(race["id"]))[:3]
+    user_id = seed.user_id(1900)
+
+    # 6口 + 6口 > 10口
+    results = run(race_two_purchases(
+        database, seed.guild_id, user_id,
+        lambda: database.place_trifecta_bet(
+            seed.guild_id, race["race_date"], race["id"], user_id,
+            first, second, third, 60000
+        )
+    ))
+
+    ok = [r for r in results if isinstance(r, dict)]
+    errors = [r for r in results if isinstance(r, RuntimeError)]
+
+    assert len(ok) == 1
+    assert len(errors) == 1
+    assert "最大10口" in str(errors[0])
+
+
+def test_buy_trifecta_bet_limit_under_concurrency(database, seed, run):
+    race = run(seed.race(8))
+    first, second, third = run(seed.runner_ids(race["id"]))[:3]
+    user_id = seed.user_id(1901)
+
+    results = run(race_two_purchases(
+        database, seed.guild_id, user_id,
+        lambda: database.buy_trifecta_bet(
+            seed.guild_id, race["id"], user_id, first, second, third, 60000,
+            max_amount=100000,
+            total_max_amount=10_000_000
+        )
+    ))
+
+    assert sorted(r["status"] for r in results) == ["limit", "ok"]
+
+
+def test_buy_race_bet_limit_under_concurrency(database, seed, run):
+    race = run(seed.race(8))
+    pet_id = run(seed.runner_ids(race["id"]))[0]
+    user_id = seed.user_id(1902)
+
+    results = run(race_two_purchases(
+        database, seed.guild_id, user_id,
+        lambda: database.buy_race_bet(
+            seed.guild_id, race["id"], user_id, pet_id, 60000,
+            max_amount=100000,
+            allow_closed=True
+        )
+    ))
+
+    assert sorted(r["status"] for r in results) == ["limit", "ok"]
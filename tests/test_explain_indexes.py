@@ -0,0 +1,197 @@
+# tests/test_explain_indexes.py
+# ============================================================
+# インデックスの回帰テスト（EXPLAIN）
+# 履歴データを入れて ANALYZE したうえで enable_seqscan=off にし、
+# よく通るクエリのプランに v0003 / v0007 のインデックス名が出ることを確認する。
+# クエリの形は db.py の該当メソッドと同じ（WHERE / ORDER BY の列）。
+# ============================================================
+
+import json
+
+import pytest
+
+
+# (名前, SQL, 引数の作り方, 使われるべきインデックス)
+HOT_QUERIES = [
+    (
+        # 抽選・確定の出走馬（_fetch_race_runners / run_race_lottery）
+        "race_entries_by_race",
+        """
+        SELECT pet_id
+        FROM race_entries
+        WHERE guild_id = $1
+          AND race_date = $2
+          AND schedule_id = $3
+          AND status = 'selected'
+        """,
+        lambda s: (s["guild_id"], s["race_date"], s["schedule_id"]),
+        "idx_race_entries_race_status",
+    ),
+    (
+        # get_race_entries_by_status / 返金
+        "race_entries_by_schedule",
+        """
+        SELECT *
+        FROM race_entries
+        WHERE schedule_id = $1
+          AND status = $2
+        """,
+        lambda s: (s["schedule_id"], "cancelled"),
+        "idx_race_entries_schedule_status",
+    ),
+    (
+        # 単勝のユーザー別購入額（get_user_single_units / 購入上限）
+        "race_bets_user_sum",
+        """
+        SELECT COALESCE(SUM(amount), 0)
+        FROM race_bets
+        WHERE guild_id = $1
+          AND race_date = $2
+          AND schedule_id = $3
+          AND user_id = $4
+        """,
+        lambda s: (s["guild_id"], s["race_date"], s["schedule_id"], s["user_id"]),
+        "idx_race_bets_race_user",
+    ),
+    (
+        # 3連単のユーザー別購入額（place_trifecta_bet / buy_trifecta_bet）
+        "trifecta_bets_user_sum",
+        """
+        SELECT COALESCE(SUM(amount), 0)
+        FROM race_trifecta_bets
+        WHERE guild_id = $1
+          AND race_date = $2
+          AND schedule_id = $3
+          AND user_id = $4
+        """,
+        lambda s: (s["guild_id"], s["race_date"], s["schedule_id"], s["user_id"]),
+        "idx_race_trifecta_bets_race_user",
+    ),
+    (
+        # 的中者検索（settle_trifecta）
+        "trifecta_bets_combo",
+        """
+        SELECT user_id, amount
+        FROM race_trifecta_bets
+        WHERE guild_id = $1
+          AND race_date = $2
+          AND schedule_id = $3
+          AND first_pet_id = $4
+          AND second_pet_id = $5
+          AND third_pet_id = $6
+        """,
+        lambda s: (s["guild_id"], s["race_date"], s["schedule_id"], *s["combo"]),
+        "idx_race_trifecta_bets_combo",
+    ),
+    (
+        # 購入DM未送信（get_unnotified_trifecta_bets）
+        "trifecta_bets_undelivered",
+        """
+        SELECT *
+        FROM race_trifecta_bets
+        WHERE dm_sent = FALSE
+        ORDER BY id ASC
+        LIMIT 20
+        """,
+        lambda s: (),
+        "idx_race_trifecta_bets_undelivered",
+    ),
+    (
+        # その日のレース一覧（get_today_race_schedules）
+        "race_schedules_by_date",
+        """
+        SELECT *
+        FROM race_schedules
+        WHERE race_date = $1
+          AND guild_id = $2
+        ORDER BY race_no
+        """,
+        lambda s: (s["race_date"], s["guild_id"]),
+        "idx_race_schedules_guild_date",
+    ),
+    (
+        # ランキング（get_pet_ranking。v0007 の集計表）
+        "pet_ranking",
+        """
+        SELECT s.pet_id, s.wins
+        FROM pet_race_stats s
+        JOIN oasistchi_pets p
+          ON p.id = s.pet_id
+        WHERE s.guild_id = $1
+          AND s.distance = $2
+          AND s.wins > 0
+        ORDER BY s.wins DESC
+        LIMIT 50
+        """,
+        lambda s: (s["guild_id"], s["distance"]),
+        "idx_pet_race_stats_ranking",
+    ),
+]
+
+
+def index_names(plan) -> set:
+    """EXPLAIN (FORMAT JSON) の全ノードから Index Name を集める"""
+    names = set()
+
+    if isinstance(plan, dict):
+        if "Index Name" in plan:
+            names.add(plan["Index Name"])
+        for value in plan.values():
+            names |= index_names(value)
+
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= index_names(value)
+
+    return names
+
+
+@pytest.fixture(scope="module")
+def sample(database, seed, run):
+    """履歴の中から実在するレース・購入者・組み合わせを1つ選ぶ"""
+
+    async def load():
+        await database._execute("ANALYZE")
+
+        bet = await database._fetchrow("""
+            SELECT b.guild_id, b.race_date, b.schedule_id, b.user_id,
+                   b.first_pet_id, b.second_pet_id, b.third_pet_id,
+                   s.distance
+            FROM race_trifecta_bets b
+            JOIN race_schedules s ON s.id = b.schedule_id
+            WHERE b.guild_id = $1
+            ORDER BY b.id
+            LIMIT 1
+        """, seed.guild_id)
+
+        return {
+            "guild_id": bet["guild_id"],
+            "race_date": bet["race_date"],
+            "schedule_id": bet["schedule_id"],
+            "user_id": bet["user_id"],
+            "combo": (bet["first_pet_id"], bet["second_pet_id"], bet["third_pet_id"]),
+            "distance": bet["distance"],
+        }
+
+    return run(load())
+
+
+@pytest.mark.parametrize(
+    "sql, make_args, index",
+    [q[1:] for q in HOT_QUERIES],
+    ids=[q[0] for q in HOT_QUERIES],
+)
+def test_hot_query_uses_index(database, sample, run, sql, make_args, index):
+
+    async def explain():
+        async with database.pool.acquire() as conn:
+            async with conn.transaction():
+                # このトランザクションだけ（プールに戻すコネクションには残さない）
+                await conn.execute("SET LOCAL enable_seqscan = off")
+                return await conn.fetchval(
+                    "EXPLAIN (FORMAT JSON) " + sql, *make_args(sample)
+                )
+
+    plan = json.loads(run(explain()))
+
+    assert index in index_names(plan), json.dumps(plan, ensure_ascii=False, indent=2)
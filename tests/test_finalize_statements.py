@@ -0,0 +1,48 @@
+# tests/test_finalize_statements.py
+# ============================================================
+# finalize_race の往復回数が出走頭数に依存しないことの確認
+# 共有プールの QueryStats（TimedConnection 経由で全 SQL を記録）で
+# 2頭立てと8頭立てを確定したときの SQL 数・テンプレートを比べる。
+# ============================================================
+
+import pytest
+
+db_pool = pytest.importorskip("db_pool")
+
+
+def finalize_and_count(database, run, race):
+    """return: (確定結果, {SQL テンプレート: 回数})"""
+    db_pool.query_stats.reset()
+
+    results = run(database.finalize_race(
+        race["guild_id"], race["race_date"], race["id"], race["distance"]
+    ))
+
+    counts = {t["query"]: t["count"] for t in db_pool.query_stats.top(n=10_000)}
+    return results, counts
+
+
+def test_finalize_race_statement_count_is_constant(database, seed, run):
+    small = run(seed.race(2, distance="マイル"))
+    large = run(seed.race(8, distance="マイル"))
+
+    small_results, small_counts = finalize_and_count(database, run, small)
+    large_results, large_counts = finalize_and_count(database, run, large)
+
+    assert len(small_results) == 2
+    assert len(large_results) == 8
+
+    assert sum(small_counts.values()) == sum(large_counts.values())
+    assert small_counts == large_counts
+
+
+def test_finalize_race_twice_is_noop(database, seed, run):
+    race = run(seed.race(8))
+
+    first, _ = finalize_and_count(database, run, race)
+    second, counts = finalize_and_count(database, run, race)
+
+    assert len(first) == 8
+    assert second == []
+    # 締切行のロックだけで終わる
+    assert sum(counts.values()) == 1
@@ -0,0 +1,37 @@
+# tests/test_latest_race.py
+# ============================================================
+# 「最新レース」系がカレンダーの先の日付を拾わないこと
+# （カレンダーは RACE_CALENDAR_DAYS 日先まで作ってある）
+# ============================================================
+
+from datetime import datetime, timedelta
+
+
+def today_jst():
+    import db
+    return datetime.now(db.JST).date()
+
+
+def test_latest_open_race_ignores_future_days(database, seed, run):
+    today = today_jst()
+
+    # 抽選済み扱いの未来のレース
+    run(seed.race(8, race_date=today + timedelta(days=1)))
+    run(seed.race(8, race_date=today + timedelta(days=3)))
+
+    race = run(database.get_latest_open_race(seed.guild_id))
+
+    assert race is not None
+    assert race["race_date"] <= today
+
+
+def test_latest_active_race_is_today(database, seed, run):
+    today = today_jst()
+
+    run(seed.race(8, race_date=today))
+    run(seed.race(8, race_date=today + timedelta(days=2)))
+
+    race = run(database.get_latest_active_race(seed.guild_id))
+
+    # 時刻によっては今日のレースが全部終わっている
+    assert race is None or race["race_date"] == today
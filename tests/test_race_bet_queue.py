@@ -0,0 +1,52 @@
+# tests/test_race_bet_queue.py
+# ============================================================
+# GroupCommitQueue がレースごとのロックを溜め込まないこと
+# （成功・例外のどちらでも、最後のバッチが抜けたら消える）
+# ============================================================
+
+import asyncio
+
+import pytest
+
+from race_bet_queue import GroupCommitQueue
+
+
+def test_locks_are_released_after_batches():
+    active = {}
+
+    async def handler(key, items):
+        # 同じキーのバッチが並行して走っていないこと
+        assert not active.get(key)
+        active[key] = True
+        await asyncio.sleep(0.001)
+        active[key] = False
+        return [item * 2 for item in items]
+
+    queue = GroupCommitQueue(handler, window_ms=1, max_batch=3)
+
+    async def main():
+        results = await asyncio.gather(*(
+            queue.submit(race_id % 5, race_id) for race_id in range(100)
+        ))
+        return results, dict(queue._locks), dict(queue._lock_users)
+
+    results, locks, users = asyncio.run(main())
+
+    assert results == [race_id * 2 for race_id in range(100)]
+    assert locks == {}
+    assert users == {}
+
+
+def test_locks_are_released_after_handler_error():
+
+    async def handler(key, items):
+        raise RuntimeError("commit failed")
+
+    queue = GroupCommitQueue(handler, window_ms=1)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await queue.submit("race-1", 1)
+        return dict(queue._locks), dict(queue._lock_users)
+
+    assert asyncio.run(main()) == ({}, {})
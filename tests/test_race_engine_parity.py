@@ -0,0 +1,299 @@
+# tests/test_race_engine_parity.py
+# ============================================================
+# race_engine（配列版）と従来のループ版 simulate_race の一致テスト
+# 従来版は下にそのまま残してある（print と未使用の変数だけ削除。乱数は引かないので結果は同じ）。
+# 同じ random.seed から
+# ・着順・スコア・debug の中身が完全に一致すること
+# ・引いた乱数の数が同じこと（後続の random の値が一致）
+# を、同族（同じ adult_key）入りの混成フィールドと全パッシブで確認する。
+# ============================================================
+
+import copy
+import random
+
+import pytest
+
+pytest.importorskip("asyncpg")   # db → db_pool
+pytest.importorskip("numpy")
+
+import db
+import race_engine
+
+
+# ============================================================
+# 従来版（Database.apply_passive_effect / simulate_race）
+# ============================================================
+def reference_apply_passive_effect(stats: dict, pet: dict, context: dict) -> dict:
+    passive_key = pet.get("passive_skill")
+    passive = db.PASSIVE_SKILLS.get(passive_key)
+
+    if not passive:
+        return stats
+
+    ptype = passive["type"]
+
+    if ptype == "stat":
+        target = passive["target"]
+        stats[target] *= passive["multiplier"]
+
+    elif ptype == "all":
+        m = passive["multiplier"]
+
+        stats["speed"] *= m
+        stats["stamina"] *= m
+        stats["power"] *= m
+
+    elif ptype == "trade":
+        for k, v in passive["effects"].items():
+            stats[k] *= v
+
+    elif ptype == "gate_number":
+        if context.get("gate") == passive["gate"]:
+            m = passive["multiplier"]
+            stats["speed"] *= m
+            stats["stamina"] *= m
+            stats["power"] *= m
+
+    elif ptype == "surface":
+        if context.get("surface") == passive["surface"]:
+            m = passive["multiplier"]
+            stats["speed"] *= m
+            stats["stamina"] *= m
+            stats["power"] *= m
+
+    elif ptype == "distance":
+        if context.get("distance") == passive["distance"]:
+            m = passive["multiplier"]
+            stats["speed"] *= m
+            stats["stamina"] *= m
+            stats["power"] *= m
+
+    elif ptype == "same_adult":
+        if context.get("same_adult_exists"):
+            m = passive["multiplier"]
+            stats["speed"] *= m
+            stats["stamina"] *= m
+            stats["power"] *= m
+
+    elif ptype == "chance_boost":
+        if random.random() < passive["chance"]:
+            m = passive["multiplier"]
+            stats["speed"] *= m
+            stats["stamina"] *= m
+            stats["power"] *= m
+
+    elif ptype == "odds_rank":
+        rank = context.get("odds_rank", 1)
+        m = 1 + rank * 0.02
+
+        stats["speed"] *= m
+        stats["stamina"] *= m
+        stats["power"] *= m
+
+    stats["speed"] = int(stats["speed"])
+    stats["stamina"] = int(stats["stamina"])
+    stats["power"] = int(stats["power"])
+
+    return stats
+
+
+def reference_simulate_race(entries, race):
+    DISTANCE_BALANCE = {
+        "短距離": {"speed": 1.4, "power": 0.8, "stamina": 0.5},
+        "マイル": {"speed": 1.2, "power": 1.2, "stamina": 0.8},
+        "中距離": {"speed": 0.9, "power": 1.3, "stamina": 1.3},
+        "長距離": {"speed": 0.6, "power": 1.0, "stamina": 1.6},
+    }
+
+    distance = race["distance"]
+    surface = race["surface"]
+
+    balance = DISTANCE_BALANCE.get(distance)
+    if not balance:
+        raise ValueError(f"不明な距離: {distance}")
+
+    results = []
+
+    for e in entries:
+
+        # 同族判定
+        same_adult_exists = any(
+            other["adult_key"] == e["adult_key"] and other["pet_id"] != e["pet_id"]
+            for other in entries
+        )
+
+        # パッシブ適用
+        stats = {
+            "speed": e["speed"],
+            "stamina": e["stamina"],
+            "power": e["power"]
+        }
+
+        context = {
+            "gate": e.get("gate"),
+            "surface": surface,
+            "distance": distance,
+            "same_adult_exists": same_adult_exists,
+        }
+
+        stats = reference_apply_passive_effect(stats, e, context)
+
+        # 根性発動判定
+        happiness = e.get("happiness", 0)
+        base_guts_rate = (happiness / 100) * 0.10
+        guts_triggered = random.random() < base_guts_rate
+
+        # 距離補正込み能力計算
+        speed = stats["speed"] * balance["speed"] + stats["power"] * balance["power"]
+        stamina = stats["stamina"]
+
+        stamina_loss = 50 * balance["stamina"]
+        stamina_after = stamina - stamina_loss
+
+        if stamina_after <= 0:
+            speed *= 0.6
+
+        rand_factor = random.uniform(0.95, 1.05)
+
+        final_score = speed * rand_factor
+
+        debug_data = {
+            "base_speed": e["speed"],
+            "after_passive_speed": stats["speed"],
+
+            "base_power": e["power"],
+            "after_passive_power": stats["power"],
+
+            "base_stamina": e["stamina"],
+            "after_passive_stamina": stats["stamina"],
+
+            "stamina_after": stamina_after,
+
+            "rand": rand_factor,
+            "same_adult": same_adult_exists,
+            "passive": e.get("passive_skill"),
+            "distance": distance,
+            "surface": surface,
+            "guts": guts_triggered,
+
+            "final_score": final_score
+        }
+
+        results.append({
+            "pet_id": e["pet_id"],
+            "user_id": e["user_id"],
+            "score": final_score,
+            "debug": debug_data
+        })
+
+    results.sort(key=lambda x: x["score"], reverse=True)
+
+    for i, r in enumerate(results):
+        r["rank"] = i + 1
+
+    return results
+
+
+# ============================================================
+# フィールド生成
+# ============================================================
+PASSIVES = list(db.PASSIVE_SKILLS)
+DISTANCES = list(race_engine.DISTANCE_BALANCE)
+SURFACES = ["芝", "ダート"]
+ADULT_KEYS = ["a", "b", "c", None]
+
+
+def make_field(rng: random.Random, n: int, passives=None, repeat_ids=False) -> list:
+    """
+    n 頭の混成フィールド。
+    adult_key は少数から選ぶので同族が混ざる。枠番はシャッフル、
+    happiness は無い馬もいる（従来版は 0 扱い）。
+    repeat_ids: pet_id の重複あり（同族判定は pet_id で自分を除く）
+    """
+    gates = list(range(1, n + 1))
+    rng.shuffle(gates)
+
+    entries = []
+    for i in range(n):
+        e = {
+            "user_id": str(1000 + i),
+            "pet_id": rng.randint(1, 6) if repeat_ids else i + 1,
+            "passive_skill": rng.choice(PASSIVES + [None, None]),
+            "adult_key": rng.choice(ADULT_KEYS),
+            "speed": rng.randint(1, 200),
+            "power": rng.randint(1, 200),
+            "stamina": rng.randint(1, 120),
+            "gate": gates[i],
+        }
+        if rng.random() < 0.7:
+            e["happiness"] = rng.randint(0, 100)
+        entries.append(e)
+
+    for i, passive in enumerate(passives or []):
+        entries[i]["passive_skill"] = passive
+
+    return entries
+
+
+def assert_same_as_reference(entries, race, seed):
+    random.seed(seed)
+    expected = reference_simulate_race(copy.deepcopy(entries), race)
+    expected_next = random.random()
+
+    random.seed(seed)
+    actual = race_engine.simulate_race(entries, race)
+    actual_next = random.random()
+
+    assert actual == expected
+    # 乱数を引いた回数も同じ
+    assert actual_next == expected_next
+
+
+# ============================================================
+# テスト
+# ============================================================
+@pytest.mark.parametrize("passive", PASSIVES)
+def test_each_passive_matches_reference(passive):
+    """
+    パッシブごとに、距離・馬場・枠番・同族の有無を変えて回す。
+    先頭2頭は同じ adult_key（同族あり）、3頭目は単独にする。
+    """
+    for trial in range(40):
+        rng = random.Random(f"{passive}:{trial}")
+        race = {
+            "distance": DISTANCES[trial % len(DISTANCES)],
+            "surface": SURFACES[(trial // len(DISTANCES)) % len(SURFACES)],
+        }
+
+        entries = make_field(rng, rng.randint(3, 12), passives=[passive, passive, passive])
+        entries[0]["adult_key"] = entries[1]["adult_key"] = "dup"
+        entries[2]["adult_key"] = "solo"
+
+        assert_same_as_reference(entries, race, seed=trial)
+
+
+def test_mixed_fields_match_reference():
+    for trial in range(500):
+        rng = random.Random(trial)
+        race = {
+            "distance": rng.choice(DISTANCES),
+            "surface": rng.choice(SURFACES),
+        }
+
+        entries = make_field(rng, rng.randint(1, 18), repeat_ids=(trial % 7 == 0))
+        assert_same_as_reference(entries, race, seed=trial)
+
+
+def test_database_simulate_race_uses_engine():
+    rng = random.Random(7)
+    race = {"distance": "マイル", "surface": "芝"}
+    entries = make_field(rng, 8, passives=PASSIVES[:8])
+
+    random.seed(7)
+    expected = reference_simulate_race(copy.deepcopy(entries), race)
+
+    random.seed(7)
+    # self は使わない
+    actual = db.Database.simulate_race(None, entries, race)
+
+    assert actual == expected
@@ -0,0 +1,57 @@
+# tests/test_race_pools.py
+# ============================================================
+# PoolAggregator のメモリが確定後・日付切り替えで解放されること
+# DB は get_pool_data だけ持つ偽物で足りる。
+# ============================================================
+
+import asyncio
+from datetime import date
+
+from race_pools import PoolAggregator
+
+
+class FakeDB:
+    def __init__(self):
+        self.loads = 0
+
+    async def get_pool_data(self, guild_id, race_date, schedule_id):
+        self.loads += 1
+        return 3000, {1: 1000, 2: 2000}
+
+
+def test_drop_releases_pool_and_lock():
+    pools = PoolAggregator()
+    db = FakeDB()
+
+    total, pets = asyncio.run(pools.get(db, 1, date(2026, 1, 1), 10))
+    assert (total, pets) == (3000, {1: 1000, 2: 2000})
+
+    pools.drop("1", date(2026, 1, 1), 10)
+
+    assert pools._pools == {}
+    assert pools._load_locks == {}
+
+    # 外したあとは DB から読み直す
+    asyncio.run(pools.get(db, 1, date(2026, 1, 1), 10))
+    assert db.loads == 2
+
+
+def test_evict_before_keeps_today():
+    pools = PoolAggregator()
+    db = FakeDB()
+
+    async def load():
+        await pools.get(db, 1, date(2026, 1, 1), 10)
+        await pools.get(db, 1, date(2026, 1, 2), 11)
+        await pools.get(db, 2, date(2026, 1, 2), 12)
+
+    asyncio.run(load())
+
+    assert pools.evict_before(date(2026, 1, 2)) == 1
+    assert set(pools._pools) == {("1", date(2026, 1, 2), 11), ("2", date(2026, 1, 2), 12)}
+    assert set(pools._load_locks) == set(pools._pools)
+
+    # 文字列の日付でも同じ
+    assert pools.evict_before("2026-01-03") == 2
+    assert pools._pools == {}
+    assert pools._load_locks == {}
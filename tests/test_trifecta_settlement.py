@@ -0,0 +1,38 @@
+# tests/test_trifecta_settlement.py
+# ============================================================
+# 3連単の精算 → 精算サマリーの読み出し
+# race_date は DATE 列。date でも "YYYY-MM-DD" でも通ること。
+# ============================================================
+
+import itertools
+
+
+def test_settle_and_read_settlement(database, seed, run):
+    race = run(seed.race(4))
+    race_date = race["race_date"]
+
+    # 4頭立ての全24通りを1口ずつ（必ず的中が出る）
+    combos = list(itertools.permutations(run(seed.runner_ids(race["id"])), 3))
+    for i, combo in enumerate(combos):
+        run(database.place_trifecta_bet(
+            seed.guild_id, race_date, race["id"], seed.user_id(1500 + i), *combo, 10000
+        ))
+
+    results = run(database.finalize_race(
+        race["guild_id"], race_date, race["id"], race["distance"]
+    ))
+    winner = tuple(r["pet_id"] for r in sorted(results, key=lambda r: r["rank"])[:3])
+
+    assert run(database.get_trifecta_settlement(seed.guild_id, race_date, race["id"])) is None
+
+    settled = run(database.settle_trifecta(seed.guild_id, race_date.isoformat(), race["id"]))
+    assert settled["status"] == "hit"
+
+    row = run(database.get_trifecta_settlement(seed.guild_id, race_date.isoformat(), race["id"]))
+
+    assert row is not None
+    assert row["status"] == "hit"
+    assert row["race_date"] == race_date
+    assert (row["first_pet_id"], row["second_pet_id"], row["third_pet_id"]) == winner
+    assert row["total_pool"] == settled["total_pool"]
+    assert row["winning_bets"] == 1
@@ -1,22 +1,40 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import asyncpg
-from datetime import datetime
+from datetime import datetime, date
 import math
+import asyncio
 import random
 import hmac
 import hashlib
 from pydantic import BaseModel
 from datetime import timedelta, timezone
-from db import Database
+from db import Database, RACE_DURATION_MINUTES
+import race_engine
+from race_pools import pool_aggregator
+from race_bet_queue import GroupCommitQueue
+from response_cache import race_cache, encode_json, etag_matches
+from race_stream import RaceStreamHub
+from db_pool import get_pool
+from migrations import run_migrations
 
 JST = timezone(timedelta(hours=9))
 UNIT_PRICE = 1000
 MAX_UNITS = 100
 MAX_AMOUNT = UNIT_PRICE * MAX_UNITS  # 100,000rrc
+TRI_UNIT = 10000
+TRI_MAX_UNITS = 10
+TRI_MAX_AMOUNT = TRI_UNIT * TRI_MAX_UNITS  # 100000
+TOTAL_MAX_AMOUNT = 200000  # 単勝＋3連単 合算上限
 TEST_MODE = True
 
+# 購入のグループコミット（同じレースに BET_BATCH_MS 以内に届いた購入を1トランザクションに）
+# 0 なら無効（1件ずつ処理）
+BET_BATCH_MS = float(os.getenv("BET_BATCH_MS", "0"))
+BET_BATCH_MAX = int(os.getenv("BET_BATCH_MAX", "200"))
+
 WEB_SECRET = "9f3a7c4d8b2e1f0a6c8d9e7f1a2b3c4d9e0f1a2b3c4d5e6f7a8b9c0d1e2f3a4"
 
 print("🔐 WEB_SECRET loaded (WEB)")
@@ -71,9 +89,8 @@ def calculate_odds(total_pool: int, pet_pool: int, take_rate: float = 0.10):
     # 最小1.1倍、最大10倍に制限
     return round(max(1.0, odds), 2)
 
-def get_race_phase(race):
-    now = datetime.now(JST)
-
+def get_race_phase_times(race):
+    """return: (エントリー締切, 発走, レース終了)"""
     race_date = race["race_date"]
     race_time = race["race_time"]
 
@@ -91,7 +108,14 @@ def get_race_phase(race):
     )
 
     entry_close = race_datetime - timedelta(hours=1)
-    race_end = race_datetime + timedelta(hours=1)
+    race_end = race_datetime + timedelta(minutes=RACE_DURATION_MINUTES)
+
+    return entry_close, race_datetime, race_end
+
+def get_race_phase(race):
+    now = datetime.now(JST)
+
+    entry_close, race_datetime, race_end = get_race_phase_times(race)
 
     if now < entry_close:
         return "entry"
@@ -102,6 +126,27 @@ def get_race_phase(race):
     else:
         return "closed"
 
+def next_phase_change(race):
+    """次にフェーズが変わる時刻（UNIX 秒）。closed なら None"""
+    now = datetime.now(JST)
+
+    for t in get_race_phase_times(race):
+        if now < t:
+            return t.timestamp()
+
+    return None
+
+def etag_response(body: bytes, etag: str, if_none_match: str | None):
+    """If-None-Match が一致すれば 304（本文なし）"""
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
+
 def get_condition_label(happiness: int):
     if happiness >= 80:
         return "好調", "good"
@@ -143,46 +188,102 @@ if not DATABASE_URL:
 # =========================
 @app.on_event("startup")
 async def ensure_schema():
-    app.state.pool = await asyncpg.create_pool(
-        DATABASE_URL,
-        min_size=1,
-        max_size=10
-    )
+    # Bot と同じプロセス内なら Bot 側と同じプールが返る
+    # （閉じるのはプロセスの持ち主の bot.py。Web API の停止では閉じない）
+    app.state.pool = await get_pool()
     app.state.db = Database()
     await app.state.db.connect()
 
-    async with app.state.pool.acquire() as conn:
-        async def ensure_column(table, column, definition):
-            exists = await conn.fetchval("""
-                SELECT 1
-                FROM information_schema.columns
-                WHERE table_name=$1
-                  AND column_name=$2
-            """, table, column)
-            if not exists:
-                print(f"🔧 Adding {column} to {table}...")
-                await conn.execute(f"""
-                    ALTER TABLE {table}
-                    ADD COLUMN {column} {definition}
-                """)
-                print(f"✅ {column} added to {table}")
-
-        # race_bets の不足カラムを補完
-        await ensure_column("race_bets", "guild_id", "TEXT")
-        await ensure_column("race_bets", "schedule_id", "INTEGER")
-        await ensure_column("race_bets", "race_date", "DATE")
-
-@app.on_event("shutdown")
-async def shutdown():
-    await app.state.pool.close()
+    # race_bets のカラム補完などは migrations/ で管理
+    await run_migrations(app.state.pool)
+
+    # 今日の単勝プールをメモリに読み込む（DB と突き合わせ）
+    loaded = await pool_aggregator.warm(app.state.db, datetime.now(JST).date())
+    print(f"[POOL] warmed {loaded} races")
+
+    # 購入のグループコミット（BET_BATCH_MS > 0 のときだけ）
+    app.state.bet_queue = None
+    app.state.trifecta_queue = None
+
+    if BET_BATCH_MS > 0:
+        app.state.bet_queue = GroupCommitQueue(
+            flush_race_bets, BET_BATCH_MS, BET_BATCH_MAX, name="bet_queue"
+        )
+        app.state.trifecta_queue = GroupCommitQueue(
+            flush_trifecta_bets, BET_BATCH_MS, BET_BATCH_MAX, name="trifecta_queue"
+        )
+        print(f"[BET QUEUE] group commit enabled window={BET_BATCH_MS}ms")
+
+    # ライブ配信（変更通知は表示キャッシュの bump から受け取る）
+    app.state.race_stream = RaceStreamHub(race_stream_snapshot)
+    race_cache.add_listener(app.state.race_stream.notify)
+
+
+async def flush_race_bets(key, items):
+    guild_id, schedule_id = key
+    return await app.state.db.buy_race_bets(
+        guild_id, schedule_id, items,
+        max_amount=MAX_AMOUNT,
+        allow_closed=TEST_MODE
+    )
+
+
+async def flush_trifecta_bets(key, items):
+    guild_id, schedule_id = key
+    return await app.state.db.buy_trifecta_bets(
+        guild_id, schedule_id, items,
+        max_amount=TRI_MAX_AMOUNT,
+        total_max_amount=TOTAL_MAX_AMOUNT
+    )
+
 
 @app.get("/api/race/by-id/{guild_id}/{schedule_id}")
 async def get_race_by_id(
     guild_id: str,
     schedule_id: int,
-    user: str | None = None
+    user: str | None = None,
+    if_none_match: str | None = Header(default=None)
 ):
 
+    # 全員共通の部分はキャッシュ（購入・フェーズ変更で作り直し）
+    async def build():
+        return await build_race_by_id(guild_id, schedule_id)
+
+    cached = await race_cache.get(
+        ("by-id", guild_id, schedule_id), guild_id, schedule_id, build
+    )
+
+    if not user:
+        return etag_response(cached.body, cached.etag, if_none_match)
+
+    # =========================
+    # 🔥 ユーザー別購入額取得（←ここ追加）
+    # =========================
+    rows = await app.state.db._fetch("""
+        SELECT pet_id, COALESCE(SUM(amount),0) AS total
+        FROM race_bets
+        WHERE guild_id = $1
+          AND schedule_id = $2
+          AND user_id = $3
+        GROUP BY pet_id
+    """, guild_id, schedule_id, user)
+
+    my_amounts = {
+        r["pet_id"]: r["total"] for r in rows
+    }
+
+    data = dict(cached.data)
+    data["pets"] = [
+        {**p, "my_amount": my_amounts.get(p["pet_id"], 0)}
+        for p in cached.data["pets"]
+    ]
+
+    body, etag = encode_json(data)
+    return etag_response(body, etag, if_none_match)
+
+
+async def build_race_by_id(guild_id: str, schedule_id: int):
+
     async with app.state.pool.acquire() as conn:
 
         race = await conn.fetchrow("""
@@ -218,93 +319,200 @@ async def get_race_by_id(
             ORDER BY e.created_at
         """, schedule_id, guild_id)
 
-        # =========================
-        # 🔥 全体プール取得
-        # =========================
-        total_pool_row = await conn.fetchrow("""
-            SELECT total_pool
-            FROM race_pools
-            WHERE guild_id = $1
-              AND race_date = $2
-              AND schedule_id = $3
-        """, guild_id, race["race_date"], race["id"])
+    # =========================
+    # 🔥 全体・ペット別プール（メモリ集計）
+    # =========================
+    total_pool, pet_pools = await pool_aggregator.get(
+        app.state.db, guild_id, race["race_date"], race["id"]
+    )
 
-        total_pool = total_pool_row["total_pool"] if total_pool_row else 0
+    # =========================
+    # パッシブ倍率（シミュレーターと同じスキルコンパイラ）
+    # =========================
+    passive_effects = {}
+
+    if entries and race["distance"] in race_engine.DISTANCE_BALANCE:
+        field = race_engine.RaceField([dict(e) for e in entries], race)
+        passive_effects = {p["pet_id"]: p for p in field.passive_preview()}
+
+    # =========================
+    # 推定勝率（抽選確定後に計算済み）
+    # =========================
+    probs = await app.state.db.get_race_probabilities(race["id"]) or {}
+    win_probs = probs.get("win", {})
+    top3_probs = probs.get("top3", {})
+
+    pets = []
+
+    for e in entries:
+
+        pet_id = e["pet_id"]
+
+        # ペットのプール額
+        pet_pool = pet_pools.get(pet_id, 0)
+
+        # オッズ計算
+        odds = calculate_odds(total_pool, pet_pool, take_rate=0.10)
+
+        # コンディション表示
+        label, cls = get_condition_label(e["happiness"])
+
+        pets.append({
+            "pet_id": pet_id,
+            "name": e["name"],
+            "adult_key": e["adult_key"],
+            "speed": e["speed"],
+            "power": e["power"],
+            "stamina": e["stamina"],
+            "condition_label": label,
+            "condition_class": cls,
+            "passive_skill": e["passive_skill"],
+            "passive_effect": passive_effects.get(pet_id),
+            "odds": odds,
+            "win_prob": win_probs.get(pet_id),
+            "top3_prob": top3_probs.get(pet_id),
+            "my_amount": 0   # user 指定時に上書き
+        })
+
+    data = {
+        "schedule_id": race["id"],
+        "race_date": str(race["race_date"]),
+        "race_time": race["race_time"],
+        "distance": race["distance"],
+        "surface": race["surface"],
+        "phase": phase,
+        "locked": race["lottery_done"],
+        "finished": race["race_finished"],
+        "pets": pets
+    }
 
-        # =========================
-        # 🔥 ペット別プール取得
-        # =========================
-        pet_pool_rows = await conn.fetch("""
-            SELECT pet_id, total_amount
-            FROM race_pet_pools
-            WHERE guild_id = $1
-              AND race_date = $2
-              AND schedule_id = $3
-        """, guild_id, race["race_date"], race["id"])
+    return jsonable_encoder(data), next_phase_change(race)
 
-        pet_pools = {r["pet_id"]: r["total_amount"] for r in pet_pool_rows}
+# =========================
+# ライブ配信（SSE）：オッズ・プール・3連単・フェーズ
+# =========================
+def race_status(data):
+    """open / locked / racing / finished"""
+    if data["finished"]:
+        return "finished"
+    if data["phase"] in ("racing", "closed"):
+        return "racing"
+    if data["locked"]:
+        return "locked"
+    return "open"
 
-        # =========================
-        # 🔥 ユーザー別購入額取得（←ここ追加）
-        # =========================
-        my_amounts = {}
 
-        if user:
-            rows = await conn.fetch("""
-                SELECT pet_id, COALESCE(SUM(amount),0) AS total
-                FROM race_bets
-                WHERE guild_id = $1
-                  AND schedule_id = $2
-                  AND user_id = $3
-                GROUP BY pet_id
-            """, guild_id, race["id"], user)
+async def race_stream_snapshot(guild_id: str, schedule_id: int):
+    """
+    配信用の状態。レース本体は /api/race/by-id と同じキャッシュを使うので、
+    REST のポーリングと合わせても変更1回につき DB 読み込み1回。
+    プールはメモリ集計、3連単はオッズ表キャッシュから。
+    """
+    cached = await race_cache.get(
+        ("by-id", guild_id, schedule_id), guild_id, schedule_id,
+        lambda: build_race_by_id(guild_id, schedule_id)
+    )
+    data = cached.data
 
-            my_amounts = {
-                r["pet_id"]: r["total"] for r in rows
-            }
+    race_date = date.fromisoformat(data["race_date"])
 
-        pets = []
+    total_pool, pet_pools = await pool_aggregator.get(
+        app.state.db, guild_id, race_date, schedule_id
+    )
 
-        for e in entries:
+    pets = {
+        p["pet_id"]: {"odds": p["odds"], "pool": pet_pools.get(p["pet_id"], 0)}
+        for p in data["pets"]
+    }
 
-            pet_id = e["pet_id"]
+    # 3連単は購入のある組み合わせだけ
+    trifecta = {}
+    trifecta_total = 0
+    matrix = await app.state.db.get_trifecta_matrix(guild_id, schedule_id)
+
+    if matrix:
+        trifecta_total = matrix["total_pool"]
+        payout_pool = trifecta_total * (1 - HOUSE_TAKE)
+
+        for key, amount in zip(trifecta_keys(matrix["runners"]), matrix["pools"]):
+            if amount > 0:
+                trifecta[key] = {"pool": amount, "odds": round(payout_pool / amount, 2)}
+
+    state = {
+        "phase": data["phase"],
+        "status": race_status(data),
+        "total_pool": total_pool,
+        "pets": pets,
+        "trifecta_total": trifecta_total,
+        "trifecta": trifecta
+    }
 
-            # ペットのプール額
-            pet_pool = pet_pools.get(pet_id, 0)
+    next_change = next_phase_change({
+        "race_date": race_date,
+        "race_time": data["race_time"]
+    })
 
-            # 自分の購入額（←ここ追加）
-            my_amount = my_amounts.get(pet_id, 0)
+    return state, next_change
 
-            # オッズ計算
-            odds = calculate_odds(total_pool, pet_pool, take_rate=0.10)
 
-            # コンディション表示
-            label, cls = get_condition_label(e["happiness"])
+@app.get("/api/race/stream/{guild_id}/{schedule_id}")
+async def stream_race(guild_id: str, schedule_id: int, request: Request):
+    """
+    text/event-stream。接続直後に snapshot、以降は phase / odds / trifecta の差分。
+    15秒ごとにコメント行（keep-alive）を送る。
+    """
+    # 無いレースは接続前に 404
+    await race_cache.get(
+        ("by-id", guild_id, schedule_id), guild_id, schedule_id,
+        lambda: build_race_by_id(guild_id, schedule_id)
+    )
 
-            pets.append({
-                "pet_id": pet_id,
-                "name": e["name"],
-                "adult_key": e["adult_key"],
-                "speed": e["speed"],
-                "power": e["power"],
-                "stamina": e["stamina"],
-                "condition_label": label,
-                "condition_class": cls,
-                "passive_skill": e["passive_skill"],
-                "odds": odds,
-                "my_amount": my_amount   # ← ここで使える
-            })
+    hub = app.state.race_stream
 
-        return {
-            "schedule_id": race["id"],
-            "race_date": str(race["race_date"]),
-            "race_time": race["race_time"],
-            "distance": race["distance"],
-            "surface": race["surface"],
-            "phase": phase,
-            "locked": race["lottery_done"],
-            "pets": pets
+    async def events():
+        async with hub.subscribe(guild_id, schedule_id) as queue:
+            while True:
+                if await request.is_disconnected():
+                    break
+
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+
+                if message is None:
+                    break
+
+                yield message
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
         }
+    )
+
+# =========================
+# 推定確率（単勝・複勝・3連単）
+# =========================
+@app.get("/api/race/probabilities/{guild_id}/{schedule_id}")
+async def get_race_probabilities(guild_id: str, schedule_id: int):
+
+    probs = await app.state.db.get_race_probabilities(schedule_id)
+
+    if not probs or probs["guild_id"] != guild_id:
+        raise HTTPException(status_code=404, detail="Probabilities not ready")
+
+    return {
+        "schedule_id": schedule_id,
+        "n_sims": probs["n_sims"],
+        "win": probs["win"],
+        "top3": probs["top3"],
+        "trifecta": probs["trifecta"]
+    }
 
 # =========================
 # 3連単口数
@@ -383,13 +591,31 @@ async def verify(user: str, guild: str, race: str, token: str):
 
 
 @app.get("/api/race/{guild_id}/{race_date}/{race_no}")
-async def get_race_entries(guild_id: str, race_date: str, race_no: int):
+async def get_race_entries(
+    guild_id: str,
+    race_date: str,
+    race_no: int,
+    if_none_match: str | None = Header(default=None)
+):
 
     try:
         race_date_obj = datetime.strptime(race_date, "%Y-%m-%d").date()
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format")
 
+    # schedule_id が引くまで分からないのでギルド単位で無効化
+    async def build():
+        return await build_race_entries(guild_id, race_date, race_date_obj, race_no)
+
+    cached = await race_cache.get(
+        ("entries", guild_id, race_date, race_no), guild_id, None, build
+    )
+
+    return etag_response(cached.body, cached.etag, if_none_match)
+
+
+async def build_race_entries(guild_id: str, race_date: str, race_date_obj, race_no: int):
+
     async with app.state.pool.acquire() as conn:
 
         race = await conn.fetchrow("""
@@ -450,7 +676,7 @@ async def get_race_entries(guild_id: str, race_date: str, race_no: int):
             })
 
         if not processed:
-            return {
+            return jsonable_encoder({
                 "schedule_id": race["id"],
                 "race_date": race_date,
                 "race_time": race["race_time"],
@@ -459,28 +685,16 @@ async def get_race_entries(guild_id: str, race_date: str, race_no: int):
                 "pets": [],
                 "distance": race["distance"],
                 "surface": race["surface"]
-            }
-
-        # ===== プール取得 =====
-        total_pool_row = await conn.fetchrow("""
-            SELECT total_pool
-            FROM race_pools
-            WHERE guild_id = $1
-              AND race_date = $2
-              AND schedule_id = $3
-        """, guild_id, race["race_date"], race["id"])
+            }), next_phase_change(race)
 
-        total_pool = total_pool_row["total_pool"] if total_pool_row else 0
-
-        pet_pool_rows = await conn.fetch("""
-            SELECT pet_id, total_amount
-            FROM race_pet_pools
-            WHERE guild_id = $1
-              AND race_date = $2
-              AND schedule_id = $3
-        """, guild_id, race["race_date"], race["id"])
+        # ===== プール取得（メモリ集計） =====
+        total_pool, pet_pools = await pool_aggregator.get(
+            app.state.db, guild_id, race["race_date"], race["id"]
+        )
 
-        pet_pools = {r["pet_id"]: r["total_amount"] for r in pet_pool_rows}
+        probs = await app.state.db.get_race_probabilities(race["id"]) or {}
+        win_probs = probs.get("win", {})
+        top3_probs = probs.get("top3", {})
 
         pets = []
         for p in processed:
@@ -499,10 +713,12 @@ async def get_race_entries(guild_id: str, race_date: str, race_no: int):
                 "condition_label": "—",
                 "condition_class": "normal",
                 "condition_ratio": 1.0,
-                "odds": odds
+                "odds": odds,
+                "win_prob": win_probs.get(pet_id),
+                "top3_prob": top3_probs.get(pet_id)
             })
 
-        return {
+        return jsonable_encoder({
             "schedule_id": race["id"],
             "race_date": race_date,
             "race_time": race["race_time"],
@@ -511,7 +727,7 @@ async def get_race_entries(guild_id: str, race_date: str, race_no: int):
             "pets": pets,
             "distance": race["distance"],
             "surface": race["surface"]
-        }
+        }), next_phase_change(race)
 
 @app.get("/api/balance")
 async def get_balance(
@@ -543,35 +759,53 @@ async def get_balance(
 # =========================
 
 @app.get("/api/race/latest/{guild_id}")
-async def get_latest_race(guild_id: str):
-    async with app.state.pool.acquire() as conn:
-        race = await conn.fetchrow("""
-            SELECT *
-            FROM race_schedules
-            WHERE guild_id = $1
-            ORDER BY race_date DESC, race_no DESC
-            LIMIT 1
-        """, guild_id)
+async def get_latest_race(
+    guild_id: str,
+    if_none_match: str | None = Header(default=None)
+):
+    async def build():
+        # 今日の開催中・次のレース。全部終わっていれば今日までの最後のレース
+        # （カレンダーは数日先まであるので、未来の日付は見ない）
+        race = await app.state.db.get_latest_active_race(guild_id)
 
         if not race:
-            return {"exists": False}
+            race = await app.state.db._fetchrow("""
+                SELECT *
+                FROM race_schedules
+                WHERE guild_id = $1
+                  AND race_date <= $2
+                ORDER BY race_date DESC, race_no DESC
+                LIMIT 1
+            """, guild_id, datetime.now(JST).date())
+
+        if not race:
+            return {"exists": False}, None
 
         phase = get_race_phase(race)
 
-        return {
+        return jsonable_encoder({
             "exists": True,
             "phase": phase,
             "schedule_id": race["id"],
             "race_no": race["race_no"],
             "race_date": str(race["race_date"]),
             "race_time": race["race_time"]
-        }
+        }), next_phase_change(race)
+
+    cached = await race_cache.get(("latest", guild_id), guild_id, None, build)
+
+    return etag_response(cached.body, cached.etag, if_none_match)
 
 # =========================
 # レース順位API
 # =========================
 @app.get("/api/race/result/{guild_id}/{race_date}/{schedule_id}")
-async def get_race_result(guild_id: str, race_date: str, schedule_id: int):
+async def get_race_result(
+    guild_id: str,
+    race_date: str,
+    schedule_id: int,
+    if_none_match: str | None = Header(default=None)
+):
 
     # 🔥 ここが重要
     try:
@@ -579,8 +813,8 @@ async def get_race_result(guild_id: str, race_date: str, schedule_id: int):
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format")
 
-    async with app.state.pool.acquire() as conn:
-        rows = await conn.fetch("""
+    async def build():
+        rows = await app.state.db._fetch("""
             SELECT re.pet_id,
                    re.rank,
                    re.score,
@@ -601,9 +835,15 @@ async def get_race_result(guild_id: str, race_date: str, schedule_id: int):
             ORDER BY re.rank ASC
         """, guild_id, race_date_obj, schedule_id)
 
-        return {
+        return jsonable_encoder({
             "results": [dict(r) for r in rows]
-        }
+        }), None
+
+    cached = await race_cache.get(
+        ("result", guild_id, race_date, schedule_id), guild_id, schedule_id, build
+    )
+
+    return etag_response(cached.body, cached.etag, if_none_match)
 # =========================
 # 3連単用順位API
 # =========================
@@ -652,17 +892,76 @@ async def get_trifecta_odds(
             third
         )
 
+        # 推定確率（未計算なら None）
+        probs = await app.state.db.get_race_probabilities(schedule_id) or {}
+        probability = probs.get("trifecta", {}).get(f"{first}-{second}-{third}")
+
         if total_pool == 0 or combo_pool == 0:
-            return {"status": "no_bets"}
+            return {"status": "no_bets", "probability": probability}
 
         payout_pool = total_pool * (1 - HOUSE_TAKE)
         odds = round(payout_pool / combo_pool, 2)
 
         return {
             "status": "ok",
-            "odds": odds
+            "odds": odds,
+            "probability": probability
         }
 
+
+# =========================
+# 3連単オッズ表（全組み合わせ）
+# =========================
+def trifecta_keys(runners):
+    """オッズ表の並び（i → j → k、同じ馬を飛ばす）で "a-b-c" を返す"""
+    n = len(runners)
+    return [
+        race_engine.trifecta_key(runners[i], runners[j], runners[k])
+        for i in range(n)
+        for j in range(n) if j != i
+        for k in range(n) if k != i and k != j
+    ]
+
+
+@app.get("/api/trifecta/matrix")
+async def get_trifecta_matrix(guild: str, schedule_id: int):
+    """
+    runners: 出走馬 pet_id（抽選順）
+    pools / odds / prob: 組み合わせごとの配列。並びは runners の添字 (i, j, k) を
+        i → j → k の順に回し、同じ馬を含むものを飛ばした順（8頭なら336要素）
+    odds は購入が無い組み合わせで null、prob は推定前なら null
+    """
+    matrix = await app.state.db.get_trifecta_matrix(guild, schedule_id)
+
+    if matrix is None:
+        raise HTTPException(status_code=404, detail="Race not found")
+
+    total_pool = matrix["total_pool"]
+    payout_pool = total_pool * (1 - HOUSE_TAKE)
+
+    odds = [
+        round(payout_pool / amount, 2) if amount > 0 else None
+        for amount in matrix["pools"]
+    ]
+
+    # 推定確率（あれば同じ並びで）
+    runners = matrix["runners"]
+    probs = await app.state.db.get_race_probabilities(schedule_id)
+    prob = None
+
+    if probs:
+        trifecta = probs["trifecta"]
+        prob = [trifecta.get(key) for key in trifecta_keys(runners)]
+
+    return {
+        "schedule_id": schedule_id,
+        "runners": runners,
+        "total_pool": total_pool,
+        "pools": matrix["pools"],
+        "odds": odds,
+        "prob": prob
+    }
+
 # =========================
 # 単勝購入口数
 # =========================
@@ -695,28 +994,36 @@ async def get_single_units(
 @app.get("/api/trifecta/pool")
 async def get_trifecta_pool(
     guild: str,
-    schedule_id: int
+    schedule_id: int,
+    if_none_match: str | None = Header(default=None)
 ):
-    async with app.state.pool.acquire() as conn:
+    async def build():
+        async with app.state.pool.acquire() as conn:
 
-        race = await conn.fetchrow("""
-            SELECT race_date
-            FROM race_schedules
-            WHERE id=$1 AND guild_id=$2
-        """, schedule_id, guild)
+            race = await conn.fetchrow("""
+                SELECT race_date
+                FROM race_schedules
+                WHERE id=$1 AND guild_id=$2
+            """, schedule_id, guild)
 
-        if not race:
-            return {"pool": 0}
+            if not race:
+                return {"pool": 0}, None
 
-        total_pool = await conn.fetchval("""
-            SELECT COALESCE(SUM(amount),0)
-            FROM race_trifecta_bets
-            WHERE guild_id=$1
-              AND race_date=$2
-              AND schedule_id=$3
-        """, guild, race["race_date"], schedule_id)
+            total_pool = await conn.fetchval("""
+                SELECT COALESCE(SUM(amount),0)
+                FROM race_trifecta_bets
+                WHERE guild_id=$1
+                  AND race_date=$2
+                  AND schedule_id=$3
+            """, guild, race["race_date"], schedule_id)
+
+            return {"pool": total_pool}, None
+
+    cached = await race_cache.get(
+        ("trifecta-pool", guild, schedule_id), guild, schedule_id, build
+    )
 
-        return {"pool": total_pool}
+    return etag_response(cached.body, cached.etag, if_none_match)
 
 # =========================
 # 🏆 入賞ランキングAPI（安定版）
@@ -724,59 +1031,55 @@ async def get_trifecta_pool(
 @app.get("/api/ranking/{guild_id}/{distance}")
 async def get_ranking(guild_id: str, distance: str):
 
-    async with app.state.pool.acquire() as conn:
-
-        rows = await conn.fetch("""
-            SELECT
-                p.id AS pet_id,
-                p.name,
-                p.adult_key,
+    # 通算成績表（finalize_race で加算）から上位50件
+    rows = await app.state.db.get_pet_ranking(guild_id, distance, limit=50)
 
-                p.base_speed,
-                p.train_speed,
-                p.base_power,
-                p.train_power,
-                p.base_stamina,
-                p.train_stamina,
+    return {
+        "results": [dict(r) for r in rows]
+    }
 
-                p.passive_skill,
-                p.user_id,
+# =========================
+# 🐎 ペット戦績API
+# =========================
+@app.get("/api/pet/career/{guild_id}/{pet_id}")
+async def get_pet_career(guild_id: str, pet_id: int):
 
-                COUNT(*) AS win_count
+    pet, stats = await app.state.db.get_pet_career(guild_id, pet_id)
 
-            FROM race_entries re
+    if pet is None:
+        raise HTTPException(status_code=404, detail="Pet not found")
 
-            JOIN race_schedules rs
-              ON rs.id = re.schedule_id
+    starts = sum(s["starts"] for s in stats)
+    wins = sum(s["wins"] for s in stats)
+    podiums = sum(s["podiums"] for s in stats)
 
-            JOIN oasistchi_pets p
-              ON p.id = re.pet_id
-
-            WHERE re.guild_id = $1
-              AND rs.distance = $2
-              AND re.rank = 1
-              AND re.status = 'selected'
-
-            GROUP BY
-                p.id,
-                p.name,
-                p.adult_key,
-                p.base_speed,
-                p.train_speed,
-                p.base_power,
-                p.train_power,
-                p.base_stamina,
-                p.train_stamina,
-                p.passive_skill,
-                p.user_id
-
-            ORDER BY win_count DESC
-            LIMIT 50
-        """, guild_id, distance)
+    return {
+        "pet_id": pet["pet_id"],
+        "name": pet["name"],
+        "adult_key": pet["adult_key"],
+        "user_id": pet["user_id"],
+        "passive_skill": pet["passive_skill"],
+        "total": {
+            "starts": starts,
+            "wins": wins,
+            "podiums": podiums,
+            "earnings": sum(s["earnings"] for s in stats),
+            "win_rate": round(wins / starts, 3) if starts else None,
+            "podium_rate": round(podiums / starts, 3) if starts else None
+        },
+        "distances": [
+            {
+                "distance": s["distance"],
+                "starts": s["starts"],
+                "wins": s["wins"],
+                "podiums": s["podiums"],
+                "earnings": s["earnings"],
+                "win_rate": round(s["wins"] / s["starts"], 3) if s["starts"] else None
+            }
+            for s in stats
+        ]
+    }
 
-        return {
-            "results": [dict(r) for r in rows]
-        }
 # =========================
 # 🎫 馬券購入API
 # =========================
@@ -808,132 +1111,52 @@ async def place_bet(data: BetRequest):
     if data.amount % UNIT_PRICE != 0:
         raise HTTPException(status_code=400, detail="1口1000rrc単位です")
 
-    async with app.state.pool.acquire() as conn:
-        async with conn.transaction():
+    # ②〜⑧ レース確認・上限・残高・減算・bet追加・プール更新（ユーザー行ロック＋1ステートメント）
+    if app.state.bet_queue is not None:
+        result = await app.state.bet_queue.submit(
+            (data.guild, data.race), (data.user, data.pet_id, data.amount)
+        )
+    else:
+        result = await app.state.db.buy_race_bet(
+            data.guild, data.race, data.user, data.pet_id, data.amount,
+            max_amount=MAX_AMOUNT,
+            allow_closed=TEST_MODE
+        )
 
-            # ② レース確認
-            race = await conn.fetchrow("""
-                SELECT *
-                FROM race_schedules
-                WHERE id = $1
-                  AND guild_id = $2
-            """, data.race, data.guild)
+    status = result["status"]
 
-            if not race:
-                raise HTTPException(status_code=404, detail="Race not found")
+    if status == "race_not_found":
+        raise HTTPException(status_code=404, detail="Race not found")
 
-            if race["lottery_done"] and not TEST_MODE:
-                raise HTTPException(status_code=400, detail="Betting closed")
+    if status == "closed":
+        raise HTTPException(status_code=400, detail="Betting closed")
 
-            # ③ 現在の購入合計取得
-            total_user_bet = await conn.fetchval("""
-                SELECT COALESCE(SUM(amount),0)
-                FROM race_bets
-                WHERE guild_id = $1
-                  AND schedule_id = $2
-                  AND user_id = $3
-            """, data.guild, race["id"], data.user)
-
-            new_total = total_user_bet + data.amount
-
-            if new_total > MAX_AMOUNT:
-                raise HTTPException(
-                    status_code=400,
-                    detail="このレースでは最大100口まで購入できます"
-                )
-
-            # ④ 残高取得
-            balance = await conn.fetchval("""
-                SELECT balance
-                FROM users
-                WHERE user_id = $1
-                  AND guild_id = $2
-            """, data.user, data.guild)
-
-            if balance is None:
-                raise HTTPException(status_code=400, detail="ユーザー未登録")
-
-            if balance < data.amount:
-                raise HTTPException(status_code=400, detail="残高不足")
-
-            # ⑤ 残高減算
-            await conn.execute("""
-                UPDATE users
-                SET balance = balance - $1
-                WHERE user_id = $2
-                  AND guild_id = $3
-            """, data.amount, data.user, data.guild)
-
-            # ⑥ bet追加
-            await conn.execute("""
-                INSERT INTO race_bets
-                (race_id, guild_id, race_date, schedule_id, user_id, pet_id, amount)
-                VALUES ($1,$2,$3,$4,$5,$6,$7)
-            """,
-                str(race["id"]),   # TEXT
-                str(data.guild),   # TEXT
-                race["race_date"], # DATE
-                race["id"],        # INTEGER
-                str(data.user),    # TEXT
-                str(data.pet_id),       # ← ★ここはそのまま整数
-                data.amount        # INTEGER
-            )
-            # ⑦ 全体プール更新
-            await conn.execute("""
-                INSERT INTO race_pools
-                (guild_id, race_date, schedule_id, total_pool)
-                VALUES ($1,$2,$3,$4)
-                ON CONFLICT (guild_id, race_date, schedule_id)
-                DO UPDATE SET total_pool = race_pools.total_pool + $4
-            """,
-                data.guild,
-                race["race_date"],
-                race["id"],
-                data.amount
-            )
+    if status == "limit":
+        raise HTTPException(
+            status_code=400,
+            detail="このレースでは最大100口まで購入できます"
+        )
 
-            # ⑧ 個別プール更新
-            await conn.execute("""
-                INSERT INTO race_pet_pools
-                (guild_id, race_date, schedule_id, pet_id, total_amount)
-                VALUES ($1,$2,$3,$4,$5)
-                ON CONFLICT (guild_id, race_date, schedule_id, pet_id)
-                DO UPDATE SET total_amount = race_pet_pools.total_amount + $5
-            """,
-                data.guild,
-                race["race_date"],
-                race["id"],
-                data.pet_id,
-                data.amount
-            )
+    if status == "no_user":
+        raise HTTPException(status_code=400, detail="ユーザー未登録")
 
-            # ⑨ 最新オッズ取得
-            total_pool = await conn.fetchval("""
-                SELECT total_pool
-                FROM race_pools
-                WHERE guild_id = $1
-                  AND race_date = $2
-                  AND schedule_id = $3
-            """, data.guild, race["race_date"], race["id"])
+    if status == "balance":
+        raise HTTPException(status_code=400, detail="残高不足")
 
-            pet_pool = await conn.fetchval("""
-                SELECT total_amount
-                FROM race_pet_pools
-                WHERE guild_id = $1
-                  AND race_date = $2
-                  AND schedule_id = $3
-                  AND pet_id = $4
-            """, data.guild, race["race_date"], race["id"], data.pet_id)
+    # ⑨ メモリ集計へ反映。オッズは更新後のプール（RETURNING）から
+    pool_aggregator.add(data.guild, result["race_date"], data.race, data.pet_id, data.amount)
 
-            odds = calculate_odds(total_pool, pet_pool, take_rate=0.10)
+    odds = calculate_odds(result["total_pool"], result["pet_pool"], take_rate=0.10)
 
-            return {
-                "status": "ok",
-                "new_odds": odds,
-                "user_total_bet": new_total,
-                "remaining_units": (MAX_AMOUNT - new_total) // UNIT_PRICE,
-                "remaining_balance": balance - data.amount
-            }
+    new_total = result["user_total"]
+
+    return {
+        "status": "ok",
+        "new_odds": odds,
+        "user_total_bet": new_total,
+        "remaining_units": (MAX_AMOUNT - new_total) // UNIT_PRICE,
+        "remaining_balance": result["balance_after"]
+    }
 
 # =========================
 # 3連単購入API
@@ -953,11 +1176,6 @@ class TrifectaRequest(BaseModel):
 @app.post("/api/trifecta/buy")
 async def buy_trifecta(data: TrifectaRequest):
 
-    TRI_UNIT = 10000
-    TRI_MAX_UNITS = 10
-    TRI_MAX_AMOUNT = TRI_UNIT * TRI_MAX_UNITS  # 100000
-    TOTAL_MAX_AMOUNT = 200000  # 単勝＋3連単 合算上限
-
     # 🔐 トークン検証
     if not verify_token(data.user, data.guild, str(data.race), data.token):
         raise HTTPException(status_code=403, detail="Invalid token")
@@ -971,108 +1189,42 @@ async def buy_trifecta(data: TrifectaRequest):
     if units > TRI_MAX_UNITS:
         raise HTTPException(status_code=400, detail="3連単は最大10口までです")
 
-    async with app.state.pool.acquire() as conn:
-        async with conn.transaction():
+    # レース確認・上限・残高・減算・3連単登録（ユーザー行ロック＋1ステートメント）
+    if app.state.trifecta_queue is not None:
+        result = await app.state.trifecta_queue.submit(
+            (data.guild, data.race),
+            (data.user, data.first, data.second, data.third, data.amount)
+        )
+    else:
+        result = await app.state.db.buy_trifecta_bet(
+            data.guild, data.race, data.user,
+            data.first, data.second, data.third, data.amount,
+            max_amount=TRI_MAX_AMOUNT,
+            total_max_amount=TOTAL_MAX_AMOUNT
+        )
 
-            race = await conn.fetchrow("""
-                SELECT race_date
-                FROM race_schedules
-                WHERE id=$1 AND guild_id=$2
-            """, data.race, data.guild)
+    status = result["status"]
 
-            if not race:
-                raise HTTPException(status_code=404, detail="Race not found")
+    if status == "race_not_found":
+        raise HTTPException(status_code=404, detail="Race not found")
 
-            # =========================
-            # ① 既に購入済み3連単合計
-            # =========================
-            trifecta_total = await conn.fetchval("""
-                SELECT COALESCE(SUM(amount),0)
-                FROM race_trifecta_bets
-                WHERE guild_id=$1
-                  AND race_date=$2
-                  AND schedule_id=$3
-                  AND user_id=$4
-            """,
-                data.guild,
-                race["race_date"],
-                data.race,
-                data.user
-            )
-
-            new_trifecta_total = trifecta_total + data.amount
-
-            if new_trifecta_total > TRI_MAX_AMOUNT:
-                raise HTTPException(
-                    status_code=400,
-                    detail="このレースでの3連単は最大10口までです"
-                )
+    if status == "limit":
+        raise HTTPException(
+            status_code=400,
+            detail="このレースでの3連単は最大10口までです"
+        )
 
-            # =========================
-            # ② 単勝合計取得
-            # =========================
-            single_total = await conn.fetchval("""
-                SELECT COALESCE(SUM(amount),0)
-                FROM race_bets
-                WHERE guild_id=$1
-                  AND schedule_id=$2
-                  AND user_id=$3
-            """,
-                data.guild,
-                data.race,
-                data.user
-            )
+    if status == "total_limit":
+        raise HTTPException(
+            status_code=400,
+            detail="このレースでの合計上限200000rrcを超えています"
+        )
 
-            combined_total = single_total + new_trifecta_total
-
-            if combined_total > TOTAL_MAX_AMOUNT:
-                raise HTTPException(
-                    status_code=400,
-                    detail="このレースでの合計上限200000rrcを超えています"
-                )
-
-            # =========================
-            # ③ 残高確認
-            # =========================
-            balance = await conn.fetchval("""
-                SELECT balance
-                FROM users
-                WHERE user_id=$1 AND guild_id=$2
-            """, data.user, data.guild)
-
-            if balance is None or balance < data.amount:
-                raise HTTPException(status_code=400, detail="残高不足")
-
-            # =========================
-            # ④ 残高減算
-            # =========================
-            await conn.execute("""
-                UPDATE users
-                SET balance = balance - $1
-                WHERE user_id=$2 AND guild_id=$3
-            """, data.amount, data.user, data.guild)
-
-            # =========================
-            # ⑤ 3連単登録
-            # =========================
-            await conn.execute("""
-                INSERT INTO race_trifecta_bets
-                (guild_id, race_date, schedule_id,
-                 user_id, first_pet_id, second_pet_id, third_pet_id, amount)
-                VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
-            """,
-                data.guild,
-                race["race_date"],
-                data.race,
-                data.user,
-                data.first,
-                data.second,
-                data.third,
-                data.amount
-            )
+    if status == "balance":
+        raise HTTPException(status_code=400, detail="残高不足")
 
-            return {
-                "status": "ok",
-                "remaining_balance": balance - data.amount,
-                "total_units": new_trifecta_total // TRI_UNIT
-            }
+    return {
+        "status": "ok",
+        "remaining_balance": result["balance_after"],
+        "total_units": result["user_total"] // TRI_UNIT
+    }